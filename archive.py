@@ -0,0 +1,73 @@
+import asyncio
+import logging
+import time
+from typing import Dict, Optional
+
+from database import Database
+
+logger = logging.getLogger(__name__)
+
+
+class MessageArchiver:
+    """Фоновый перенос переписки закрытых заказов в архив.
+
+    Раз в interval секунд сообщения комнат, закрытых дольше grace_period
+    секунд назад, переносятся из основной базы в архив (Database.archive_room_messages).
+    Основная база хранит только переписку текущей работы.
+    """
+
+    def __init__(self, db: Database, grace_period: float, interval: float, chunk_size: int):
+        self.db = db
+        self.grace_period = grace_period
+        self.interval = interval
+        self.chunk_size = chunk_size
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = asyncio.Event()
+        self._stats = {'runs': 0, 'rooms': 0, 'messages': 0, 'raw_bytes': 0, 'stored_bytes': 0}
+
+    def start(self):
+        """Запустить фоновую архивацию"""
+        if self._task is None:
+            self._stopping.clear()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Остановить фоновую архивацию (начатая комната дописывается при следующем запуске)"""
+        if self._task is None:
+            return
+        self._stopping.set()
+        await self._task
+        self._task = None
+
+    async def archive_once(self) -> int:
+        """Перенести в архив переписку всех подходящих комнат; возвращает количество сообщений"""
+        closed_before = time.time() - self.grace_period
+        archived = 0
+        for room_id in await self.db.get_rooms_to_archive(closed_before):
+            if self._stopping.is_set():
+                break
+            result = await self.db.archive_room_messages(room_id, self.chunk_size)
+            archived += result['messages']
+            self._stats['rooms'] += 1
+            self._stats['messages'] += result['messages']
+            self._stats['raw_bytes'] += result['raw_bytes']
+            self._stats['stored_bytes'] += result['stored_bytes']
+            logger.info(f"Переписка комнаты {room_id} перенесена в архив: {result['messages']} сообщений")
+        self._stats['runs'] += 1
+        return archived
+
+    async def _run(self):
+        """Цикл: архивируем сразу после запуска и затем раз в interval"""
+        while not self._stopping.is_set():
+            try:
+                await self.archive_once()
+            except Exception as e:
+                logger.error(f"Ошибка архивации переписки: {e}")
+            try:
+                await asyncio.wait_for(self._stopping.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def get_stats(self) -> Dict:
+        """Статистика: проходов, комнат, сообщений, байт до и после сжатия"""
+        return dict(self._stats)
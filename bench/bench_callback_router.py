@@ -0,0 +1,61 @@
+"""Маршрутизация нажатий кнопок: цепочка фильтров F.data.startswith против CallbackRouter.
+
+Худший случай для цепочки: нажата кнопка последнего зарегистрированного обработчика.
+
+python bench/bench_callback_router.py [число повторов]
+"""
+import sys
+import time
+
+from aiogram import F
+from aiogram.types import CallbackQuery, User
+
+import common  # noqa: F401  (путь к модулям репозитория)
+from callbacks import CallbackRouter
+
+
+async def handler(callback, *args):
+    pass
+
+
+def make_callback(data: str) -> CallbackQuery:
+    return CallbackQuery(id='1', from_user=User(id=1, is_bot=False, first_name='User'), chat_instance='1', data=data)
+
+
+def bench_chain(handlers: int, repeats: int) -> float:
+    """Время на одно нажатие: фильтры проверяются по порядку регистрации"""
+    filters = [F.data.startswith(f'action{i}_') for i in range(handlers)]
+    callback = make_callback(f'action{handlers - 1}_42_7')
+    started = time.perf_counter()
+    for _ in range(repeats):
+        for callback_filter in filters:
+            if callback_filter.resolve(callback):
+                int(callback.data.split('_')[1])
+                break
+    return (time.perf_counter() - started) / repeats
+
+
+def bench_router(handlers: int, repeats: int) -> float:
+    """Время на одно нажатие: разбор callback_data и поиск действия в словаре"""
+    router = CallbackRouter()
+    for i in range(handlers):
+        router.route(f'action{i}', int, int)(handler)
+    callback = make_callback(router.pack(f'action{handlers - 1}', 42, 7))
+    started = time.perf_counter()
+    for _ in range(repeats):
+        action, args = router.unpack(callback.data)
+        router._routes[action]
+    return (time.perf_counter() - started) / repeats
+
+
+def main():
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    print(f'{"handlers":>8s}  {"startswith chain":>16s}  {"router":>8s}')
+    for handlers in (10, 50, 200, 1000):
+        chain = bench_chain(handlers, repeats)
+        routed = bench_router(handlers, repeats)
+        print(f'{handlers:8d}  {chain * 1e6:13.1f} us  {routed * 1e6:5.1f} us')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,32 @@
+"""Профили PRAGMA: последовательные save_message на локальном диске.
+
+python bench/bench_pragmas.py [число сообщений]
+"""
+import asyncio
+import sys
+import time
+
+from common import temp_database
+from database import PRAGMA_PROFILES
+
+
+async def run(profile: str, count: int):
+    async with temp_database(profile) as db:
+        await db.add_user(1, 'admin', 'Admin', 'admin')
+        await db.add_user(2, 'customer', 'Customer')
+        room_id = await db.create_room('Комната', 1, 2)
+        started = time.perf_counter()
+        for i in range(count):
+            await db.save_message(room_id, 2, f'сообщение {i}', True)
+        elapsed = time.perf_counter() - started
+    print(f'{profile:11s} {count / elapsed:8.0f} msg/s  {elapsed / count * 1e6:7.1f} us/msg')
+
+
+async def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    for profile in PRAGMA_PROFILES:
+        await run(profile, count)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,55 @@
+"""Пользователи в комнате: перебор всех сессий против обратного индекса PresenceMap.
+
+После заполнения, перемещений и выходов индекс сверяется с перебором по каждой комнате.
+
+python bench/bench_presence.py [число сессий] [число комнат]
+"""
+import random
+import sys
+import time
+
+import common  # noqa: F401  (путь к модулям репозитория)
+from sessions import PresenceMap, SessionStore
+
+
+def main():
+    sessions_count = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    rooms = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+    random.seed(1)
+    # Без базы: карта только в памяти, сохранение не запускается
+    store = SessionStore(None, ttl=1e9, flush_interval=1)
+    presence = store.map('active_room', map_class=PresenceMap)
+    plain = {}
+    for user_id in range(sessions_count):
+        room_id = random.randrange(rooms)
+        presence[user_id] = plain[user_id] = room_id
+    for user_id in random.sample(range(sessions_count), sessions_count // 5):
+        room_id = random.randrange(rooms)
+        presence[user_id] = plain[user_id] = room_id
+    for user_id in random.sample(range(sessions_count), sessions_count // 10):
+        del presence[user_id]
+        del plain[user_id]
+    
+    by_room = {}
+    for user_id, room_id in plain.items():
+        by_room.setdefault(room_id, set()).add(user_id)
+    for room_id in range(rooms):
+        assert presence.users_in(room_id) == by_room.get(room_id, set()), room_id
+    
+    target = 42
+    repeats = 100
+    started = time.perf_counter()
+    for _ in range(repeats):
+        [user_id for user_id, room_id in plain.items() if room_id == target]
+    scan = (time.perf_counter() - started) / repeats
+    started = time.perf_counter()
+    for _ in range(repeats):
+        presence.users_in(target)
+    indexed = (time.perf_counter() - started) / repeats
+    print(f'sessions {len(presence)}, rooms {rooms}')
+    print(f'full scan:          {scan * 1e3:8.2f} ms per room lookup')
+    print(f'users_in(room_id):  {indexed * 1e6:8.2f} us per room lookup')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+"""Получатели рассылки комнаты: запросы на каждого участника против одного JOIN с кэшем.
+
+"before" повторяет прежний путь process_message: get_room_members, затем на каждого
+участника запрос роли и get_room_notification.
+
+python bench/bench_room_recipients.py [число участников]
+"""
+import asyncio
+import sys
+import time
+
+from common import temp_database
+
+
+async def main():
+    members = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    async with temp_database() as db:
+        for user_id in range(1, members + 1):
+            await db.add_user(user_id, f'user{user_id}', f'User {user_id}', 'admin' if user_id % 10 == 0 else 'developer')
+        room_id = await db.create_room('Комната', 1)
+        for user_id in range(2, members + 1):
+            await db.add_room_access(room_id, user_id, 'developer')
+        
+        queries = 0
+        original_read = db._read
+        
+        def counting_read():
+            nonlocal queries
+            queries += 1
+            return original_read()
+        
+        async def before():
+            for member in await db.get_room_members(room_id):
+                async with db._read() as conn:
+                    async with conn.execute('SELECT role FROM users WHERE user_id = ?', (member['user_id'],)) as cursor:
+                        await cursor.fetchone()
+                await db.get_room_notification(member['user_id'], room_id)
+        
+        async def after():
+            await db.get_room_broadcast_recipients(room_id)
+        
+        db._read = counting_read
+        for name, run in (('before', before), ('after (cold)', after), ('after (cached)', after)):
+            if name == 'after (cold)':
+                db._recipients_cache.clear()
+            queries = 0
+            started = time.perf_counter()
+            await run()
+            elapsed = time.perf_counter() - started
+            print(f'{name:15s} queries={queries:4d} {elapsed * 1000:7.2f} ms')
+        db._read = original_read
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
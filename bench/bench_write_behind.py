@@ -0,0 +1,38 @@
+"""Отложенная групповая запись: save_message из параллельных задач с DB_WRITE_BEHIND и без.
+
+python bench/bench_write_behind.py [число сообщений] [число задач]
+"""
+import asyncio
+import sys
+import time
+
+from common import temp_database
+
+
+async def run(profile: str, write_behind: bool, count: int, concurrency: int):
+    async with temp_database(profile, write_behind=write_behind) as db:
+        await db.add_user(1, 'admin', 'Admin', 'admin')
+        await db.add_user(2, 'customer', 'Customer')
+        room_id = await db.create_room('Комната', 1, 2)
+        
+        async def worker(first: int):
+            for i in range(first, count, concurrency):
+                await db.save_message(room_id, 2, f'сообщение {i}', True)
+        
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(first) for first in range(concurrency)))
+        await db.flush_pending_writes()
+        elapsed = time.perf_counter() - started
+    print(f'{profile:9s} write_behind={write_behind!s:5s} {count / elapsed:8.0f} msg/s')
+
+
+async def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    for profile in ('durable', 'balanced'):
+        for write_behind in (False, True):
+            await run(profile, write_behind, count, concurrency)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
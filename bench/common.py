@@ -0,0 +1,31 @@
+"""Общая подготовка бенчмарков: окружение для config.py и Database во временном каталоге.
+
+Скрипты запускаются из корня репозитория: python bench/<скрипт>.py
+"""
+import os
+import sys
+import tempfile
+from contextlib import asynccontextmanager
+
+# config.py завершает процесс без токена и администраторов
+os.environ.setdefault('BOT_TOKEN', '123456:bench-token')
+os.environ.setdefault('ADMIN_IDS', '1')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import Database  # noqa: E402
+
+
+@asynccontextmanager
+async def temp_database(pragma_profile: str = None, **attrs):
+    """Database на пустой базе во временном каталоге (attrs - атрибуты до init_db)"""
+    with tempfile.TemporaryDirectory(prefix='workbot-bench-') as directory:
+        db = Database(pragma_profile) if pragma_profile else Database()
+        db.db_path = os.path.join(directory, 'bot_database.db')
+        db.archive_path = os.path.join(directory, 'bot_archive.db')
+        for name, value in attrs.items():
+            setattr(db, name, value)
+        await db.init_db()
+        try:
+            yield db
+        finally:
+            await db.close()
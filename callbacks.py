@@ -0,0 +1,91 @@
+import logging
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from aiogram.types import CallbackQuery
+
+logger = logging.getLogger(__name__)
+
+# Версия формата callback_data: "v1:<действие>:<арг1>:<арг2>..."
+# Кнопки без префикса версии - старый формат "<действие>_<арг1>_<арг2>"
+CALLBACK_VERSION = 'v1'
+# Ограничение Telegram на длину callback_data (байты)
+CALLBACK_DATA_MAX_BYTES = 64
+
+
+class CallbackRouter:
+    """Типизированные callback_data и маршрутизация нажатий кнопок.
+
+    Каждое действие регистрируется с типами аргументов. Обработчик ищется
+    по точному ключу действия в словаре за O(1) и получает уже разобранные
+    аргументы вместо разбора callback.data.
+    """
+
+    def __init__(self):
+        # Действие -> (обработчик, типы аргументов)
+        self._routes: Dict[str, Tuple[Callable[..., Awaitable], Tuple[type, ...]]] = {}
+        # Ключи действий от длинных к коротким (для разбора старого формата)
+        self._legacy_prefixes: List[str] = []
+
+    def route(self, action: str, *arg_types: type):
+        """Декоратор: зарегистрировать обработчик действия с типами аргументов"""
+        if ':' in action:
+            raise ValueError(f"Недопустимый ключ действия: {action}")
+
+        def decorator(handler: Callable[..., Awaitable]):
+            if action in self._routes:
+                raise ValueError(f"Действие уже зарегистрировано: {action}")
+            self._routes[action] = (handler, arg_types)
+            self._legacy_prefixes = sorted(self._routes, key=len, reverse=True)
+            return handler
+        return decorator
+
+    def pack(self, action: str, *args) -> str:
+        """Закодировать действие и аргументы в callback_data"""
+        if action not in self._routes:
+            raise ValueError(f"Неизвестное действие: {action}")
+        arg_types = self._routes[action][1]
+        if len(args) != len(arg_types):
+            raise ValueError(f"Действие {action} ожидает {len(arg_types)} аргументов, получено {len(args)}")
+        for arg, arg_type in zip(args, arg_types):
+            if not isinstance(arg, arg_type) or ':' in str(arg):
+                raise ValueError(f"Недопустимый аргумент {arg!r} для действия {action}")
+        data = ':'.join([CALLBACK_VERSION, action, *(str(arg) for arg in args)])
+        if len(data.encode()) > CALLBACK_DATA_MAX_BYTES:
+            raise ValueError(f"callback_data длиннее {CALLBACK_DATA_MAX_BYTES} байт: {data}")
+        return data
+
+    def _split_legacy(self, data: str) -> Tuple[Optional[str], List[str]]:
+        """Разобрать старый формат "действие_арг_арг" (кнопки, отправленные до v1)"""
+        if data in self._routes:
+            return data, []
+        for prefix in self._legacy_prefixes:
+            if data.startswith(prefix + '_'):
+                return prefix, data[len(prefix) + 1:].split('_')
+        return None, []
+
+    def unpack(self, data: str) -> Optional[Tuple[str, tuple]]:
+        """Разобрать callback_data: (действие, аргументы) или None, если формат неизвестен"""
+        parts = data.split(':')
+        if parts[0] == CALLBACK_VERSION and len(parts) >= 2:
+            action, raw_args = parts[1], parts[2:]
+        else:
+            action, raw_args = self._split_legacy(data)
+        route = self._routes.get(action)
+        if route is None or len(raw_args) != len(route[1]):
+            return None
+        try:
+            args = tuple(arg_type(raw) for arg_type, raw in zip(route[1], raw_args))
+        except ValueError:
+            return None
+        return action, args
+
+    async def dispatch(self, callback: CallbackQuery):
+        """Вызвать обработчик нажатой кнопки"""
+        parsed = self.unpack(callback.data or '')
+        if parsed is None:
+            logger.warning(f"Неизвестная кнопка от пользователя {callback.from_user.id}: {callback.data}")
+            await callback.answer()
+            return
+        action, args = parsed
+        handler = self._routes[action][0]
+        await handler(callback, *args)
@@ -36,3 +36,94 @@ if not ADMIN_IDS or (len(ADMIN_IDS_STR) > 0 and any(x in ADMIN_IDS_STR.lower() f
 # Путь к базе данных
 DATABASE_PATH = 'bot_database.db'
 
+# Путь к архиву переписки закрытых заказов (отдельный файл SQLite)
+ARCHIVE_DATABASE_PATH = os.getenv('ARCHIVE_DATABASE_PATH', 'bot_archive.db')
+
+# Количество соединений на чтение в пуле базы данных
+DB_READ_POOL_SIZE = int(os.getenv('DB_READ_POOL_SIZE', '4'))
+
+# Профиль настроек SQLite: durable, balanced или throughput
+DB_PRAGMA_PROFILE = os.getenv('DB_PRAGMA_PROFILE', 'balanced').strip().lower()
+
+# Сколько запросов на запись, уже ждущих в очереди, объединяются в одну транзакцию
+DB_WRITE_GROUP_SIZE = int(os.getenv('DB_WRITE_GROUP_SIZE', '64'))
+# Дольше этого (мс) единица работы обновления не удерживает соединение записи: затем записи фиксируются
+UNIT_OF_WORK_MAX_HOLD_MS = int(os.getenv('UNIT_OF_WORK_MAX_HOLD_MS', '250'))
+
+# Отложенная групповая запись сообщений (write-behind): 1 - включить
+DB_WRITE_BEHIND = os.getenv('DB_WRITE_BEHIND', '0').strip().lower() in ('1', 'true', 'yes')
+# Максимальное окно потери сообщений при сбое (мс): не дольше этого сообщение ждет записи
+DB_WRITE_BEHIND_MAX_DELAY_MS = int(os.getenv('DB_WRITE_BEHIND_MAX_DELAY_MS', '50'))
+# Максимальное количество сообщений в одной транзакции
+DB_WRITE_BEHIND_BATCH_SIZE = int(os.getenv('DB_WRITE_BEHIND_BATCH_SIZE', '200'))
+# Размер очереди ожидающих записи сообщений (при заполнении обработчики ждут)
+DB_WRITE_BEHIND_QUEUE_SIZE = int(os.getenv('DB_WRITE_BEHIND_QUEUE_SIZE', '10000'))
+
+# Размер кэша получателей рассылки (количество комнат)
+ROOM_RECIPIENTS_CACHE_SIZE = int(os.getenv('ROOM_RECIPIENTS_CACHE_SIZE', '256'))
+
+# Размер кэша записей комнат (количество комнат)
+ROOM_CACHE_SIZE = int(os.getenv('ROOM_CACHE_SIZE', '1024'))
+
+# Размер кэша проверок доступа к комнатам (количество пар комната-пользователь)
+ROOM_ACCESS_CACHE_SIZE = int(os.getenv('ROOM_ACCESS_CACHE_SIZE', '10000'))
+
+# Размер кэша профилей пользователей для add_user (количество пользователей)
+USER_PROFILE_CACHE_SIZE = int(os.getenv('USER_PROFILE_CACHE_SIZE', '10000'))
+
+# Количество строк на одной странице списков (чаты, заказчики, комнаты, отзывы, история)
+LIST_PAGE_SIZE = int(os.getenv('LIST_PAGE_SIZE', '10'))
+
+# Количество сообщений на одной странице истории комнаты или чата
+HISTORY_PAGE_SIZE = int(os.getenv('HISTORY_PAGE_SIZE', '10'))
+
+# Максимальная длина сообщения при показе истории (символов, длиннее - обрезается)
+HISTORY_MESSAGE_PREVIEW = int(os.getenv('HISTORY_MESSAGE_PREVIEW', '300'))
+
+# Количество сообщений удаленной комнаты, удаляемых одной транзакцией в фоне
+ROOM_PURGE_BATCH_SIZE = int(os.getenv('ROOM_PURGE_BATCH_SIZE', '1000'))
+
+# Поиск по сообщениям: сколько самых новых совпадений ранжируется по релевантности
+# (более старые совпадения и архив закрытых заказов в результаты не попадают)
+SEARCH_RANK_WINDOW = int(os.getenv('SEARCH_RANK_WINDOW', '5000'))
+
+# Архивация переписки закрытых заказов: через сколько дней после закрытия
+# сообщения переносятся в архив, как часто проверять (секунды) и размер порции (сообщений)
+ARCHIVE_GRACE_DAYS = float(os.getenv('ARCHIVE_GRACE_DAYS', '30'))
+ARCHIVE_INTERVAL = float(os.getenv('ARCHIVE_INTERVAL', '3600'))
+ARCHIVE_CHUNK_SIZE = int(os.getenv('ARCHIVE_CHUNK_SIZE', '200'))
+
+# Максимальное количество одновременных отправок при рассылке
+FANOUT_CONCURRENCY = int(os.getenv('FANOUT_CONCURRENCY', '20'))
+
+# Ограничение исходящих запросов к Telegram
+# Общий лимит бота (сообщений в секунду)
+TELEGRAM_GLOBAL_RATE = float(os.getenv('TELEGRAM_GLOBAL_RATE', '30'))
+# Лимит для одного личного чата (сообщений в секунду) и допустимая серия подряд
+TELEGRAM_CHAT_RATE = float(os.getenv('TELEGRAM_CHAT_RATE', '1'))
+TELEGRAM_CHAT_BURST = float(os.getenv('TELEGRAM_CHAT_BURST', '3'))
+# Лимит для группы (сообщений в минуту)
+TELEGRAM_GROUP_RATE_PER_MIN = float(os.getenv('TELEGRAM_GROUP_RATE_PER_MIN', '20'))
+# Сколько раз повторять запрос после ответа 429 (RetryAfter)
+TELEGRAM_MAX_RETRIES = int(os.getenv('TELEGRAM_MAX_RETRIES', '3'))
+
+# Доставка исходящих сообщений через outbox
+# Количество сообщений, выбираемых из outbox за один проход
+OUTBOX_BATCH_SIZE = int(os.getenv('OUTBOX_BATCH_SIZE', '100'))
+# Интервал проверки outbox при отсутствии новых сообщений (секунды)
+OUTBOX_POLL_INTERVAL = float(os.getenv('OUTBOX_POLL_INTERVAL', '5'))
+# Максимальное количество попыток доставки одного сообщения
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', '8'))
+# Начальная и максимальная задержка перед повтором (секунды), задержка удваивается
+OUTBOX_RETRY_BASE_DELAY = float(os.getenv('OUTBOX_RETRY_BASE_DELAY', '2'))
+OUTBOX_RETRY_MAX_DELAY = float(os.getenv('OUTBOX_RETRY_MAX_DELAY', '600'))
+# Количество доставленных сообщений, удаляемых из outbox за раз
+OUTBOX_COMPACT_BATCH_SIZE = int(os.getenv('OUTBOX_COMPACT_BATCH_SIZE', '500'))
+# Сколько дней хранить недоставленные сообщения (для разбора ошибок), затем они удаляются
+OUTBOX_FAILED_RETENTION = float(os.getenv('OUTBOX_FAILED_RETENTION', '30'))
+
+# Состояние сессий (активные комнаты, чаты администраторов, ожидаемый ввод) в базе
+# Через сколько секунд без обращений запись состояния удаляется (по умолчанию 7 дней)
+SESSION_STATE_TTL = float(os.getenv('SESSION_STATE_TTL', str(7 * 24 * 3600)))
+# Интервал записи накопленных изменений состояния в базу (секунды)
+SESSION_STATE_FLUSH_INTERVAL = float(os.getenv('SESSION_STATE_FLUSH_INTERVAL', '2'))
@@ -1,183 +1,1240 @@
+import asyncio
+import contextvars
+import json
+import logging
+import re
+import sqlite3
+import time
+import zlib
 import aiosqlite
-from config import DATABASE_PATH
-from typing import List, Optional, Dict
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from config import (
+    DATABASE_PATH, ARCHIVE_DATABASE_PATH, DB_READ_POOL_SIZE, DB_PRAGMA_PROFILE, DB_WRITE_GROUP_SIZE, UNIT_OF_WORK_MAX_HOLD_MS,
+    DB_WRITE_BEHIND, DB_WRITE_BEHIND_MAX_DELAY_MS, DB_WRITE_BEHIND_BATCH_SIZE, DB_WRITE_BEHIND_QUEUE_SIZE,
+    ROOM_RECIPIENTS_CACHE_SIZE, ROOM_CACHE_SIZE, ROOM_ACCESS_CACHE_SIZE, USER_PROFILE_CACHE_SIZE, LIST_PAGE_SIZE,
+    HISTORY_PAGE_SIZE, ROOM_PURGE_BATCH_SIZE, SEARCH_RANK_WINDOW
+)
+from typing import Any, List, Optional, Dict, Set, Tuple
 
-class Database:
+logger = logging.getLogger(__name__)
+
+# Профили PRAGMA, применяемые к каждому соединению пула.
+# durable    - максимальная надежность (fsync на каждый коммит)
+# balanced   - WAL + synchronous=NORMAL: при сбое питания теряется только последний коммит
+# throughput - без fsync, максимальная скорость записи (допустима потеря последних коммитов)
+PRAGMA_PROFILES = {
+    'durable': {
+        'journal_mode': 'WAL',
+        'synchronous': 'FULL',
+        'cache_size': -8000,
+        'mmap_size': 0,
+        'busy_timeout': 5000,
+        'temp_store': 'DEFAULT',
+    },
+    'balanced': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'cache_size': -32000,
+        'mmap_size': 64 * 1024 * 1024,
+        'busy_timeout': 5000,
+        'temp_store': 'MEMORY',
+    },
+    'throughput': {
+        'journal_mode': 'WAL',
+        'synchronous': 'OFF',
+        'cache_size': -64000,
+        'mmap_size': 256 * 1024 * 1024,
+        'busy_timeout': 10000,
+        'temp_store': 'MEMORY',
+    },
+}
+
+# Вторичные индексы под горячие запросы (миграция 3; индексы сообщений по времени удалены миграцией 10)
+INDEXES = (
+    # get_user_rooms (не админ): покрывающий индекс по room_access для WHERE user_id = ?
+    'CREATE INDEX IF NOT EXISTS idx_room_access_user ON room_access (user_id, room_id, access_type)',
+    # get_user_rooms (админ), get_rooms_page: ORDER BY created_at
+    'CREATE INDEX IF NOT EXISTS idx_rooms_created ON rooms (created_at)',
+    # get_chats_page: ORDER BY last_message_at DESC
+    'CREATE INDEX IF NOT EXISTS idx_chats_last_message ON chats (last_message_at)',
+    # get_users_by_role: WHERE role = ? ORDER BY created_at DESC
+    'CREATE INDEX IF NOT EXISTS idx_users_role_created ON users (role, created_at)',
+    # get_customer_closed_orders: WHERE customer_id = ? ORDER BY closed_at DESC
+    'CREATE INDEX IF NOT EXISTS idx_order_history_customer_closed ON order_history (customer_id, closed_at)',
+    # get_customer_closed_orders: LEFT JOIN reviews ON room_id = ? AND user_id = ?
+    'CREATE INDEX IF NOT EXISTS idx_reviews_room_user ON reviews (room_id, user_id)',
+)
+
+# Индексы под постраничные списки (миграция 6): порядок (время, id) читается из индекса
+PAGINATION_INDEXES = (
+    # get_users_page без роли: ORDER BY created_at DESC, user_id DESC
+    'CREATE INDEX IF NOT EXISTS idx_users_created ON users (created_at)',
+    # get_customers_page: ORDER BY updated_at DESC, user_id DESC
+    'CREATE INDEX IF NOT EXISTS idx_customers_updated ON customers (updated_at, user_id)',
+    # get_reviews_page: ORDER BY created_at DESC, review_id DESC
+    'CREATE INDEX IF NOT EXISTS idx_reviews_created ON reviews (created_at)',
+    # get_order_history_page: ORDER BY closed_at DESC, history_id DESC
+    'CREATE INDEX IF NOT EXISTS idx_order_history_closed ON order_history (closed_at)',
+    # get_order_history_by_room: WHERE room_id = ?
+    'CREATE INDEX IF NOT EXISTS idx_order_history_room ON order_history (room_id)',
+)
+
+# Индексы под историю сообщений по message_id (миграция 7)
+HISTORY_INDEXES = (
+    # get_room_history: WHERE room_id = ? AND message_id < ? ORDER BY message_id DESC
+    'CREATE INDEX IF NOT EXISTS idx_messages_room_id ON messages (room_id, message_id)',
+    # get_chat_history: WHERE chat_id = ? AND message_id < ? ORDER BY message_id DESC
+    'CREATE INDEX IF NOT EXISTS idx_chat_messages_chat_id ON chat_messages (chat_id, message_id)',
+)
+
+# Индексы под внешние ключи и отложенное удаление комнат (миграция 8)
+CASCADE_INDEXES = (
+    # ON DELETE CASCADE из rooms: поиск настроек уведомлений комнаты
+    'CREATE INDEX IF NOT EXISTS idx_room_notifications_room ON room_notifications (room_id)',
+    # purge_deleted_rooms: комнаты, отмеченные удаленными
+    'CREATE INDEX IF NOT EXISTS idx_rooms_deleted ON rooms (deleted_at) WHERE deleted_at IS NOT NULL',
+)
+
+# Схема таблиц с внешними ключами после миграции 8 ({name} - имя создаваемой таблицы).
+# Данные комнаты удаляются вместе с ней (ON DELETE CASCADE), отзывы остаются без ссылки на комнату.
+# Ссылки на users не объявлены внешними ключами: администратор может указать ID пользователя,
+# который еще не писал боту и отсутствует в таблице users.
+CASCADE_SCHEMA = {
+    'rooms': '''
+        CREATE TABLE {name} (
+            room_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            room_name TEXT NOT NULL,
+            customer_id INTEGER,
+            created_by INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            status TEXT DEFAULT 'active',
+            deleted_at TIMESTAMP
+        )
+    ''',
+    'room_access': '''
+        CREATE TABLE {name} (
+            access_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            room_id INTEGER REFERENCES rooms(room_id) ON DELETE CASCADE,
+            user_id INTEGER,
+            access_type TEXT DEFAULT 'developer',
+            UNIQUE(room_id, user_id)
+        )
+    ''',
+    'messages': '''
+        CREATE TABLE {name} (
+            message_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            room_id INTEGER REFERENCES rooms(room_id) ON DELETE CASCADE,
+            sender_id INTEGER,
+            message_text TEXT,
+            is_from_customer BOOLEAN,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''',
+    'chats': '''
+        CREATE TABLE {name} (
+            chat_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            last_message_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            unread_count INTEGER DEFAULT 0,
+            UNIQUE(user_id)
+        )
+    ''',
+    'chat_messages': '''
+        CREATE TABLE {name} (
+            message_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER REFERENCES chats(chat_id) ON DELETE CASCADE,
+            sender_id INTEGER,
+            message_text TEXT,
+            is_from_user BOOLEAN,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''',
+    'customers': '''
+        CREATE TABLE {name} (
+            customer_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            notes TEXT,
+            status TEXT DEFAULT 'new',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE(user_id)
+        )
+    ''',
+    'room_notifications': '''
+        CREATE TABLE {name} (
+            notification_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            room_id INTEGER REFERENCES rooms(room_id) ON DELETE CASCADE,
+            enabled BOOLEAN DEFAULT 1,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE(user_id, room_id)
+        )
+    ''',
+    'reviews': '''
+        CREATE TABLE {name} (
+            review_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            room_id INTEGER REFERENCES rooms(room_id) ON DELETE SET NULL,
+            review_text TEXT NOT NULL,
+            admin_reply TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''',
+    'order_history': '''
+        CREATE TABLE {name} (
+            history_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            room_id INTEGER,
+            room_name TEXT NOT NULL,
+            customer_id INTEGER,
+            created_by INTEGER,
+            closed_by INTEGER,
+            closed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            room_created_at TIMESTAMP
+        )
+    ''',
+}
+
+# История заказов с именами заказчика, создателя и закрывшего (см. _order_history_row)
+ORDER_HISTORY_COLUMNS = '''
+    h.history_id, h.room_id, h.room_name, h.customer_id, h.created_by, h.closed_by,
+    h.closed_at, h.room_created_at,
+    u1.username as customer_username, u1.full_name as customer_name,
+    u2.username as creator_username, u2.full_name as creator_name,
+    u3.username as closer_username, u3.full_name as closer_name
+'''
+ORDER_HISTORY_FROM = '''
+    order_history h
+    LEFT JOIN users u1 ON h.customer_id = u1.user_id
+    LEFT JOIN users u2 ON h.created_by = u2.user_id
+    LEFT JOIN users u3 ON h.closed_by = u3.user_id
+'''
+ORDER_HISTORY_SELECT = f'SELECT {ORDER_HISTORY_COLUMNS} FROM {ORDER_HISTORY_FROM}'
+
+
+def _order_history_row(row) -> Dict:
+    """Строка ORDER_HISTORY_SELECT в словарь"""
+    return {
+        'history_id': row[0],
+        'room_id': row[1],
+        'room_name': row[2],
+        'customer_id': row[3],
+        'created_by': row[4],
+        'closed_by': row[5],
+        'closed_at': row[6],
+        'room_created_at': row[7],
+        'customer_username': row[8],
+        'customer_name': row[9],
+        'creator_username': row[10],
+        'creator_name': row[11],
+        'closer_username': row[12],
+        'closer_name': row[13]
+    }
+
+
+# Границы совпадения в snippet результатов search_messages (управляющие символы не встречаются в тексте)
+SEARCH_MARK_START = '\x02'
+SEARCH_MARK_END = '\x03'
+
+
+# Архив переписки закрытых заказов (отдельный файл, подключается как schema "archive").
+# Сообщения комнаты хранятся порциями: JSON-список строк messages, сжатый zlib.
+ARCHIVE_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS archive.archived_messages (
+        room_id INTEGER NOT NULL,
+        first_message_id INTEGER NOT NULL,
+        last_message_id INTEGER NOT NULL,
+        message_count INTEGER NOT NULL,
+        payload BLOB NOT NULL,
+        archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (room_id, last_message_id)
+    ) WITHOUT ROWID
+'''
+
+
+def fts_match_query(text: str) -> Optional[str]:
+    """Запрос FTS5 из текста пользователя: все слова (по началу слова), без операторов FTS5"""
+    words = re.findall(r'\w+', text)
+    if not words:
+        return None
+    # Каждое слово в кавычках - спецсимволы и AND/OR/NOT не разбираются как синтаксис запроса
+    return ' '.join(f'"{word}"*' for word in words)
+
+
+async def _migration_1_base_schema(db: aiosqlite.Connection):
+    """Базовая схема: все таблицы бота"""
+    # Таблица пользователей
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            full_name TEXT,
+            role TEXT DEFAULT 'user',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    
+    # Таблица комнат
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS rooms (
+            room_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            room_name TEXT NOT NULL,
+            customer_id INTEGER,
+            created_by INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (customer_id) REFERENCES users(user_id),
+            FOREIGN KEY (created_by) REFERENCES users(user_id)
+        )
+    ''')
+    
+    # Таблица доступа к комнатам (кто может видеть и писать в комнате)
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS room_access (
+            access_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            room_id INTEGER,
+            user_id INTEGER,
+            access_type TEXT DEFAULT 'developer',
+            FOREIGN KEY (room_id) REFERENCES rooms(room_id),
+            FOREIGN KEY (user_id) REFERENCES users(user_id),
+            UNIQUE(room_id, user_id)
+        )
+    ''')
+    
+    # Таблица сообщений (для истории)
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS messages (
+            message_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            room_id INTEGER,
+            sender_id INTEGER,
+            message_text TEXT,
+            is_from_customer BOOLEAN,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (room_id) REFERENCES rooms(room_id),
+            FOREIGN KEY (sender_id) REFERENCES users(user_id)
+        )
+    ''')
+    
+    # Таблица чатов (диалоги с пользователями до создания комнаты)
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS chats (
+            chat_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            last_message_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            unread_count INTEGER DEFAULT 0,
+            FOREIGN KEY (user_id) REFERENCES users(user_id),
+            UNIQUE(user_id)
+        )
+    ''')
+    
+    # Таблица сообщений в чатах
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS chat_messages (
+            message_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER,
+            sender_id INTEGER,
+            message_text TEXT,
+            is_from_user BOOLEAN,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (chat_id) REFERENCES chats(chat_id),
+            FOREIGN KEY (sender_id) REFERENCES users(user_id)
+        )
+    ''')
+    
+    # Таблица заказчиков с пометками
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS customers (
+            customer_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            notes TEXT,
+            status TEXT DEFAULT 'new',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(user_id),
+            UNIQUE(user_id)
+        )
+    ''')
+    
+    # Таблица настроек уведомлений по комнатам
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS room_notifications (
+            notification_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            room_id INTEGER,
+            enabled BOOLEAN DEFAULT 1,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(user_id),
+            FOREIGN KEY (room_id) REFERENCES rooms(room_id),
+            UNIQUE(user_id, room_id)
+        )
+    ''')
+    
+    # Таблица отзывов
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS reviews (
+            review_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            room_id INTEGER,
+            review_text TEXT NOT NULL,
+            admin_reply TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(user_id),
+            FOREIGN KEY (room_id) REFERENCES rooms(room_id)
+        )
+    ''')
+    
+    # Таблица истории заказов (удаленные/закрытые комнаты)
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS order_history (
+            history_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            room_id INTEGER,
+            room_name TEXT NOT NULL,
+            customer_id INTEGER,
+            created_by INTEGER,
+            closed_by INTEGER,
+            closed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            room_created_at TIMESTAMP,
+            FOREIGN KEY (customer_id) REFERENCES users(user_id),
+            FOREIGN KEY (created_by) REFERENCES users(user_id),
+            FOREIGN KEY (closed_by) REFERENCES users(user_id)
+        )
+    ''')
+
+
+async def _migration_2_rooms_status(db: aiosqlite.Connection):
+    """Поле status в таблице rooms для отслеживания статуса (active/closed)"""
+    # В базах, созданных до появления миграций, поле может уже существовать
+    async with db.execute('PRAGMA table_info(rooms)') as cursor:
+        columns = [row[1] for row in await cursor.fetchall()]
+    if 'status' not in columns:
+        await db.execute("ALTER TABLE rooms ADD COLUMN status TEXT DEFAULT 'active'")
+
+
+async def _migration_3_indexes(db: aiosqlite.Connection):
+    """Вторичные индексы для горячих запросов"""
+    for index_sql in INDEXES:
+        await db.execute(index_sql)
+
+
+async def _migration_4_outbox(db: aiosqlite.Connection):
+    """Таблица исходящих сообщений (outbox) для доставки после перезапуска"""
+    # status: pending - ждет отправки, sent - доставлено (удаляется при уплотнении),
+    # failed - доставка невозможна или исчерпаны попытки (удаляется по истечении срока хранения)
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER NOT NULL,
+            method TEXT NOT NULL,
+            params TEXT NOT NULL,
+            status TEXT DEFAULT 'pending',
+            attempts INTEGER DEFAULT 0,
+            next_attempt_at REAL NOT NULL,
+            last_error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    # get_due_outbox: WHERE status = 'pending' AND next_attempt_at <= ? ORDER BY id
+    await db.execute('CREATE INDEX IF NOT EXISTS idx_outbox_status_due ON outbox (status, next_attempt_at)')
+    # get_due_outbox: более ранние неотправленные сообщения того же чата
+    await db.execute('CREATE INDEX IF NOT EXISTS idx_outbox_chat_status ON outbox (chat_id, status, id)')
+
+
+async def _migration_5_session_state(db: aiosqlite.Connection):
+    """Таблица состояния сессий (активные комнаты, чаты администраторов, ожидаемый ввод)"""
+    # scope - имя словаря состояния, value - значение в JSON,
+    # updated_at - время последнего обращения (для истечения по TTL)
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS session_state (
+            scope TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            value TEXT NOT NULL,
+            updated_at REAL NOT NULL,
+            PRIMARY KEY (scope, user_id)
+        ) WITHOUT ROWID
+    ''')
+    # expire_session_state: WHERE updated_at < ?
+    await db.execute('CREATE INDEX IF NOT EXISTS idx_session_state_updated ON session_state (updated_at)')
+
+
+async def _migration_6_pagination_indexes(db: aiosqlite.Connection):
+    """Индексы для keyset-пагинации списков"""
+    # Ключ страницы заказчиков - updated_at, поэтому он не должен быть пустым
+    await db.execute('''
+        UPDATE customers
+        SET updated_at = COALESCE(created_at, (SELECT u.created_at FROM users u WHERE u.user_id = customers.user_id), CURRENT_TIMESTAMP)
+        WHERE updated_at IS NULL
+    ''')
+    for index_sql in PAGINATION_INDEXES:
+        await db.execute(index_sql)
+
+
+async def _migration_7_history_indexes(db: aiosqlite.Connection):
+    """Индексы для истории сообщений по message_id"""
+    for index_sql in HISTORY_INDEXES:
+        await db.execute(index_sql)
+
+
+async def _rebuild_table(db: aiosqlite.Connection, table: str, create_sql: str):
+    """Пересоздать таблицу по новой схеме с сохранением строк и счетчика AUTOINCREMENT"""
+    async with db.execute('SELECT seq FROM sqlite_sequence WHERE name = ?', (table,)) as cursor:
+        row = await cursor.fetchone()
+        seq = row[0] if row else None
+    new_table = f'{table}_new'
+    await db.execute(create_sql.format(name=new_table))
+    async with db.execute(f'PRAGMA table_info({table})') as cursor:
+        old_columns = {row[1] for row in await cursor.fetchall()}
+    async with db.execute(f'PRAGMA table_info({new_table})') as cursor:
+        columns = ', '.join(row[1] for row in await cursor.fetchall() if row[1] in old_columns)
+    await db.execute(f'INSERT INTO {new_table} ({columns}) SELECT {columns} FROM {table}')
+    await db.execute(f'DROP TABLE {table}')
+    await db.execute(f'ALTER TABLE {new_table} RENAME TO {table}')
+    # Не выдавать повторно ID удаленных строк
+    if seq is not None:
+        cursor = await db.execute('UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = ?', (seq, table))
+        if cursor.rowcount == 0:
+            await db.execute('INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)', (table, seq))
+
+
+async def _migration_8_foreign_keys(db: aiosqlite.Connection):
+    """Внешние ключи с ON DELETE CASCADE и отметка удаления комнаты (rooms.deleted_at)"""
+    # Строки, ссылающиеся на уже удаленные комнаты и чаты (накопились без внешних ключей)
+    for table in ('room_access', 'messages', 'room_notifications'):
+        await db.execute(f'DELETE FROM {table} WHERE room_id NOT IN (SELECT room_id FROM rooms)')
+    await db.execute('UPDATE reviews SET room_id = NULL WHERE room_id NOT IN (SELECT room_id FROM rooms)')
+    await db.execute('DELETE FROM chat_messages WHERE chat_id NOT IN (SELECT chat_id FROM chats)')
+    
+    # ALTER TABLE не меняет внешние ключи: таблицы пересоздаются (PRAGMA foreign_keys еще выключен)
+    for table, create_sql in CASCADE_SCHEMA.items():
+        await _rebuild_table(db, table, create_sql)
+    # Индексы удалены вместе со старыми таблицами
+    for index_sql in INDEXES + PAGINATION_INDEXES + HISTORY_INDEXES + CASCADE_INDEXES:
+        await db.execute(index_sql)
+    
+    async with db.execute('PRAGMA foreign_key_check') as cursor:
+        violations = await cursor.fetchall()
+    if violations:
+        raise RuntimeError(f"Нарушены внешние ключи после миграции: {violations[:10]}")
+
+
+async def _migration_9_fulltext_search(db: aiosqlite.Connection):
+    """Полнотекстовый индекс FTS5 по текстам сообщений комнат и чатов"""
+    for table, fts_table, id_column in (('messages', 'messages_fts', 'message_id'),
+                                        ('chat_messages', 'chat_messages_fts', 'message_id')):
+        # Внешнее содержимое: индекс хранит только термины, текст читается из самой таблицы
+        await db.execute(f'''
+            CREATE VIRTUAL TABLE IF NOT EXISTS {fts_table} USING fts5(
+                message_text, content='{table}', content_rowid='{id_column}',
+                tokenize='unicode61 remove_diacritics 2'
+            )
+        ''')
+        # Триггеры поддерживают индекс при вставке, удалении (в т.ч. каскадном) и правке сообщения
+        await db.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {fts_table}_insert AFTER INSERT ON {table} BEGIN
+                INSERT INTO {fts_table} (rowid, message_text) VALUES (new.{id_column}, new.message_text);
+            END
+        ''')
+        await db.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {fts_table}_delete AFTER DELETE ON {table} BEGIN
+                INSERT INTO {fts_table} ({fts_table}, rowid, message_text) VALUES ('delete', old.{id_column}, old.message_text);
+            END
+        ''')
+        await db.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {fts_table}_update AFTER UPDATE OF message_text ON {table} BEGIN
+                INSERT INTO {fts_table} ({fts_table}, rowid, message_text) VALUES ('delete', old.{id_column}, old.message_text);
+                INSERT INTO {fts_table} (rowid, message_text) VALUES (new.{id_column}, new.message_text);
+            END
+        ''')
+        # Индексируем уже сохраненные сообщения
+        await db.execute(f"INSERT INTO {fts_table} ({fts_table}) VALUES ('rebuild')")
+
+
+async def _migration_10_drop_time_ordered_message_indexes(db: aiosqlite.Connection):
+    """Удаление индексов сообщений по времени: история читается по message_id"""
+    # Без читающих запросов индексы только замедляли каждую вставку сообщения
+    await db.execute('DROP INDEX IF EXISTS idx_messages_room_created')
+    await db.execute('DROP INDEX IF EXISTS idx_chat_messages_chat_created')
+
+
+# Упорядоченный список миграций схемы: (версия, описание, функция)
+MIGRATIONS = (
+    (1, 'базовая схема', _migration_1_base_schema),
+    (2, 'поле rooms.status', _migration_2_rooms_status),
+    (3, 'индексы горячих запросов', _migration_3_indexes),
+    (4, 'таблица outbox', _migration_4_outbox),
+    (5, 'таблица session_state', _migration_5_session_state),
+    (6, 'индексы постраничных списков', _migration_6_pagination_indexes),
+    (7, 'индексы истории сообщений', _migration_7_history_indexes),
+    (8, 'внешние ключи и отложенное удаление комнат', _migration_8_foreign_keys),
+    (9, 'полнотекстовый поиск по сообщениям', _migration_9_fulltext_search),
+    (10, 'удаление индексов сообщений по времени', _migration_10_drop_time_ordered_message_indexes),
+)
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+class _WriteRequest:
+    """Запрос на запись в очереди задачи записи.
+    
+    granted - задача записи открыла для запроса точку сохранения и передала соединение;
+    released - запрос закончил работу (True) или завершился ошибкой (False);
+    done - транзакция группы зафиксирована (или изменения запроса отменены).
+    """
+    
     def __init__(self):
+        loop = asyncio.get_running_loop()
+        self.granted = loop.create_future()
+        self.released = loop.create_future()
+        self.done = loop.create_future()
+    
+    def finish(self, error: Optional[BaseException] = None):
+        """Сообщить запросу результат фиксации"""
+        if self.done.done():
+            return
+        if error is None:
+            self.done.set_result(None)
+        else:
+            self.done.set_exception(error)
+
+
+# Единица работы текущего обновления Telegram (задается Database.unit_of_work)
+_current_unit: contextvars.ContextVar[Optional['UnitOfWork']] = contextvars.ContextVar('unit_of_work', default=None)
+
+# Ошибки, которые относятся к отдельной строке пакета (ограничения, неверный тип значения)
+_ROW_ERRORS = (sqlite3.IntegrityError, sqlite3.InterfaceError)
+
+# Ключ в списке сброшенных кэшей единицы работы: после фиксации кэш очищается целиком
+_ALL_KEYS = object()
+
+
+class UnitOfWork:
+    """Единица работы одного обновления Telegram: его записи идут одной транзакцией.
+    
+    Соединение записи берется у задачи записи при первой записи обновления и
+    удерживается до точки фиксации: запроса к Telegram, ожидания отложенной
+    записи, конца обновления или истечения Database.unit_max_hold секунд
+    (на случай ожиданий, не связанных с базой). Пока транзакция открыта, чтения идут через
+    то же соединение и видят свои изменения. Ошибка обработчика откатывает
+    все незафиксированные записи обновления.
+    """
+    
+    def __init__(self, db: 'Database'):
+        self.db = db
+        self.active = True
+        # Записи, чтения и фиксация единицы выполняются по очереди (в том числе из дочерних задач)
+        self._lock = asyncio.Lock()
+        self._request: Optional[_WriteRequest] = None
+        self._writes = 0
+        # Ключи кэшей, сброшенные до фиксации: сбрасываются повторно после нее
+        self._invalidated: List[Tuple['LRUCache', Any]] = []
+        # Таймер ограничения удержания соединения записи и запущенная им фиксация
+        self._hold_timer: Optional[asyncio.TimerHandle] = None
+        self._hold_commit: Optional[asyncio.Task] = None
+    
+    @property
+    def in_transaction(self) -> bool:
+        """Есть ли у единицы незафиксированная транзакция"""
+        return self._request is not None
+    
+    @asynccontextmanager
+    async def write(self):
+        """Запись в транзакции единицы; ошибка отменяет изменения только этого блока"""
+        async with self._lock:
+            if self.active:
+                if self._request is None:
+                    self._request = await self.db._request_writer()
+                    self._start_hold_timer()
+                conn = self.db._writer
+                if not self._writes:
+                    # Первая запись: при ошибке отменяется весь запрос единицы, точка сохранения не нужна
+                    try:
+                        yield conn
+                    except BaseException:
+                        self._stop_hold_timer()
+                        request, self._request = self._request, None
+                        request.released.set_result(False)
+                        await request.done
+                        raise
+                    self._writes += 1
+                    return
+                if not conn.in_transaction:
+                    await conn.execute('BEGIN')
+                await conn.execute('SAVEPOINT unit_write')
+                try:
+                    yield conn
+                except BaseException:
+                    if conn.in_transaction:
+                        await conn.execute('ROLLBACK TO unit_write')
+                        await conn.execute('RELEASE unit_write')
+                    raise
+                await conn.execute('RELEASE unit_write')
+                self._writes += 1
+                return
+        # Единица уже завершена (запись из задачи, пережившей обновление)
+        async with self.db._write_request() as conn:
+            yield conn
+    
+    @asynccontextmanager
+    async def read(self):
+        """Чтение через соединение записи, пока транзакция единицы открыта"""
+        async with self._lock:
+            yield self.db._writer
+    
+    async def commit(self):
+        """Зафиксировать записи единицы (если они есть)"""
+        await self._finish(True)
+    
+    def _start_hold_timer(self):
+        """Запустить таймер удержания соединения записи"""
+        if self.db.unit_max_hold > 0:
+            self._hold_timer = asyncio.get_running_loop().call_later(self.db.unit_max_hold, self._hold_expired)
+    
+    def _stop_hold_timer(self):
+        """Остановить таймер удержания (транзакция единицы завершается)"""
+        if self._hold_timer is not None:
+            self._hold_timer.cancel()
+            self._hold_timer = None
+    
+    def _hold_expired(self):
+        """Единица держит соединение записи дольше unit_max_hold: зафиксировать ее записи"""
+        self._hold_timer = None
+        self.db._write_stats['units_hold_expired'] += 1
+        logger.warning(f"Единица работы удерживает соединение записи дольше {self.db.unit_max_hold} с: фиксация")
+        self._hold_commit = asyncio.create_task(self._commit_held())
+    
+    async def _commit_held(self):
+        """Фиксация по таймеру удержания (ошибка только записывается в журнал)"""
+        try:
+            await self.commit()
+        except Exception as e:
+            logger.error(f"Ошибка фиксации единицы работы по таймеру удержания: {e}")
+    
+    async def rollback(self):
+        """Откатить незафиксированные записи единицы"""
+        await self._finish(False)
+    
+    async def _finish(self, commit: bool):
+        """Завершить транзакцию единицы и привести кэши в соответствие с базой"""
+        async with self._lock:
+            self._stop_hold_timer()
+            request, self._request = self._request, None
+            if request is None:
+                return
+            writes, self._writes = self._writes, 0
+            invalidated, self._invalidated = self._invalidated, []
+            request.released.set_result(commit)
+            committed = False
+            try:
+                await request.done
+                committed = commit
+            finally:
+                for cache, key in invalidated:
+                    if key is _ALL_KEYS:
+                        cache.clear()
+                    else:
+                        cache.invalidate(key)
+                if committed:
+                    self.db._write_stats['units_committed'] += 1
+                    # Фоновые задачи могли проснуться до фиксации и не увидеть новых строк
+                    self.db.outbox_ready.set()
+                    self.db._purge_ready.set()
+                elif writes:
+                    self.db._write_stats['units_rolled_back'] += 1
+                    # Кэши в памяти могли получить значения отмененных записей
+                    self.db._profiles.clear()
+                    await self.db._load_roles()
+
+
+class LRUCache:
+    """Небольшой LRU-кэш в памяти со счетчиками попаданий и промахов"""
+    
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        # Поколения ключей, которые сейчас читаются из базы после промаха:
+        # ключ -> [поколение, число незавершенных чтений]. Инвалидация
+        # увеличивает поколение, и устаревшее чтение не попадает в кэш
+        self._fills: Dict = {}
+    
+    def get(self, key):
+        """Получить значение из кэша (None при промахе)"""
+        if key in self._data:
+            self._data.move_to_end(key)
+            self.hits += 1
+            return self._data[key]
+        self.misses += 1
+        return None
+    
+    def put(self, key, value):
+        """Положить значение в кэш, вытеснив самое старое при переполнении"""
+        self._data[key] = value
+        self._data.move_to_end(key)
+        if len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+    
+    def begin_fill(self, key) -> int:
+        """Начать чтение ключа из базы после промаха; возвращает поколение ключа для end_fill"""
+        fill = self._fills.setdefault(key, [0, 0])
+        fill[1] += 1
+        return fill[0]
+    
+    def end_fill(self, key, generation: int, value=None):
+        """Завершить чтение ключа: положить value в кэш, только если ключ не инвалидировали за время чтения"""
+        fill = self._fills[key]
+        fill[1] -= 1
+        if fill[1] == 0:
+            del self._fills[key]
+        if value is not None and fill[0] == generation:
+            self.put(key, value)
+    
+    def invalidate(self, key):
+        """Удалить значение из кэша (внутри открытой единицы работы - еще раз после ее фиксации)"""
+        self._data.pop(key, None)
+        if key in self._fills:
+            self._fills[key][0] += 1
+        unit = _current_unit.get()
+        if unit is not None and unit.in_transaction:
+            unit._invalidated.append((self, key))
+    
+    def clear(self):
+        """Очистить кэш (внутри открытой единицы работы - еще раз после ее фиксации)"""
+        self._data.clear()
+        for fill in self._fills.values():
+            fill[0] += 1
+        unit = _current_unit.get()
+        if unit is not None and unit.in_transaction:
+            unit._invalidated.append((self, _ALL_KEYS))
+    
+    def get_stats(self) -> Dict:
+        """Размер кэша и счетчики попаданий/промахов"""
+        total = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / total, 3) if total else 0.0
+        }
+
+
+class Database:
+    def __init__(self, pragma_profile: str = DB_PRAGMA_PROFILE):
+        if pragma_profile not in PRAGMA_PROFILES:
+            raise ValueError(f"Неизвестный профиль SQLite: {pragma_profile}")
         self.db_path = DATABASE_PATH
+        self.archive_path = ARCHIVE_DATABASE_PATH
+        self.read_pool_size = DB_READ_POOL_SIZE
+        self.pragma_profile = pragma_profile
+        # Предел удержания соединения записи одной единицей работы (секунды, 0 - без предела)
+        self.unit_max_hold = UNIT_OF_WORK_MAX_HOLD_MS / 1000
+        # Пул соединений: одно соединение на запись и несколько на чтение
+        self._writer: Optional[aiosqlite.Connection] = None
+        # Все изменения идут через одну задачу записи с очередью запросов;
+        # запросы, накопившиеся в очереди, фиксируются общей транзакцией
+        self._write_requests: Optional[asyncio.Queue] = None
+        self._write_task: Optional[asyncio.Task] = None
+        self._write_stats = {
+            'requests': 0, 'failed': 0, 'transactions': 0, 'max_group': 0,
+            'units_committed': 0, 'units_rolled_back': 0, 'units_hold_expired': 0
+        }
+        self._readers: List[aiosqlite.Connection] = []
+        self._read_pool: Optional[asyncio.Queue] = None
+        # Очередь отложенной записи сообщений (включается DB_WRITE_BEHIND)
+        self.write_behind = DB_WRITE_BEHIND
+        self.write_behind_max_delay = DB_WRITE_BEHIND_MAX_DELAY_MS / 1000
+        self.write_behind_queue_size = DB_WRITE_BEHIND_QUEUE_SIZE
+        self._pending_writes: Optional[asyncio.Queue] = None
+        self._write_behind_task: Optional[asyncio.Task] = None
+        # Кэш получателей рассылки по комнатам (room_id -> список получателей)
+        self._recipients_cache = LRUCache(ROOM_RECIPIENTS_CACHE_SIZE)
+        # Кэш записей комнат (room_id -> строка rooms, включая status)
+        self._rooms_cache = LRUCache(ROOM_CACHE_SIZE)
+        # Кэш ролей: все пользователи с ролью, отличной от 'user' (user_id -> роль),
+        # и множество всех известных пользователей (загружаются при запуске)
+        self._roles: Dict[int, str] = {}
+        self._known_users: Set[int] = set()
+        # Последние записанные (username, full_name) пользователей: add_user без изменений не пишет в базу
+        self._profiles = LRUCache(USER_PROFILE_CACHE_SIZE)
+        # Кэш участия в комнатах ((room_id, user_id) -> есть ли доступ) для проверки доступа
+        self._memberships = LRUCache(ROOM_ACCESS_CACHE_SIZE)
+        # Сигнал диспетчеру outbox о новых исходящих сообщениях
+        self.outbox_ready = asyncio.Event()
+        # Фоновое удаление сообщений комнат, отмеченных удаленными (порциями по purge_batch_size)
+        self.purge_batch_size = ROOM_PURGE_BATCH_SIZE
+        self._purge_ready = asyncio.Event()
+        self._purge_task: Optional[asyncio.Task] = None
+        self._purge_stopping = False
+    
+    async def _open_pool(self):
+        """Открыть постоянные соединения с базой данных"""
+        if self._writer is not None:
+            return
+        self._writer = await aiosqlite.connect(self.db_path)
+        await self._apply_pragmas(self._writer)
+        await self._attach_archive(self._writer)
+        # Режим журнала хранится в файле архива: достаточно установить его один раз
+        async with self._writer.execute('PRAGMA archive.journal_mode = WAL') as cursor:
+            await cursor.fetchone()
+        self._read_pool = asyncio.Queue()
+        for _ in range(max(1, self.read_pool_size)):
+            conn = await aiosqlite.connect(self.db_path)
+            await self._apply_pragmas(conn)
+            await self._attach_archive(conn)
+            self._readers.append(conn)
+            self._read_pool.put_nowait(conn)
+    
+    async def _attach_archive(self, conn: aiosqlite.Connection):
+        """Подключить архив переписки к соединению как схему archive"""
+        await conn.execute('ATTACH DATABASE ? AS archive', (self.archive_path,))
+    
+    async def _apply_pragmas(self, conn: aiosqlite.Connection):
+        """Применить к соединению PRAGMA из выбранного профиля"""
+        for name, value in PRAGMA_PROFILES[self.pragma_profile].items():
+            await conn.execute(f'PRAGMA {name} = {value}')
+    
+    async def get_pragma_report(self) -> Dict:
+        """Получить фактические значения PRAGMA соединения на запись"""
+        report = {}
+        async with self._write() as db:
+            for name in PRAGMA_PROFILES[self.pragma_profile]:
+                async with db.execute(f'PRAGMA {name}') as cursor:
+                    row = await cursor.fetchone()
+                    report[name] = row[0] if row else None
+        return report
+    
+    def get_cache_stats(self) -> Dict:
+        """Статистика кэшей: записи комнат, получатели рассылки, доступ к комнатам и роли"""
+        return {
+            'rooms': self._rooms_cache.get_stats(),
+            'room_recipients': self._recipients_cache.get_stats(),
+            'room_access': self._memberships.get_stats(),
+            'roles': {'users': len(self._known_users), 'with_role': len(self._roles)},
+            'user_profiles': self._profiles.get_stats()
+        }
+    
+    def get_write_stats(self) -> Dict:
+        """Статистика задачи записи: запросов, ошибок, транзакций, наибольшая группа, единицы работы (в т.ч. зафиксированные по таймеру)"""
+        return dict(self._write_stats)
+    
+    async def close(self):
+        """Закрыть все соединения пула"""
+        await self._stop_room_purge()
+        await self._stop_write_behind()
+        await self._stop_writer()
+        for conn in self._readers:
+            await conn.close()
+        self._readers = []
+        self._read_pool = None
+        if self._writer is not None:
+            await self._writer.close()
+            self._writer = None
+    
+    @asynccontextmanager
+    async def unit_of_work(self):
+        """Единица работы для обработки одного обновления: фиксация в конце, откат при ошибке"""
+        unit = UnitOfWork(self)
+        token = _current_unit.set(unit)
+        try:
+            yield unit
+        except BaseException:
+            unit.active = False
+            await unit.rollback()
+            raise
+        else:
+            unit.active = False
+            await unit.commit()
+        finally:
+            _current_unit.reset(token)
+    
+    async def commit_unit_of_work(self):
+        """Точка фиксации: зафиксировать записи текущей единицы работы, если транзакция открыта"""
+        unit = _current_unit.get()
+        if unit is not None and unit.in_transaction:
+            await unit.commit()
+    
+    @asynccontextmanager
+    async def _read(self):
+        """Взять соединение на чтение из пула (в открытой единице работы - соединение записи)"""
+        unit = _current_unit.get()
+        if unit is not None and unit.in_transaction:
+            async with unit.read() as conn:
+                yield conn
+            return
+        conn = await self._read_pool.get()
+        try:
+            yield conn
+        finally:
+            self._read_pool.put_nowait(conn)
+    
+    @asynccontextmanager
+    async def _write(self):
+        """Получить соединение на запись (в единице работы - в ее транзакции)"""
+        unit = _current_unit.get()
+        if unit is not None and unit.active:
+            async with unit.write() as conn:
+                yield conn
+            return
+        async with self._write_request() as conn:
+            yield conn
+    
+    async def _request_writer(self) -> _WriteRequest:
+        """Поставить запрос в очередь задачи записи и дождаться соединения"""
+        request = _WriteRequest()
+        self._write_requests.put_nowait(request)
+        try:
+            await request.granted
+        except BaseException:
+            # Отмена в момент, когда очередь уже дошла до запроса
+            if not request.granted.cancelled():
+                request.released.set_result(False)
+            raise
+        return request
+    
+    @asynccontextmanager
+    async def _write_request(self):
+        """Отдельный запрос к задаче записи.
+        
+        Выход из блока ждет фиксации транзакции; при ошибке в блоке отменяются
+        только его изменения, остальные запросы группы фиксируются.
+        """
+        request = await self._request_writer()
+        try:
+            yield request.granted.result()
+        except BaseException:
+            request.released.set_result(False)
+            await request.done
+            raise
+        request.released.set_result(True)
+        await request.done
+    
+    async def _write_loop(self):
+        """Задача записи: выполняет запросы по очереди, объединяя ждущие запросы в одну транзакцию"""
+        stopping = False
+        while not stopping:
+            request = await self._write_requests.get()
+            if request is None:
+                break
+            group = []
+            served = 0
+            try:
+                while True:
+                    served += 1
+                    if await self._serve_write(request, savepoint=bool(group)):
+                        group.append(request)
+                    if served >= DB_WRITE_GROUP_SIZE or self._write_requests.empty():
+                        break
+                    request = self._write_requests.get_nowait()
+                    if request is None:
+                        stopping = True
+                        break
+                await self._writer.commit()
+            except Exception as e:
+                logger.error(f"Ошибка транзакции записи ({len(group)} запросов): {e}")
+                if self._writer.in_transaction:
+                    await self._writer.rollback()
+                if request is not None and not request.granted.done():
+                    # Запрос, до которого очередь не успела дойти
+                    request.granted.set_exception(e)
+                elif request is not None:
+                    request.finish(e)
+                self._write_stats['failed'] += len(group)
+                for request in group:
+                    request.finish(e)
+                continue
+            for request in group:
+                request.finish()
+            self._write_stats['transactions'] += 1
+            self._write_stats['max_group'] = max(self._write_stats['max_group'], served)
+    
+    async def _serve_write(self, request: _WriteRequest, savepoint: bool) -> bool:
+        """Выполнить один запрос в транзакции группы; True - изменения запроса остаются в группе.
+        
+        Первый запрос группы (savepoint=False) открывает транзакцию сам, как обычная запись;
+        следующие выполняются внутри точки сохранения, чтобы ошибка отменяла только их изменения.
+        """
+        if request.granted.cancelled():
+            return False
+        if savepoint:
+            if not self._writer.in_transaction:
+                await self._writer.execute('BEGIN')
+            await self._writer.execute('SAVEPOINT write_request')
+            if request.granted.cancelled():
+                await self._writer.execute('RELEASE write_request')
+                return False
+        request.granted.set_result(self._writer)
+        self._write_stats['requests'] += 1
+        if await request.released:
+            if savepoint:
+                await self._writer.execute('RELEASE write_request')
+            return True
+        self._write_stats['failed'] += 1
+        if not savepoint:
+            await self._writer.rollback()
+            request.finish()
+            return False
+        if not self._writer.in_transaction:
+            # SQLite сам откатил всю транзакцию: изменения предыдущих запросов группы потеряны
+            request.finish()
+            raise aiosqlite.OperationalError("транзакция отменена SQLite после ошибки запроса")
+        await self._writer.execute('ROLLBACK TO write_request')
+        await self._writer.execute('RELEASE write_request')
+        request.finish()
+        return False
+    
+    async def _stop_writer(self):
+        """Остановить задачу записи после выполнения всех запросов из очереди"""
+        if self._write_task is None:
+            return
+        self._write_requests.put_nowait(None)
+        await self._write_task
+        self._write_task = None
     
     async def init_db(self):
-        """Инициализация базы данных и создание таблиц"""
-        async with aiosqlite.connect(self.db_path) as db:
-            # Таблица пользователей
-            await db.execute('''
-                CREATE TABLE IF NOT EXISTS users (
-                    user_id INTEGER PRIMARY KEY,
-                    username TEXT,
-                    full_name TEXT,
-                    role TEXT DEFAULT 'user',
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-            
-            # Таблица комнат
-            await db.execute('''
-                CREATE TABLE IF NOT EXISTS rooms (
-                    room_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    room_name TEXT NOT NULL,
-                    customer_id INTEGER,
-                    created_by INTEGER,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (customer_id) REFERENCES users(user_id),
-                    FOREIGN KEY (created_by) REFERENCES users(user_id)
-                )
-            ''')
-            
-            # Таблица доступа к комнатам (кто может видеть и писать в комнате)
-            await db.execute('''
-                CREATE TABLE IF NOT EXISTS room_access (
-                    access_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    room_id INTEGER,
-                    user_id INTEGER,
-                    access_type TEXT DEFAULT 'developer',
-                    FOREIGN KEY (room_id) REFERENCES rooms(room_id),
-                    FOREIGN KEY (user_id) REFERENCES users(user_id),
-                    UNIQUE(room_id, user_id)
-                )
-            ''')
-            
-            # Таблица сообщений (для истории)
-            await db.execute('''
-                CREATE TABLE IF NOT EXISTS messages (
-                    message_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    room_id INTEGER,
-                    sender_id INTEGER,
-                    message_text TEXT,
-                    is_from_customer BOOLEAN,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (room_id) REFERENCES rooms(room_id),
-                    FOREIGN KEY (sender_id) REFERENCES users(user_id)
-                )
-            ''')
-            
-            # Таблица чатов (диалоги с пользователями до создания комнаты)
-            await db.execute('''
-                CREATE TABLE IF NOT EXISTS chats (
-                    chat_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER,
-                    last_message_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    unread_count INTEGER DEFAULT 0,
-                    FOREIGN KEY (user_id) REFERENCES users(user_id),
-                    UNIQUE(user_id)
-                )
-            ''')
-            
-            # Таблица сообщений в чатах
-            await db.execute('''
-                CREATE TABLE IF NOT EXISTS chat_messages (
-                    message_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    chat_id INTEGER,
-                    sender_id INTEGER,
-                    message_text TEXT,
-                    is_from_user BOOLEAN,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (chat_id) REFERENCES chats(chat_id),
-                    FOREIGN KEY (sender_id) REFERENCES users(user_id)
-                )
-            ''')
-            
-            # Таблица заказчиков с пометками
-            await db.execute('''
-                CREATE TABLE IF NOT EXISTS customers (
-                    customer_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER,
-                    notes TEXT,
-                    status TEXT DEFAULT 'new',
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (user_id) REFERENCES users(user_id),
-                    UNIQUE(user_id)
-                )
-            ''')
-            
-            # Таблица настроек уведомлений по комнатам
-            await db.execute('''
-                CREATE TABLE IF NOT EXISTS room_notifications (
-                    notification_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER,
-                    room_id INTEGER,
-                    enabled BOOLEAN DEFAULT 1,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (user_id) REFERENCES users(user_id),
-                    FOREIGN KEY (room_id) REFERENCES rooms(room_id),
-                    UNIQUE(user_id, room_id)
-                )
-            ''')
-            
-            # Таблица отзывов
-            await db.execute('''
-                CREATE TABLE IF NOT EXISTS reviews (
-                    review_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER,
-                    room_id INTEGER,
-                    review_text TEXT NOT NULL,
-                    admin_reply TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (user_id) REFERENCES users(user_id),
-                    FOREIGN KEY (room_id) REFERENCES rooms(room_id)
-                )
-            ''')
-            
-            # Таблица истории заказов (удаленные/закрытые комнаты)
-            await db.execute('''
-                CREATE TABLE IF NOT EXISTS order_history (
-                    history_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    room_id INTEGER,
-                    room_name TEXT NOT NULL,
-                    customer_id INTEGER,
-                    created_by INTEGER,
-                    closed_by INTEGER,
-                    closed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    room_created_at TIMESTAMP,
-                    FOREIGN KEY (customer_id) REFERENCES users(user_id),
-                    FOREIGN KEY (created_by) REFERENCES users(user_id),
-                    FOREIGN KEY (closed_by) REFERENCES users(user_id)
-                )
-            ''')
-            
-            # Добавляем поле status в таблицу rooms для отслеживания статуса (active/closed)
+        """Инициализация базы данных и применение миграций схемы"""
+        await self._open_pool()
+        await self._migrate(self._writer)
+        # Включается после миграций: пересоздание таблиц идет без проверки внешних ключей
+        await self._writer.execute('PRAGMA foreign_keys = ON')
+        await self._writer.execute(ARCHIVE_SCHEMA)
+        await self._writer.commit()
+        if self._write_task is None:
+            self._write_requests = asyncio.Queue()
+            self._write_task = asyncio.create_task(self._write_loop())
+        await self._load_roles()
+        if self.write_behind and self._write_behind_task is None:
+            self._pending_writes = asyncio.Queue(maxsize=self.write_behind_queue_size)
+            self._write_behind_task = asyncio.create_task(self._write_behind_loop())
+        if self._purge_task is None:
+            # Дочищаем комнаты, удаление которых прервал перезапуск
+            self._purge_stopping = False
+            self._purge_ready.set()
+            self._purge_task = asyncio.create_task(self._room_purge_loop())
+    
+    async def _migrate(self, db: aiosqlite.Connection):
+        """Применить недостающие миграции (версия схемы хранится в PRAGMA user_version)"""
+        async with db.execute('PRAGMA user_version') as cursor:
+            row = await cursor.fetchone()
+            version = row[0] if row else 0
+        
+        # Быстрый путь: схема актуальна, ничего не делаем
+        if version >= SCHEMA_VERSION:
+            return
+        
+        for target_version, description, migration in MIGRATIONS:
+            if target_version <= version:
+                continue
+            # Каждая миграция применяется в отдельной транзакции вместе с номером версии
+            await db.execute('BEGIN IMMEDIATE')
             try:
-                await db.execute('ALTER TABLE rooms ADD COLUMN status TEXT DEFAULT "active"')
-            except:
-                pass  # Поле уже существует
-            
-            await db.commit()
+                await migration(db)
+                await db.execute(f'PRAGMA user_version = {target_version}')
+                await db.commit()
+            except BaseException:
+                await db.rollback()
+                raise
+            logger.info(f"Миграция БД {target_version} применена: {description}")
+            version = target_version
+    
+    async def _load_roles(self):
+        """Загрузить кэш ролей одним запросом"""
+        async with self._read() as db:
+            async with db.execute('SELECT user_id, role FROM users') as cursor:
+                rows = await cursor.fetchall()
+        self._known_users = {row[0] for row in rows}
+        self._roles = {row[0]: row[1] for row in rows if row[1] != 'user'}
+        logger.info(f"Кэш ролей загружен: {len(self._known_users)} пользователей, {len(self._roles)} с ролью")
+    
+    def _cache_role(self, user_id: int, role: Optional[str]):
+        """Обновить кэш ролей после записи в таблицу users"""
+        self._known_users.add(user_id)
+        if role is None or role == 'user':
+            self._roles.pop(user_id, None)
+        else:
+            self._roles[user_id] = role
+    
+    def _plan_user_upsert(self, user_id: int, username: Optional[str], full_name: Optional[str], role: str) -> Optional[Dict]:
+        """Сравнить профиль с последним записанным: None, если запись в базу не нужна"""
+        known = user_id in self._known_users
+        role_changes = role != 'user' and self._roles.get(user_id) != role
+        previous = self._profiles.get(user_id) if known else None
+        if previous is not None:
+            profile = (previous[0] if username is None else username,
+                       previous[1] if full_name is None else full_name)
+            if profile == previous and not role_changes:
+                return None
+        elif username is not None and full_name is not None:
+            profile = (username, full_name)
+        else:
+            profile = None
+        return {'known': known, 'role_changes': role_changes, 'profile': profile}
+    
+    async def _upsert_user(self, db: aiosqlite.Connection, user_id: int, username: Optional[str],
+                           full_name: Optional[str], role: str):
+        """Добавить пользователя или обновить профиль в рамках открытой транзакции"""
+        await db.execute('''
+            INSERT INTO users (user_id, username, full_name, role)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT (user_id) DO UPDATE SET
+                username = COALESCE(excluded.username, users.username),
+                full_name = COALESCE(excluded.full_name, users.full_name),
+                role = CASE WHEN excluded.role = 'user' THEN users.role ELSE excluded.role END
+            WHERE users.username IS NOT COALESCE(excluded.username, users.username)
+               OR users.full_name IS NOT COALESCE(excluded.full_name, users.full_name)
+               OR (excluded.role != 'user' AND users.role IS NOT excluded.role)
+        ''', (user_id, username, full_name, role))
+    
+    def _apply_user_upsert(self, user_id: int, role: str, plan: Dict):
+        """Обновить кэши профилей и ролей после коммита записи пользователя"""
+        if plan['profile'] is not None:
+            self._profiles.put(user_id, plan['profile'])
+        if plan['role_changes'] or not plan['known']:
+            self._cache_role(user_id, role)
+        if plan['role_changes']:
+            # Роль влияет на признак администратора у получателей рассылки
+            self._recipients_cache.clear()
     
     async def add_user(self, user_id: int, username: str = None, full_name: str = None, role: str = 'user'):
-        """Добавить пользователя в базу"""
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute('''
-                INSERT OR REPLACE INTO users (user_id, username, full_name, role)
-                VALUES (?, ?, ?, ?)
-            ''', (user_id, username, full_name, role))
-            await db.commit()
+        """Добавить пользователя или обновить его профиль.
+        
+        username/full_name = None не затирают сохраненные значения, роль 'user'
+        не понижает уже назначенную роль (для этого есть update_user_role).
+        Если профиль не изменился, запись в базу не выполняется.
+        """
+        plan = self._plan_user_upsert(user_id, username, full_name, role)
+        if plan is None:
+            return
+        async with self._write() as db:
+            await self._upsert_user(db, user_id, username, full_name, role)
+        self._apply_user_upsert(user_id, role, plan)
     
     async def get_user_role(self, user_id: int) -> Optional[str]:
-        """Получить роль пользователя"""
-        async with aiosqlite.connect(self.db_path) as db:
-            async with db.execute('SELECT role FROM users WHERE user_id = ?', (user_id,)) as cursor:
-                row = await cursor.fetchone()
-                return row[0] if row else None
+        """Получить роль пользователя (из кэша ролей, без запроса к базе)"""
+        role = self._roles.get(user_id)
+        if role is not None:
+            return role
+        return 'user' if user_id in self._known_users else None
     
-    async def is_admin(self, user_id: int) -> bool:
-        """Проверить, является ли пользователь администратором"""
-        role = await self.get_user_role(user_id)
-        return role == 'admin'
+    async def get_user(self, user_id: int) -> Optional[Dict]:
+        """Получить информацию о пользователе"""
+        async with self._read() as db:
+            async with db.execute('''
+                SELECT user_id, username, full_name, role, created_at
+                FROM users WHERE user_id = ?
+            ''', (user_id,)) as cursor:
+                row = await cursor.fetchone()
+                if row:
+                    return {
+                        'user_id': row[0],
+                        'username': row[1],
+                        'full_name': row[2],
+                        'role': row[3],
+                        'created_at': row[4]
+                    }
+                return None
     
     async def create_room(self, room_name: str, created_by: int, customer_id: int = None) -> int:
         """Создать новую комнату"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._write() as db:
             cursor = await db.execute('''
                 INSERT INTO rooms (room_name, customer_id, created_by)
                 VALUES (?, ?, ?)
@@ -196,31 +1253,56 @@ class Database:
                 INSERT INTO room_access (room_id, user_id, access_type)
                 VALUES (?, ?, 'developer')
             ''', (room_id, created_by))
-            
-            await db.commit()
-            return room_id
+        
+        self._rooms_cache.invalidate(room_id)
+        self._memberships.invalidate((room_id, created_by))
+        if customer_id:
+            self._memberships.invalidate((room_id, customer_id))
+        return room_id
+    
+    async def _get_room_record(self, room_id: int) -> Optional[Dict]:
+        """Запись комнаты из кэша; при промахе читается из базы и кладется в кэш"""
+        record = self._rooms_cache.get(room_id)
+        if record is not None:
+            return record
+        generation = self._rooms_cache.begin_fill(room_id)
+        try:
+            async with self._read() as db:
+                async with db.execute('''
+                    SELECT room_id, room_name, customer_id, created_by, created_at, status
+                    FROM rooms WHERE room_id = ? AND deleted_at IS NULL
+                ''', (room_id,)) as cursor:
+                    row = await cursor.fetchone()
+            if row:
+                record = {
+                    'room_id': row[0],
+                    'room_name': row[1],
+                    'customer_id': row[2],
+                    'created_by': row[3],
+                    'created_at': row[4],
+                    'status': row[5]
+                }
+        finally:
+            # Удаление или изменение комнаты за время чтения не перезаписывается старой записью
+            self._rooms_cache.end_fill(room_id, generation, record)
+        return record
     
     async def get_room(self, room_id: int) -> Optional[Dict]:
         """Получить информацию о комнате"""
-        async with aiosqlite.connect(self.db_path) as db:
-            async with db.execute('''
-                SELECT room_id, room_name, customer_id, created_by, created_at
-                FROM rooms WHERE room_id = ?
-            ''', (room_id,)) as cursor:
-                row = await cursor.fetchone()
-                if row:
-                    return {
-                        'room_id': row[0],
-                        'room_name': row[1],
-                        'customer_id': row[2],
-                        'created_by': row[3],
-                        'created_at': row[4]
-                    }
-                return None
+        record = await self._get_room_record(room_id)
+        if record is None:
+            return None
+        return {
+            'room_id': record['room_id'],
+            'room_name': record['room_name'],
+            'customer_id': record['customer_id'],
+            'created_by': record['created_by'],
+            'created_at': record['created_at']
+        }
     
     async def get_user_rooms(self, user_id: int, is_admin: bool = False) -> List[Dict]:
         """Получить все комнаты, к которым у пользователя есть доступ"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._read() as db:
             if is_admin:
                 # Администраторы видят все комнаты
                 async with db.execute('''
@@ -228,6 +1310,7 @@ class Database:
                            COALESCE(ra.access_type, 'admin') as access_type
                     FROM rooms r
                     LEFT JOIN room_access ra ON r.room_id = ra.room_id AND ra.user_id = ?
+                    WHERE r.deleted_at IS NULL
                     ORDER BY r.created_at DESC
                 ''', (user_id,)) as cursor:
                     rows = await cursor.fetchall()
@@ -255,24 +1338,48 @@ class Database:
     
     async def add_room_access(self, room_id: int, user_id: int, access_type: str = 'developer'):
         """Добавить доступ пользователю к комнате"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._write() as db:
             await db.execute('''
                 INSERT OR REPLACE INTO room_access (room_id, user_id, access_type)
                 VALUES (?, ?, ?)
             ''', (room_id, user_id, access_type))
-            await db.commit()
+        self._recipients_cache.invalidate(room_id)
+        self._memberships.invalidate((room_id, user_id))
     
     async def remove_room_access(self, room_id: int, user_id: int):
         """Удалить доступ пользователя к комнате"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._write() as db:
             await db.execute('''
                 DELETE FROM room_access WHERE room_id = ? AND user_id = ?
             ''', (room_id, user_id))
-            await db.commit()
+        self._recipients_cache.invalidate(room_id)
+        self._memberships.invalidate((room_id, user_id))
+    
+    async def has_room_access(self, room_id: int, user_id: int) -> bool:
+        """Есть ли у пользователя доступ к комнате (кэш; при промахе - поиск по UNIQUE(room_id, user_id))"""
+        key = (room_id, user_id)
+        allowed = self._memberships.get(key)
+        if allowed is not None:
+            return allowed
+        generation = self._memberships.begin_fill(key)
+        try:
+            async with self._read() as db:
+                async with db.execute('SELECT 1 FROM room_access WHERE room_id = ? AND user_id = ?', key) as cursor:
+                    allowed = await cursor.fetchone() is not None
+        finally:
+            # Отзыв доступа за время чтения не перезаписывается старым значением
+            self._memberships.end_fill(key, generation, allowed)
+        return allowed
+    
+    async def user_has_any_room(self, user_id: int) -> bool:
+        """Есть ли у пользователя доступ хотя бы к одной комнате (первая строка индекса по user_id)"""
+        async with self._read() as db:
+            async with db.execute('SELECT 1 FROM room_access WHERE user_id = ? LIMIT 1', (user_id,)) as cursor:
+                return await cursor.fetchone() is not None
     
     async def get_room_access(self, room_id: int, user_id: int) -> Optional[Dict]:
         """Получить доступ пользователя к комнате"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._read() as db:
             async with db.execute('''
                 SELECT access_id, room_id, user_id, access_type
                 FROM room_access
@@ -290,7 +1397,7 @@ class Database:
     
     async def get_room_members(self, room_id: int) -> List[Dict]:
         """Получить всех участников комнаты"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._read() as db:
             async with db.execute('''
                 SELECT u.user_id, u.username, u.full_name, ra.access_type
                 FROM room_access ra
@@ -305,91 +1412,292 @@ class Database:
                     'access_type': row[3]
                 } for row in rows]
     
-    async def get_room_customer(self, room_id: int) -> Optional[int]:
-        """Получить ID заказчика комнаты"""
-        async with aiosqlite.connect(self.db_path) as db:
-            async with db.execute('SELECT customer_id FROM rooms WHERE room_id = ?', (room_id,)) as cursor:
-                row = await cursor.fetchone()
-                return row[0] if row else None
+    async def get_room_broadcast_recipients(self, room_id: int) -> List[Dict]:
+        """Получить участников комнаты для рассылки: роль в комнате, признак админа и настройку уведомлений"""
+        recipients = self._recipients_cache.get(room_id)
+        if recipients is not None:
+            return recipients
+        generation = self._recipients_cache.begin_fill(room_id)
+        try:
+            async with self._read() as db:
+                async with db.execute('''
+                    SELECT ra.user_id, ra.access_type, u.role = 'admin' as is_admin,
+                           COALESCE(rn.enabled, 1) as notifications_enabled
+                    FROM room_access ra
+                    JOIN users u ON ra.user_id = u.user_id
+                    LEFT JOIN room_notifications rn ON rn.user_id = ra.user_id AND rn.room_id = ra.room_id
+                    WHERE ra.room_id = ?
+                ''', (room_id,)) as cursor:
+                    rows = await cursor.fetchall()
+                    recipients = [{
+                        'user_id': row[0],
+                        'access_type': row[1],
+                        'is_admin': bool(row[2]),
+                        'notifications_enabled': bool(row[3])
+                    } for row in rows]
+        finally:
+            # Отзыв доступа или смена роли за время чтения не перезаписываются старым списком
+            self._recipients_cache.end_fill(room_id, generation, recipients)
+        return recipients
+    
+    # Отложенная групповая запись сообщений
+    async def _write_behind_loop(self):
+        """Фоновая задача: сбрасывает накопленные сообщения одной транзакцией"""
+        loop = asyncio.get_running_loop()
+        max_delay = self.write_behind_max_delay
+        stopping = False
+        while not stopping:
+            item = await self._pending_writes.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = loop.time() + max_delay
+            # Набираем пакет, пока не истекло окно, не набралось BATCH_SIZE строк
+            # или кто-то не запросил немедленный сброс
+            while len(batch) < DB_WRITE_BEHIND_BATCH_SIZE and batch[-1][0] != 'flush':
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._pending_writes.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self._flush_until_written(batch)
     
-    async def save_message(self, room_id: int, sender_id: int, message_text: str, is_from_customer: bool):
-        """Сохранить сообщение в историю"""
-        async with aiosqlite.connect(self.db_path) as db:
+    async def _flush_until_written(self, batch: List[tuple]):
+        """Записать пакет, повторяя его при ошибках, не связанных с отдельными строками"""
+        attempt = 0
+        while not await self._flush_batch(batch):
+            attempt += 1
+            await asyncio.sleep(min(0.05 * 2 ** attempt, 5))
+    
+    async def _flush_batch(self, batch: List[tuple]) -> bool:
+        """Записать пакет сообщений в одной транзакции; False - пакет не записан и будет повторен.
+        
+        Если вставка пакета нарушает ограничение (например, внешний ключ на удаленную
+        комнату), пакет в той же транзакции вставляется по одной строке и отбрасываются
+        только ошибочные строки. Ждущие сброса очереди будятся после записи пакета.
+        """
+        items = [(kind, item) for kind, item in batch if kind != 'flush']
+        room_rows = [item[0] for kind, item in items if kind == 'message']
+        chat_rows = [item[0] for kind, item in items if kind == 'chat_message']
+        outbox_entries = [entry for kind, item in items for entry in item[1]]
+        # Счетчики непрочитанных по чатам, чтобы обновить каждый чат один раз
+        unread = {}
+        for chat_id, sender_id, message_text, is_from_user in chat_rows:
+            if is_from_user:
+                unread[chat_id] = unread.get(chat_id, 0) + 1
+        try:
+            if items:
+                async with self._write() as db:
+                    if not db.in_transaction:
+                        await db.execute('BEGIN')
+                    await db.execute('SAVEPOINT write_behind_batch')
+                    try:
+                        await self._insert_batch(db, room_rows, chat_rows, unread)
+                        await self._insert_outbox(db, outbox_entries)
+                    except _ROW_ERRORS as e:
+                        await db.execute('ROLLBACK TO write_behind_batch')
+                        logger.warning(f"Групповая запись {len(items)} сообщений не прошла ({e}): запись по одному")
+                        await self._insert_rows_one_by_one(db, items)
+                    await db.execute('RELEASE write_behind_batch')
+                if outbox_entries:
+                    self.outbox_ready.set()
+        except Exception as e:
+            logger.error(f"Ошибка групповой записи {len(items)} сообщений, пакет будет повторен: {e}")
+            return False
+        # Будим всех, кто ждал сброса очереди
+        for kind, waiter in batch:
+            if kind == 'flush' and not waiter.done():
+                waiter.set_result(None)
+        return True
+    
+    async def _insert_rows_one_by_one(self, db: aiosqlite.Connection, items: List[tuple]):
+        """Вставить сообщения пакета по одному; строка с ошибкой ограничения отбрасывается вместе со своим outbox"""
+        for kind, (row, outbox) in items:
+            await db.execute('SAVEPOINT write_behind_row')
+            try:
+                if kind == 'message':
+                    await self._insert_batch(db, [row], [], {})
+                else:
+                    await self._insert_batch(db, [], [row], {row[0]: 1} if row[3] else {})
+                await self._insert_outbox(db, outbox)
+            except _ROW_ERRORS as e:
+                await db.execute('ROLLBACK TO write_behind_row')
+                target = 'комнату' if kind == 'message' else 'чат'
+                logger.error(f"Сообщение от {row[1]} в {target} {row[0]} не записано и отброшено: {e}")
+            await db.execute('RELEASE write_behind_row')
+    
+    async def _insert_batch(self, db: aiosqlite.Connection, room_rows: List[tuple], chat_rows: List[tuple], unread: Dict[int, int]):
+        """Вставить пакет сообщений в рамках открытой транзакции"""
+        if room_rows:
+            await db.executemany('''
+                INSERT INTO messages (room_id, sender_id, message_text, is_from_customer)
+                VALUES (?, ?, ?, ?)
+            ''', room_rows)
+        if chat_rows:
+            await db.executemany('''
+                INSERT INTO chat_messages (chat_id, sender_id, message_text, is_from_user)
+                VALUES (?, ?, ?, ?)
+            ''', chat_rows)
+        if unread:
+            await db.executemany('''
+                UPDATE chats 
+                SET last_message_at = CURRENT_TIMESTAMP, 
+                    unread_count = unread_count + ?
+                WHERE chat_id = ?
+            ''', [(count, chat_id) for chat_id, count in unread.items()])
+    
+    async def flush_pending_writes(self):
+        """Дождаться записи всех сообщений из очереди отложенной записи"""
+        if self._pending_writes is None:
+            return
+        # Задача отложенной записи ждет соединение, которое держит единица работы
+        await self.commit_unit_of_work()
+        waiter = asyncio.get_running_loop().create_future()
+        await self._pending_writes.put(('flush', waiter))
+        await waiter
+    
+    async def _enqueue_write_behind(self, item: tuple) -> bool:
+        """Поставить сообщение в очередь отложенной записи; False - записать сразу.
+        
+        В единице работы сообщение пишется в ее транзакции: ожидание места в полной
+        очереди, пока единица держит соединение записи, заблокировало бы сброс очереди.
+        """
+        if self._pending_writes is None:
+            return False
+        unit = _current_unit.get()
+        if unit is not None and unit.active:
+            return False
+        await self._pending_writes.put(item)
+        return True
+    
+    async def _stop_write_behind(self):
+        """Остановить отложенную запись, сбросив все ожидающие сообщения"""
+        if self._write_behind_task is None:
+            return
+        pending = self._pending_writes
+        await pending.put(None)
+        await self._write_behind_task
+        self._write_behind_task = None
+        self._pending_writes = None
+        # Сообщения, поставленные в очередь после сигнала остановки, пишем напрямую
+        remaining = []
+        while not pending.empty():
+            item = pending.get_nowait()
+            if item is not None:
+                remaining.append(item)
+        if remaining:
+            await self._flush_until_written(remaining)
+    
+    async def save_message(self, room_id: int, sender_id: int, message_text: str, is_from_customer: bool,
+                           outbox: List[Tuple[int, str, Dict]] = ()):
+        """Сохранить сообщение в историю (вместе с исходящими сообщениями outbox)"""
+        outbox = list(outbox)
+        if await self._enqueue_write_behind(('message', ((room_id, sender_id, message_text, is_from_customer), outbox))):
+            return
+        async with self._write() as db:
             await db.execute('''
                 INSERT INTO messages (room_id, sender_id, message_text, is_from_customer)
                 VALUES (?, ?, ?, ?)
             ''', (room_id, sender_id, message_text, is_from_customer))
-            await db.commit()
+            await self._insert_outbox(db, outbox)
+        if outbox:
+            self.outbox_ready.set()
     
-    async def get_room_messages(self, room_id: int, limit: int = 50) -> List[Dict]:
-        """Получить историю сообщений комнаты"""
-        async with aiosqlite.connect(self.db_path) as db:
-            async with db.execute('''
-                SELECT message_id, sender_id, message_text, is_from_customer, created_at
-                FROM messages
-                WHERE room_id = ?
-                ORDER BY created_at DESC
-                LIMIT ?
-            ''', (room_id, limit)) as cursor:
-                rows = await cursor.fetchall()
-                return [{
-                    'message_id': row[0],
-                    'sender_id': row[1],
-                    'message_text': row[2],
-                    'is_from_customer': row[3],
-                    'created_at': row[4]
-                } for row in rows]
+    async def delete_room(self, room_id: int):
+        """Удалить комнату: сразу скрывается, сообщения удаляются в фоне порциями"""
+        await self.flush_pending_writes()
+        async with self._write() as db:
+            members = await self._mark_room_deleted(db, room_id)
+        self._recipients_cache.invalidate(room_id)
+        self._rooms_cache.invalidate(room_id)
+        for user_id in members:
+            self._memberships.invalidate((room_id, user_id))
+        self._purge_ready.set()
     
-    async def get_all_rooms(self) -> List[Dict]:
-        """Получить все комнаты (для администраторов)"""
-        async with aiosqlite.connect(self.db_path) as db:
-            async with db.execute('''
-                SELECT room_id, room_name, customer_id, created_by, created_at
-                FROM rooms
-                ORDER BY created_at DESC
-            ''') as cursor:
-                rows = await cursor.fetchall()
-                return [{
-                    'room_id': row[0],
-                    'room_name': row[1],
-                    'customer_id': row[2],
-                    'created_by': row[3],
-                    'created_at': row[4]
-                } for row in rows]
+    async def _mark_room_deleted(self, db: aiosqlite.Connection, room_id: int) -> List[int]:
+        """Отметить комнату удаленной и отозвать доступы в рамках уже открытой транзакции; возвращает ID бывших участников"""
+        async with db.execute('SELECT user_id FROM room_access WHERE room_id = ?', (room_id,)) as cursor:
+            members = [row[0] for row in await cursor.fetchall()]
+        await db.execute('UPDATE rooms SET deleted_at = CURRENT_TIMESTAMP WHERE room_id = ? AND deleted_at IS NULL', (room_id,))
+        # Доступы и настройки уведомлений невелики - удаляем сразу, чтобы комната пропала у участников
+        await db.execute('DELETE FROM room_access WHERE room_id = ?', (room_id,))
+        await db.execute('DELETE FROM room_notifications WHERE room_id = ?', (room_id,))
+        return members
     
-    async def delete_room(self, room_id: int):
-        """Удалить комнату и все связанные данные"""
-        async with aiosqlite.connect(self.db_path) as db:
-            # Удаляем уведомления
-            await db.execute('DELETE FROM room_notifications WHERE room_id = ?', (room_id,))
-            # Удаляем доступы к комнате
-            await db.execute('DELETE FROM room_access WHERE room_id = ?', (room_id,))
-            # Удаляем сообщения комнаты
-            await db.execute('DELETE FROM messages WHERE room_id = ?', (room_id,))
-            # Удаляем саму комнату
-            await db.execute('DELETE FROM rooms WHERE room_id = ?', (room_id,))
-            await db.commit()
+    async def purge_deleted_rooms(self, batch_size: int = 1000) -> int:
+        """Удалить порцию сообщений удаленных комнат (одна транзакция); возвращает количество удаленных строк.
+        
+        Когда сообщений комнаты не осталось, удаляется сама строка rooms,
+        остальное удаляет ON DELETE CASCADE.
+        """
+        async with self._read() as db:
+            async with db.execute('SELECT room_id FROM rooms WHERE deleted_at IS NOT NULL LIMIT 1') as cursor:
+                row = await cursor.fetchone()
+        if not row:
+            return 0
+        room_id = row[0]
+        async with self._write() as db:
+            cursor = await db.execute('''
+                DELETE FROM messages WHERE message_id IN (
+                    SELECT message_id FROM messages WHERE room_id = ? LIMIT ?
+                )
+            ''', (room_id, batch_size))
+            deleted = cursor.rowcount
+            if deleted < batch_size:
+                cursor = await db.execute('DELETE FROM rooms WHERE room_id = ? AND deleted_at IS NOT NULL', (room_id,))
+                deleted += cursor.rowcount
+                await db.execute('DELETE FROM archive.archived_messages WHERE room_id = ?', (room_id,))
+        return deleted
+    
+    async def _room_purge_loop(self):
+        """Фоновая задача: удаляет данные удаленных комнат порциями, отпуская запись между ними"""
+        while not self._purge_stopping:
+            await self._purge_ready.wait()
+            self._purge_ready.clear()
+            try:
+                # Сообщения из очереди отложенной записи не должны попасть в уже удаленную комнату
+                await self.flush_pending_writes()
+                while not self._purge_stopping and await self.purge_deleted_rooms(self.purge_batch_size):
+                    # Даем выполниться другим записям между порциями
+                    await asyncio.sleep(0)
+            except Exception as e:
+                logger.error(f"Ошибка фонового удаления комнат: {e}")
+    
+    async def _stop_room_purge(self):
+        """Остановить фоновое удаление (недоудаленное продолжится после запуска)"""
+        if self._purge_task is None:
+            return
+        self._purge_stopping = True
+        self._purge_ready.set()
+        await self._purge_task
+        self._purge_task = None
     
     async def update_room_name(self, room_id: int, new_name: str):
         """Обновить название комнаты"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._write() as db:
             await db.execute('''
                 UPDATE rooms SET room_name = ? WHERE room_id = ?
             ''', (new_name, room_id))
-            await db.commit()
+        self._rooms_cache.invalidate(room_id)
     
     async def update_user_role_in_room(self, room_id: int, user_id: int, new_role: str):
         """Изменить роль пользователя в комнате"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._write() as db:
             await db.execute('''
                 UPDATE room_access SET access_type = ? WHERE room_id = ? AND user_id = ?
             ''', (new_role, room_id, user_id))
-            await db.commit()
+        self._recipients_cache.invalidate(room_id)
     
     # Методы для работы с чатами
     async def get_or_create_chat(self, user_id: int) -> int:
         """Получить или создать чат с пользователем"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._write() as db:
             # Проверяем, есть ли чат
             async with db.execute('SELECT chat_id FROM chats WHERE user_id = ?', (user_id,)) as cursor:
                 row = await cursor.fetchone()
@@ -401,12 +1709,15 @@ class Database:
                 INSERT INTO chats (user_id, last_message_at, unread_count)
                 VALUES (?, CURRENT_TIMESTAMP, 0)
             ''', (user_id,))
-            await db.commit()
             return cursor.lastrowid
     
-    async def save_chat_message(self, chat_id: int, sender_id: int, message_text: str, is_from_user: bool):
-        """Сохранить сообщение в чат"""
-        async with aiosqlite.connect(self.db_path) as db:
+    async def save_chat_message(self, chat_id: int, sender_id: int, message_text: str, is_from_user: bool,
+                                outbox: List[Tuple[int, str, Dict]] = ()):
+        """Сохранить сообщение в чат (вместе с исходящими сообщениями outbox)"""
+        outbox = list(outbox)
+        if await self._enqueue_write_behind(('chat_message', ((chat_id, sender_id, message_text, is_from_user), outbox))):
+            return
+        async with self._write() as db:
             await db.execute('''
                 INSERT INTO chat_messages (chat_id, sender_id, message_text, is_from_user)
                 VALUES (?, ?, ?, ?)
@@ -420,57 +1731,216 @@ class Database:
                         unread_count = unread_count + 1
                     WHERE chat_id = ?
                 ''', (chat_id,))
+            await self._insert_outbox(db, outbox)
+        if outbox:
+            self.outbox_ready.set()
+    
+    async def record_user_chat_message(self, user_id: int, username: Optional[str], full_name: Optional[str],
+                                       role: str, message_text: Optional[str],
+                                       outbox: List[Tuple[int, str, Dict]] = ()) -> Dict:
+        """Записать входящее сообщение пользователя одной транзакцией.
+        
+        Обновляет профиль (как add_user), создает чат при необходимости, сохраняет
+        сообщение и счетчик непрочитанных, регистрирует заказчика (кроме
+        администраторов и разработчиков) и ставит пересылку в outbox.
+        """
+        outbox = list(outbox)
+        if message_text:
+            # Ответы администратора, ждущие в очереди отложенной записи, получают message_id раньше:
+            # курсоры истории чата опираются на порядок message_id
+            await self.flush_pending_writes()
+        plan = self._plan_user_upsert(user_id, username, full_name, role)
+        user_role = role if role != 'user' else self._roles.get(user_id, 'user')
+        is_customer = user_role not in ('admin', 'developer')
+        async with self._write() as db:
+            if plan is not None:
+                await self._upsert_user(db, user_id, username, full_name, role)
+            
+            # Создаем чат, если его еще нет
+            cursor = await db.execute('''
+                INSERT INTO chats (user_id, last_message_at, unread_count)
+                VALUES (?, CURRENT_TIMESTAMP, 0)
+                ON CONFLICT (user_id) DO NOTHING
+            ''', (user_id,))
+            is_new_chat = cursor.rowcount > 0
+            async with db.execute('SELECT chat_id FROM chats WHERE user_id = ?', (user_id,)) as cursor:
+                chat_id = (await cursor.fetchone())[0]
+            
+            if message_text:
+                await self._insert_batch(db, [], [(chat_id, user_id, message_text, True)], {chat_id: 1})
             
-            await db.commit()
+            # Заказчик: создаем запись или отмечаем время последнего обращения (пометки не трогаем)
+            if is_customer:
+                await db.execute('''
+                    INSERT INTO customers (user_id, updated_at)
+                    VALUES (?, CURRENT_TIMESTAMP)
+                    ON CONFLICT (user_id) DO UPDATE SET updated_at = CURRENT_TIMESTAMP
+                ''', (user_id,))
+            await self._insert_outbox(db, outbox)
+        
+        if plan is not None:
+            self._apply_user_upsert(user_id, role, plan)
+        if outbox:
+            self.outbox_ready.set()
+        return {
+            'chat_id': chat_id,
+            'is_new_chat': is_new_chat,
+            'role': user_role,
+            'is_customer': is_customer
+        }
     
-    async def get_all_chats(self) -> List[Dict]:
-        """Получить все чаты (для администраторов)"""
-        async with aiosqlite.connect(self.db_path) as db:
-            async with db.execute('''
-                SELECT c.chat_id, c.user_id, c.last_message_at, c.unread_count,
-                       u.username, u.full_name
-                FROM chats c
-                JOIN users u ON c.user_id = u.user_id
-                ORDER BY c.last_message_at DESC
-            ''') as cursor:
+    # История сообщений (курсор - message_id)
+    async def _message_history(self, table: str, owner_column: str, flag_column: str, owner_id: int,
+                               before_id: Optional[int], after_id: Optional[int], limit: int) -> Dict:
+        """Страница истории сообщений комнаты или чата в хронологическом порядке.
+        
+        before_id - сообщения старше указанного, after_id - новее указанного,
+        без курсора - последние сообщения. Каждая страница - один проход по
+        индексу (владелец, message_id), не больше limit + 1 строк.
+        Возвращает {'messages': сообщения, 'before': курсор на более старые или None,
+        'after': курсор на более новые или None}.
+        """
+        await self.flush_pending_writes()
+        forwards = after_id is not None
+        if forwards:
+            keyset, cursor_id, order = ' AND message_id > ?', (after_id,), 'ASC'
+        elif before_id is not None:
+            keyset, cursor_id, order = ' AND message_id < ?', (before_id,), 'DESC'
+        else:
+            keyset, cursor_id, order = '', (), 'DESC'
+        sql = f'''
+            SELECT message_id, sender_id, message_text, {flag_column}, created_at
+            FROM {table}
+            WHERE {owner_column} = ?{keyset}
+            ORDER BY message_id {order}
+            LIMIT ?
+        '''
+        async with self._read() as db:
+            async with db.execute(sql, (owner_id, *cursor_id, limit + 1)) as cursor:
                 rows = await cursor.fetchall()
-                return [{
-                    'chat_id': row[0],
-                    'user_id': row[1],
-                    'last_message_at': row[2],
-                    'unread_count': row[3],
-                    'username': row[4],
-                    'full_name': row[5]
-                } for row in rows]
+        
+        more = len(rows) > limit
+        rows = rows[:limit]
+        if forwards:
+            has_before, has_after = True, more
+        else:
+            rows.reverse()
+            has_before, has_after = more, before_id is not None
+        return {
+            'messages': [{
+                'message_id': row[0],
+                'sender_id': row[1],
+                'message_text': row[2],
+                flag_column: row[3],
+                'created_at': row[4]
+            } for row in rows],
+            'before': rows[0][0] if rows and has_before else None,
+            'after': rows[-1][0] if rows and has_after else None
+        }
     
-    async def get_chat_messages(self, chat_id: int, limit: int = 50) -> List[Dict]:
-        """Получить сообщения чата"""
-        async with aiosqlite.connect(self.db_path) as db:
-            async with db.execute('''
-                SELECT message_id, sender_id, message_text, is_from_user, created_at
-                FROM chat_messages
-                WHERE chat_id = ?
-                ORDER BY created_at DESC
-                LIMIT ?
-            ''', (chat_id, limit)) as cursor:
+    async def get_room_history(self, room_id: int, before_id: Optional[int] = None,
+                               after_id: Optional[int] = None, limit: int = HISTORY_PAGE_SIZE) -> Dict:
+        """Страница истории комнаты (старые сообщения первыми); курсоры - message_id"""
+        return await self._message_history('messages', 'room_id', 'is_from_customer', room_id, before_id, after_id, limit)
+    
+    async def get_chat_history(self, chat_id: int, before_id: Optional[int] = None,
+                               after_id: Optional[int] = None, limit: int = HISTORY_PAGE_SIZE) -> Dict:
+        """Страница истории чата (старые сообщения первыми); курсоры - message_id"""
+        return await self._message_history('chat_messages', 'chat_id', 'is_from_user', chat_id, before_id, after_id, limit)
+    
+    # Полнотекстовый поиск по сообщениям
+    async def _fts_window_start(self, db: aiosqlite.Connection, fts_table: str, source: str,
+                                params: tuple) -> Tuple[int, bool]:
+        """Наименьший rowid среди SEARCH_RANK_WINDOW самых новых совпадений в source (0, если совпадений меньше)
+        и признак того, что более старые совпадения в окно не вошли.
+        
+        source - FROM ... WHERE поиска вместе с ограничениями по комнатам, чтобы окно
+        считалось только по сообщениям, которые поиск может вернуть.
+        """
+        async with db.execute(
+            f'SELECT {fts_table}.rowid {source} ORDER BY {fts_table}.rowid DESC LIMIT 2 OFFSET ?',
+            (*params, SEARCH_RANK_WINDOW - 1)
+        ) as cursor:
+            rows = await cursor.fetchall()
+        return (rows[0][0] if rows else 0), len(rows) > 1
+    
+    async def search_messages(self, match: str, member_id: Optional[int] = None, include_chats: bool = False,
+                              limit: int = LIST_PAGE_SIZE, offset: int = 0) -> Dict:
+        """Найти сообщения по запросу FTS5 (лучшие совпадения первыми).
+        
+        member_id - искать только в комнатах, где у пользователя есть доступ
+        (None - во всех комнатах); include_chats - искать и в чатах с пользователями.
+        В snippet совпадения обрамлены символами SEARCH_MARK_START и SEARCH_MARK_END.
+        Ранжируются не больше SEARCH_RANK_WINDOW самых новых доступных совпадений в каждой таблице:
+        стоимость bm25 растет с числом совпадений, а для частых слов важнее свежие сообщения.
+        Переписка, перенесенная в архив (закрытые заказы), в поиск не входит.
+        Возвращает {'items': найденные сообщения, 'has_more': есть ли следующая страница,
+        'truncated': есть ли более старые совпадения за пределами окна}.
+        """
+        await self.flush_pending_writes()
+        room_source = '''
+                FROM messages_fts
+                JOIN messages m ON m.message_id = messages_fts.rowid
+                JOIN rooms r ON r.room_id = m.room_id
+                WHERE messages_fts MATCH ? AND r.deleted_at IS NULL
+        '''
+        room_params = (match,)
+        if member_id is not None:
+            room_source += ' AND m.room_id IN (SELECT room_id FROM room_access WHERE user_id = ?)'
+            room_params += (member_id,)
+        chat_source = '''
+                FROM chat_messages_fts
+                JOIN chat_messages cm ON cm.message_id = chat_messages_fts.rowid
+                JOIN chats c ON c.chat_id = cm.chat_id
+                LEFT JOIN users u ON u.user_id = c.user_id
+                WHERE chat_messages_fts MATCH ?
+        '''
+        async with self._read() as db:
+            min_room_message, truncated = await self._fts_window_start(db, 'messages_fts', room_source, room_params)
+            sql = f'''
+                SELECT 'room', m.message_id, m.room_id, r.room_name, m.sender_id, m.created_at,
+                       snippet(messages_fts, 0, ?, ?, '…', 16), bm25(messages_fts) AS rank
+                {room_source} AND messages_fts.rowid >= ?
+            '''
+            params = (SEARCH_MARK_START, SEARCH_MARK_END, *room_params, min_room_message)
+            if include_chats:
+                min_chat_message, chats_truncated = await self._fts_window_start(
+                    db, 'chat_messages_fts', chat_source, (match,)
+                )
+                truncated = truncated or chats_truncated
+                sql += f'''
+                UNION ALL
+                SELECT 'chat', cm.message_id, cm.chat_id, COALESCE(u.full_name, u.username), cm.sender_id, cm.created_at,
+                       snippet(chat_messages_fts, 0, ?, ?, '…', 16), bm25(chat_messages_fts) AS rank
+                {chat_source} AND chat_messages_fts.rowid >= ?
+                '''
+                params += (SEARCH_MARK_START, SEARCH_MARK_END, match, min_chat_message)
+            sql += ' ORDER BY rank LIMIT ? OFFSET ?'
+            async with db.execute(sql, (*params, limit + 1, offset)) as cursor:
                 rows = await cursor.fetchall()
-                return [{
-                    'message_id': row[0],
-                    'sender_id': row[1],
-                    'message_text': row[2],
-                    'is_from_user': row[3],
-                    'created_at': row[4]
-                } for row in rows]
+        return {
+            'items': [{
+                'source': row[0],
+                'message_id': row[1],
+                'owner_id': row[2],
+                'title': row[3],
+                'sender_id': row[4],
+                'created_at': row[5],
+                'snippet': row[6]
+            } for row in rows[:limit]],
+            'has_more': len(rows) > limit,
+            'truncated': truncated
+        }
     
     async def mark_chat_as_read(self, chat_id: int):
         """Отметить чат как прочитанный"""
-        async with aiosqlite.connect(self.db_path) as db:
+        await self.flush_pending_writes()
+        async with self._write() as db:
             await db.execute('UPDATE chats SET unread_count = 0 WHERE chat_id = ?', (chat_id,))
-            await db.commit()
     
     async def get_chat_by_user_id(self, user_id: int) -> Optional[Dict]:
         """Получить чат по ID пользователя"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._read() as db:
             async with db.execute('''
                 SELECT chat_id, user_id, last_message_at, unread_count
                 FROM chats WHERE user_id = ?
@@ -487,7 +1957,8 @@ class Database:
     
     async def get_chat_by_chat_id(self, chat_id: int) -> Optional[Dict]:
         """Получить чат по ID чата"""
-        async with aiosqlite.connect(self.db_path) as db:
+        await self.flush_pending_writes()
+        async with self._read() as db:
             async with db.execute('''
                 SELECT chat_id, user_id, last_message_at, unread_count
                 FROM chats WHERE chat_id = ?
@@ -505,32 +1976,29 @@ class Database:
     # Методы для работы с заказчиками
     async def add_or_update_customer(self, user_id: int, notes: str = None):
         """Добавить или обновить заказчика с пометками"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._write() as db:
             await db.execute('''
                 INSERT OR REPLACE INTO customers (user_id, notes, updated_at)
                 VALUES (?, ?, CURRENT_TIMESTAMP)
             ''', (user_id, notes))
-            await db.commit()
     
     async def update_customer_notes(self, user_id: int, notes: str):
         """Обновить пометки о заказчике"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._write() as db:
             await db.execute('''
                 UPDATE customers 
                 SET notes = ?, updated_at = CURRENT_TIMESTAMP
                 WHERE user_id = ?
             ''', (notes, user_id))
-            await db.commit()
     
     async def remove_customer(self, user_id: int):
         """Удалить пользователя из базы заказчиков"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._write() as db:
             await db.execute('DELETE FROM customers WHERE user_id = ?', (user_id,))
-            await db.commit()
     
     async def get_customer_info(self, user_id: int) -> Optional[Dict]:
         """Получить информацию о заказчике"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._read() as db:
             async with db.execute('''
                 SELECT customer_id, user_id, notes, status, created_at, updated_at
                 FROM customers WHERE user_id = ?
@@ -547,49 +2015,19 @@ class Database:
                     }
                 return None
     
-    async def get_all_customers(self) -> List[Dict]:
-        """Получить всех заказчиков с пометками (исключая админов и разработчиков)"""
-        async with aiosqlite.connect(self.db_path) as db:
-            # Получаем всех пользователей из таблицы customers, исключая админов и разработчиков
-            async with db.execute('''
-                SELECT u.user_id, u.username, u.full_name, u.created_at, u.role,
-                       c.customer_id, c.notes, c.status, c.created_at as customer_created_at, c.updated_at
-                FROM customers c
-                JOIN users u ON c.user_id = u.user_id
-                WHERE u.role != 'admin' AND u.role != 'developer'
-                ORDER BY COALESCE(c.updated_at, u.created_at) DESC
-            ''') as cursor:
-                rows = await cursor.fetchall()
-                result = []
-                for row in rows:
-                    # row[0] = user_id, row[1] = username, row[2] = full_name, row[3] = created_at, row[4] = role
-                    # row[5] = customer_id, row[6] = notes, row[7] = status, row[8] = customer_created_at, row[9] = updated_at
-                    result.append({
-                        'customer_id': row[5],
-                        'user_id': row[0],
-                        'notes': row[6],
-                        'status': row[7] if row[7] else 'new',
-                        'created_at': row[8] if row[8] else row[3],
-                        'updated_at': row[9] if row[9] else row[3],
-                        'username': row[1],
-                        'full_name': row[2],
-                        'role': row[4]
-                    })
-                return result
-    
     # Методы для работы с уведомлениями
     async def set_room_notification(self, user_id: int, room_id: int, enabled: bool):
         """Установить настройку уведомлений для пользователя в комнате"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._write() as db:
             await db.execute('''
                 INSERT OR REPLACE INTO room_notifications (user_id, room_id, enabled)
                 VALUES (?, ?, ?)
             ''', (user_id, room_id, 1 if enabled else 0))
-            await db.commit()
+        self._recipients_cache.invalidate(room_id)
     
     async def get_room_notification(self, user_id: int, room_id: int) -> bool:
         """Получить настройку уведомлений для пользователя в комнате (по умолчанию True)"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._read() as db:
             async with db.execute('''
                 SELECT enabled FROM room_notifications 
                 WHERE user_id = ? AND room_id = ?
@@ -602,12 +2040,13 @@ class Database:
     
     async def get_user_notification_rooms(self, user_id: int) -> List[Dict]:
         """Получить все комнаты с настройками уведомлений для пользователя"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._read() as db:
             async with db.execute('''
                 SELECT r.room_id, r.room_name, r.customer_id,
                        COALESCE(rn.enabled, 1) as enabled
                 FROM rooms r
                 LEFT JOIN room_notifications rn ON r.room_id = rn.room_id AND rn.user_id = ?
+                WHERE r.deleted_at IS NULL
                 ORDER BY r.created_at DESC
             ''', (user_id,)) as cursor:
                 rows = await cursor.fetchall()
@@ -618,31 +2057,10 @@ class Database:
                     'enabled': bool(row[3])
                 } for row in rows]
     
-    async def get_room_users_with_notifications(self, room_id: int, exclude_user_id: int = None) -> List[int]:
-        """Получить список пользователей, которым нужно отправить уведомление о новом сообщении в комнате"""
-        async with aiosqlite.connect(self.db_path) as db:
-            # Получаем всех пользователей с доступом к комнате, у которых включены уведомления
-            query = '''
-                SELECT DISTINCT ra.user_id
-                FROM room_access ra
-                LEFT JOIN room_notifications rn ON ra.room_id = rn.room_id AND ra.user_id = rn.user_id
-                WHERE ra.room_id = ? 
-                AND (rn.enabled IS NULL OR rn.enabled = 1)
-            '''
-            params = [room_id]
-            
-            if exclude_user_id:
-                query += ' AND ra.user_id != ?'
-                params.append(exclude_user_id)
-            
-            async with db.execute(query, params) as cursor:
-                rows = await cursor.fetchall()
-                return [row[0] for row in rows]
-    
     # Методы для работы с ролями пользователей
     async def get_users_by_role(self, role: str) -> List[Dict]:
         """Получить всех пользователей с определенной ролью"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._read() as db:
             async with db.execute('''
                 SELECT user_id, username, full_name, role, created_at
                 FROM users
@@ -660,86 +2078,42 @@ class Database:
     
     async def update_user_role(self, user_id: int, new_role: str):
         """Изменить роль пользователя"""
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute('''
+        async with self._write() as db:
+            cursor = await db.execute('''
                 UPDATE users SET role = ? WHERE user_id = ?
             ''', (new_role, user_id))
-            await db.commit()
-    
-    async def get_all_users(self) -> List[Dict]:
-        """Получить всех пользователей"""
-        async with aiosqlite.connect(self.db_path) as db:
-            async with db.execute('''
-                SELECT user_id, username, full_name, role, created_at
-                FROM users
-                ORDER BY created_at DESC
-            ''') as cursor:
-                rows = await cursor.fetchall()
-                return [{
-                    'user_id': row[0],
-                    'username': row[1],
-                    'full_name': row[2],
-                    'role': row[3],
-                    'created_at': row[4]
-                } for row in rows]
+            updated = cursor.rowcount > 0
+        if updated:
+            self._cache_role(user_id, new_role)
+        self._recipients_cache.clear()
     
     # Методы для работы с отзывами
     async def add_review(self, user_id: int, room_id: int, review_text: str) -> int:
         """Добавить отзыв"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._write() as db:
             cursor = await db.execute('''
                 INSERT INTO reviews (user_id, room_id, review_text)
                 VALUES (?, ?, ?)
             ''', (user_id, room_id, review_text))
-            await db.commit()
             return cursor.lastrowid
     
-    async def get_all_reviews(self) -> List[Dict]:
-        """Получить все отзывы"""
-        async with aiosqlite.connect(self.db_path) as db:
-            async with db.execute('''
-                SELECT r.review_id, r.user_id, r.room_id, r.review_text, r.admin_reply,
-                       r.created_at, r.updated_at,
-                       u.username, u.full_name,
-                       rm.room_name
-                FROM reviews r
-                JOIN users u ON r.user_id = u.user_id
-                LEFT JOIN rooms rm ON r.room_id = rm.room_id
-                ORDER BY r.created_at DESC
-            ''') as cursor:
-                rows = await cursor.fetchall()
-                return [{
-                    'review_id': row[0],
-                    'user_id': row[1],
-                    'room_id': row[2],
-                    'review_text': row[3],
-                    'admin_reply': row[4],
-                    'created_at': row[5],
-                    'updated_at': row[6],
-                    'username': row[7],
-                    'full_name': row[8],
-                    'room_name': row[9]
-                } for row in rows]
-    
     async def add_admin_reply(self, review_id: int, reply_text: str):
         """Добавить ответ администратора на отзыв"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._write() as db:
             await db.execute('''
                 UPDATE reviews 
                 SET admin_reply = ?, updated_at = CURRENT_TIMESTAMP
                 WHERE review_id = ?
             ''', (reply_text, review_id))
-            await db.commit()
     
     async def delete_review(self, review_id: int):
         """Удалить отзыв"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._write() as db:
             await db.execute('DELETE FROM reviews WHERE review_id = ?', (review_id,))
-            await db.commit()
     
     async def get_review(self, review_id: int) -> Optional[Dict]:
         """Получить отзыв по ID"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._read() as db:
             async with db.execute('''
                 SELECT review_id, user_id, room_id, review_text, admin_reply, created_at, updated_at
                 FROM reviews WHERE review_id = ?
@@ -758,9 +2132,10 @@ class Database:
                 return None
     
     # Методы для работы с историей заказов
-    async def add_to_order_history(self, room_id: int, closed_by: int):
-        """Добавить комнату в историю заказов"""
-        async with aiosqlite.connect(self.db_path) as db:
+    async def add_to_order_history(self, room_id: int, closed_by: int, outbox: List[Tuple[int, str, Dict]] = ()):
+        """Добавить комнату в историю заказов (вместе с уведомлениями участникам через outbox)"""
+        outbox = list(outbox)
+        async with self._write() as db:
             # Получаем информацию о комнате
             async with db.execute('''
                 SELECT room_name, customer_id, created_by, created_at
@@ -773,48 +2148,38 @@ class Database:
                         VALUES (?, ?, ?, ?, ?, ?)
                     ''', (room_id, row[0], row[1], row[2], closed_by, row[3]))
                     # Обновляем статус комнаты
-                    try:
-                        await db.execute('UPDATE rooms SET status = "closed" WHERE room_id = ?', (room_id,))
-                    except:
-                        pass  # Поле status может не существовать
-                    await db.commit()
-    
-    async def get_order_history(self) -> List[Dict]:
-        """Получить историю заказов"""
-        async with aiosqlite.connect(self.db_path) as db:
-            async with db.execute('''
-                SELECT h.history_id, h.room_id, h.room_name, h.customer_id, h.created_by, h.closed_by,
-                       h.closed_at, h.room_created_at,
-                       u1.username as customer_username, u1.full_name as customer_name,
-                       u2.username as creator_username, u2.full_name as creator_name,
-                       u3.username as closer_username, u3.full_name as closer_name
-                FROM order_history h
-                LEFT JOIN users u1 ON h.customer_id = u1.user_id
-                LEFT JOIN users u2 ON h.created_by = u2.user_id
-                LEFT JOIN users u3 ON h.closed_by = u3.user_id
-                ORDER BY h.closed_at DESC
-            ''') as cursor:
-                rows = await cursor.fetchall()
-                return [{
-                    'history_id': row[0],
-                    'room_id': row[1],
-                    'room_name': row[2],
-                    'customer_id': row[3],
-                    'created_by': row[4],
-                    'closed_by': row[5],
-                    'closed_at': row[6],
-                    'room_created_at': row[7],
-                    'customer_username': row[8],
-                    'customer_name': row[9],
-                    'creator_username': row[10],
-                    'creator_name': row[11],
-                    'closer_username': row[12],
-                    'closer_name': row[13]
-                } for row in rows]
+                    await db.execute("UPDATE rooms SET status = 'closed' WHERE room_id = ?", (room_id,))
+            await self._insert_outbox(db, outbox)
+        self._rooms_cache.invalidate(room_id)
+        if outbox:
+            self.outbox_ready.set()
+    
+    async def get_order_history_entry(self, history_id: int) -> Optional[Dict]:
+        """Получить один заказ из истории"""
+        async with self._read() as db:
+            async with db.execute(ORDER_HISTORY_SELECT + ' WHERE h.history_id = ?', (history_id,)) as cursor:
+                row = await cursor.fetchone()
+                return _order_history_row(row) if row else None
+    
+    async def get_order_history_by_room(self, room_id: int) -> Optional[Dict]:
+        """Получить последнюю запись истории по комнате"""
+        async with self._read() as db:
+            async with db.execute(
+                ORDER_HISTORY_SELECT + ' WHERE h.room_id = ? ORDER BY h.history_id DESC LIMIT 1', (room_id,)
+            ) as cursor:
+                row = await cursor.fetchone()
+                return _order_history_row(row) if row else None
+    
+    async def is_room_in_order_history(self, room_id: int) -> bool:
+        """Проверить, перемещена ли комната в историю заказов"""
+        async with self._read() as db:
+            async with db.execute('SELECT 1 FROM order_history WHERE room_id = ? LIMIT 1', (room_id,)) as cursor:
+                return await cursor.fetchone() is not None
     
     async def delete_from_order_history(self, history_id: int):
         """Окончательно удалить заказ из истории"""
-        async with aiosqlite.connect(self.db_path) as db:
+        await self.flush_pending_writes()
+        async with self._write() as db:
             # Получаем room_id перед удалением
             async with db.execute('SELECT room_id FROM order_history WHERE history_id = ?', (history_id,)) as cursor:
                 row = await cursor.fetchone()
@@ -823,25 +2188,145 @@ class Database:
             # Удаляем из истории
             await db.execute('DELETE FROM order_history WHERE history_id = ?', (history_id,))
             
-            # Если комната еще существует, окончательно удаляем её
-            if room_id:
-                await self.delete_room(room_id)
-            
-            await db.commit()
+            # Если комната еще существует, удаляем её (в той же транзакции; сообщения - в фоне)
+            members = await self._mark_room_deleted(db, room_id) if room_id else []
+        if room_id:
+            self._recipients_cache.invalidate(room_id)
+            self._rooms_cache.invalidate(room_id)
+            for user_id in members:
+                self._memberships.invalidate((room_id, user_id))
+            self._purge_ready.set()
     
-    async def get_room_status(self, room_id: int) -> str:
-        """Получить статус комнаты"""
-        async with aiosqlite.connect(self.db_path) as db:
-            try:
-                async with db.execute('SELECT status FROM rooms WHERE room_id = ?', (room_id,)) as cursor:
-                    row = await cursor.fetchone()
-                    return row[0] if row else 'active'
-            except:
-                return 'active'  # Если поле status не существует
+    # Архив переписки закрытых заказов
+    async def get_rooms_to_archive(self, closed_before: float) -> List[int]:
+        """Закрытые комнаты, закрытые раньше указанного времени, у которых остались сообщения в основной базе"""
+        async with self._read() as db:
+            async with db.execute('''
+                SELECT r.room_id FROM rooms r
+                WHERE r.status = 'closed' AND r.deleted_at IS NULL
+                  AND EXISTS (SELECT 1 FROM order_history h WHERE h.room_id = r.room_id AND h.closed_at <= datetime(?, 'unixepoch'))
+                  AND EXISTS (SELECT 1 FROM messages m WHERE m.room_id = r.room_id)
+            ''', (closed_before,)) as cursor:
+                return [row[0] for row in await cursor.fetchall()]
+    
+    async def archive_room_messages(self, room_id: int, chunk_size: int = 200) -> Dict:
+        """Перенести сообщения комнаты в архив порциями по chunk_size.
+        
+        Порция сначала фиксируется в архиве, затем отдельной транзакцией удаляется
+        из основной базы: в режиме WAL транзакция над двумя файлами не атомарна.
+        Сбой между ними оставляет в основной базе копии, которые при повторном
+        переносе (message_id <= последнего заархивированного) только удаляются.
+        Возвращает {'messages': перенесено, 'raw_bytes': размер JSON, 'stored_bytes': размер в архиве}.
+        """
+        await self.flush_pending_writes()
+        stats = {'messages': 0, 'raw_bytes': 0, 'stored_bytes': 0}
+        async with self._read() as db:
+            async with db.execute(
+                'SELECT COALESCE(MAX(last_message_id), 0) FROM archive.archived_messages WHERE room_id = ?', (room_id,)
+            ) as cursor:
+                archived_upto = (await cursor.fetchone())[0]
+        if archived_upto:
+            # Остатки прерванного переноса
+            async with self._write() as db:
+                await db.execute('DELETE FROM messages WHERE room_id = ? AND message_id <= ?', (room_id, archived_upto))
+        
+        while True:
+            async with self._read() as db:
+                async with db.execute('''
+                    SELECT message_id, sender_id, message_text, is_from_customer, created_at
+                    FROM messages WHERE room_id = ? AND message_id > ?
+                    ORDER BY message_id LIMIT ?
+                ''', (room_id, archived_upto, chunk_size)) as cursor:
+                    rows = await cursor.fetchall()
+            if not rows:
+                return stats
+            raw = json.dumps(rows, ensure_ascii=False).encode()
+            payload = zlib.compress(raw, 6)
+            first_id, last_id = rows[0][0], rows[-1][0]
+            async with self._write() as db:
+                await db.execute('''
+                    INSERT INTO archive.archived_messages (room_id, first_message_id, last_message_id, message_count, payload)
+                    VALUES (?, ?, ?, ?, ?)
+                ''', (room_id, first_id, last_id, len(rows), payload))
+            # Удаляем из основной базы только после фиксации порции в архиве
+            await self.commit_unit_of_work()
+            async with self._write() as db:
+                await db.execute(
+                    'DELETE FROM messages WHERE room_id = ? AND message_id BETWEEN ? AND ?', (room_id, first_id, last_id)
+                )
+            archived_upto = last_id
+            stats['messages'] += len(rows)
+            stats['raw_bytes'] += len(raw)
+            stats['stored_bytes'] += len(payload)
+            # Даем выполниться другим записям между порциями
+            await asyncio.sleep(0)
+    
+    async def get_room_archive_info(self, room_id: int) -> Optional[Dict]:
+        """Сводка архива комнаты: количество сообщений и порций (None, если архива нет)"""
+        async with self._read() as db:
+            async with db.execute('''
+                SELECT COUNT(*), SUM(message_count), MIN(archived_at), SUM(LENGTH(payload))
+                FROM archive.archived_messages WHERE room_id = ?
+            ''', (room_id,)) as cursor:
+                row = await cursor.fetchone()
+        if not row[0]:
+            return None
+        return {'chunks': row[0], 'message_count': row[1], 'archived_at': row[2], 'stored_bytes': row[3]}
+    
+    async def get_archived_room_history(self, room_id: int, before_id: Optional[int] = None,
+                                        after_id: Optional[int] = None, limit: int = HISTORY_PAGE_SIZE) -> Dict:
+        """Страница архивной переписки комнаты (тот же формат, что у get_room_history).
+        
+        Читаются и распаковываются только порции, соседние с курсором.
+        """
+        forwards = after_id is not None
+        if forwards:
+            sql = '''
+                SELECT payload FROM archive.archived_messages
+                WHERE room_id = ? AND last_message_id > ? ORDER BY last_message_id
+            '''
+            params = (room_id, after_id)
+        else:
+            sql = '''
+                SELECT payload FROM archive.archived_messages
+                WHERE room_id = ? AND first_message_id < ? ORDER BY last_message_id DESC
+            '''
+            params = (room_id, before_id if before_id is not None else 2 ** 63 - 1)
+        
+        rows = []
+        async with self._read() as db:
+            async with db.execute(sql, params) as cursor:
+                async for (payload,) in cursor:
+                    chunk = json.loads(zlib.decompress(payload))
+                    if forwards:
+                        rows.extend(row for row in chunk if row[0] > after_id)
+                    else:
+                        rows.extend(row for row in reversed(chunk) if before_id is None or row[0] < before_id)
+                    if len(rows) > limit:
+                        break
+        
+        more = len(rows) > limit
+        rows = rows[:limit]
+        if forwards:
+            has_before, has_after = True, more
+        else:
+            rows.reverse()
+            has_before, has_after = more, before_id is not None
+        return {
+            'messages': [{
+                'message_id': row[0],
+                'sender_id': row[1],
+                'message_text': row[2],
+                'is_from_customer': row[3],
+                'created_at': row[4]
+            } for row in rows],
+            'before': rows[0][0] if rows and has_before else None,
+            'after': rows[-1][0] if rows and has_after else None
+        }
     
     async def get_customer_closed_orders(self, customer_id: int) -> List[Dict]:
         """Получить закрытые заказы клиента (где он был клиентом)"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._read() as db:
             # Получаем закрытые заказы, где пользователь был клиентом
             async with db.execute('''
                 SELECT DISTINCT h.history_id, h.room_id, h.room_name, h.closed_at,
@@ -859,4 +2344,282 @@ class Database:
                     'closed_at': row[3],
                     'has_review': row[4]
                 } for row in rows]
-
+    
+    # Методы для работы с исходящими сообщениями (outbox)
+    async def _insert_outbox(self, db: aiosqlite.Connection, entries: List[Tuple[int, str, Dict]]):
+        """Поставить исходящие сообщения (chat_id, метод, параметры) в outbox в рамках открытой транзакции"""
+        if not entries:
+            return
+        now = time.time()
+        await db.executemany('''
+            INSERT INTO outbox (chat_id, method, params, next_attempt_at)
+            VALUES (?, ?, ?, ?)
+        ''', [(chat_id, method, json.dumps(params, ensure_ascii=False), now) for chat_id, method, params in entries])
+    
+    async def enqueue_outbox(self, entries: List[Tuple[int, str, Dict]]):
+        """Поставить исходящие сообщения в outbox отдельной транзакцией"""
+        entries = list(entries)
+        if not entries:
+            return
+        async with self._write() as db:
+            await self._insert_outbox(db, entries)
+        self.outbox_ready.set()
+    
+    async def get_due_outbox(self, limit: int = 100) -> List[Dict]:
+        """Получить исходящие сообщения, готовые к отправке.
+        
+        Сообщение не выдается, пока в том же чате есть более раннее неотправленное
+        сообщение, ожидающее повтора, - так сохраняется порядок доставки.
+        """
+        now = time.time()
+        async with self._read() as db:
+            async with db.execute('''
+                SELECT o.id, o.chat_id, o.method, o.params, o.attempts
+                FROM outbox o
+                WHERE o.status = 'pending' AND o.next_attempt_at <= ?
+                  AND NOT EXISTS (
+                      SELECT 1 FROM outbox p
+                      WHERE p.chat_id = o.chat_id AND p.status = 'pending'
+                        AND p.id < o.id AND p.next_attempt_at > ?
+                  )
+                ORDER BY o.id
+                LIMIT ?
+            ''', (now, now, limit)) as cursor:
+                rows = await cursor.fetchall()
+                return [{
+                    'id': row[0],
+                    'chat_id': row[1],
+                    'method': row[2],
+                    'params': json.loads(row[3]),
+                    'attempts': row[4]
+                } for row in rows]
+    
+    async def mark_outbox_sent(self, outbox_ids: List[int]):
+        """Отметить исходящие сообщения как доставленные"""
+        if not outbox_ids:
+            return
+        async with self._write() as db:
+            await db.executemany(
+                "UPDATE outbox SET status = 'sent', attempts = attempts + 1 WHERE id = ?",
+                [(outbox_id,) for outbox_id in outbox_ids]
+            )
+    
+    async def reschedule_outbox(self, retries: List[Tuple[int, float, str]]):
+        """Назначить повторную отправку: список (id, задержка в секундах, ошибка)"""
+        if not retries:
+            return
+        now = time.time()
+        async with self._write() as db:
+            await db.executemany('''
+                UPDATE outbox
+                SET attempts = attempts + 1, next_attempt_at = ?, last_error = ?
+                WHERE id = ?
+            ''', [(now + delay, error, outbox_id) for outbox_id, delay, error in retries])
+    
+    async def mark_outbox_failed(self, failures: List[Tuple[int, str]]):
+        """Отметить исходящие сообщения как недоставляемые: список (id, ошибка)"""
+        if not failures:
+            return
+        async with self._write() as db:
+            await db.executemany(
+                "UPDATE outbox SET status = 'failed', attempts = attempts + 1, last_error = ? WHERE id = ?",
+                [(error, outbox_id) for outbox_id, error in failures]
+            )
+    
+    async def compact_outbox(self, batch_size: int = 500, failed_before: Optional[float] = None) -> int:
+        """Удалить порцию доставленных и недоставляемых (созданных до failed_before) сообщений; возвращает количество удаленных"""
+        async with self._write() as db:
+            cursor = await db.execute('''
+                DELETE FROM outbox WHERE id IN (
+                    SELECT id FROM outbox WHERE status = 'sent'
+                    UNION ALL
+                    SELECT id FROM outbox WHERE status = 'failed' AND created_at <= datetime(?, 'unixepoch')
+                    LIMIT ?
+                )
+            ''', (failed_before, batch_size))
+            return cursor.rowcount
+    
+    # Методы для работы с состоянием сессий
+    async def load_session_state(self, updated_after: float) -> List[Tuple[str, int, str, float]]:
+        """Загрузить все свежие записи состояния одним запросом: (scope, user_id, value JSON, updated_at)"""
+        async with self._read() as db:
+            async with db.execute(
+                'SELECT scope, user_id, value, updated_at FROM session_state WHERE updated_at >= ?',
+                (updated_after,)
+            ) as cursor:
+                return await cursor.fetchall()
+    
+    async def save_session_state(self, upserts: List[Tuple[str, int, str, float]], deletes: List[Tuple[str, int]]):
+        """Записать изменения состояния одной транзакцией: upserts - (scope, user_id, value JSON, updated_at)"""
+        if not upserts and not deletes:
+            return
+        async with self._write() as db:
+            if upserts:
+                await db.executemany('''
+                    INSERT INTO session_state (scope, user_id, value, updated_at)
+                    VALUES (?, ?, ?, ?)
+                    ON CONFLICT (scope, user_id) DO UPDATE SET
+                        value = excluded.value,
+                        updated_at = excluded.updated_at
+                ''', upserts)
+            if deletes:
+                await db.executemany('DELETE FROM session_state WHERE scope = ? AND user_id = ?', deletes)
+    
+    async def expire_session_state(self, updated_before: float) -> int:
+        """Удалить записи состояния, к которым не обращались с указанного времени"""
+        async with self._write() as db:
+            cursor = await db.execute('DELETE FROM session_state WHERE updated_at < ?', (updated_before,))
+            return cursor.rowcount
+    
+    # Постраничные списки (keyset-пагинация)
+    async def _keyset_page(self, columns: str, from_sql: str, key_sql: str, id_sql: str,
+                           cursor: Optional[Tuple[str, int, int]], limit: int,
+                           where_sql: str = '1', params: tuple = ()) -> Dict:
+        """Страница списка, отсортированного по (время, id) по убыванию.
+        
+        cursor - None (первая страница) или ('next'|'prev', время в unix-секундах, id)
+        из полей next/prev предыдущей страницы. Запрос читает не больше limit + 1
+        строк, независимо от размера таблицы.
+        Возвращает {'rows': строки, 'next': курсор или None, 'prev': курсор или None}.
+        """
+        backwards = cursor is not None and cursor[0] == 'prev'
+        keyset = ''
+        keyset_params = ()
+        if cursor is not None:
+            keyset = f" AND ({key_sql}, {id_sql}) {'>' if backwards else '<'} (datetime(?, 'unixepoch'), ?)"
+            keyset_params = (cursor[1], cursor[2])
+        order = 'ASC' if backwards else 'DESC'
+        sql = f'''
+            SELECT {columns}, CAST(strftime('%s', {key_sql}) AS INTEGER), {id_sql}
+            FROM {from_sql}
+            WHERE {where_sql}{keyset}
+            ORDER BY {key_sql} {order}, {id_sql} {order}
+            LIMIT ?
+        '''
+        async with self._read() as db:
+            async with db.execute(sql, (*params, *keyset_params, limit + 1)) as db_cursor:
+                rows = await db_cursor.fetchall()
+        
+        more = len(rows) > limit
+        rows = rows[:limit]
+        if backwards:
+            rows.reverse()
+            has_prev, has_next = more, True
+        else:
+            has_prev, has_next = cursor is not None, more
+        return {
+            'rows': [row[:-2] for row in rows],
+            'next': ('next', rows[-1][-2], rows[-1][-1]) if rows and has_next else None,
+            'prev': ('prev', rows[0][-2], rows[0][-1]) if rows and has_prev else None
+        }
+    
+    async def get_rooms_page(self, cursor: Optional[Tuple[str, int, int]] = None, limit: int = LIST_PAGE_SIZE) -> Dict:
+        """Страница всех комнат (новые первыми)"""
+        page = await self._keyset_page(
+            'room_id, room_name, customer_id, created_by, created_at', 'rooms',
+            'created_at', 'room_id', cursor, limit, 'deleted_at IS NULL'
+        )
+        page['items'] = [{
+            'room_id': row[0],
+            'room_name': row[1],
+            'customer_id': row[2],
+            'created_by': row[3],
+            'created_at': row[4]
+        } for row in page.pop('rows')]
+        return page
+    
+    async def get_chats_page(self, cursor: Optional[Tuple[str, int, int]] = None, limit: int = LIST_PAGE_SIZE) -> Dict:
+        """Страница чатов (с последним сообщением первыми)"""
+        await self.flush_pending_writes()
+        page = await self._keyset_page(
+            'c.chat_id, c.user_id, c.last_message_at, c.unread_count, u.username, u.full_name',
+            'chats c JOIN users u ON c.user_id = u.user_id',
+            'c.last_message_at', 'c.chat_id', cursor, limit
+        )
+        page['items'] = [{
+            'chat_id': row[0],
+            'user_id': row[1],
+            'last_message_at': row[2],
+            'unread_count': row[3],
+            'username': row[4],
+            'full_name': row[5]
+        } for row in page.pop('rows')]
+        return page
+    
+    async def get_customers_page(self, cursor: Optional[Tuple[str, int, int]] = None, limit: int = LIST_PAGE_SIZE) -> Dict:
+        """Страница заказчиков (исключая админов и разработчиков), недавно писавшие первыми"""
+        page = await self._keyset_page(
+            'u.user_id, u.username, u.full_name, u.created_at, u.role, '
+            'c.customer_id, c.notes, c.status, c.created_at, c.updated_at',
+            'customers c JOIN users u ON c.user_id = u.user_id',
+            'c.updated_at', 'c.user_id', cursor, limit,
+            where_sql="u.role != 'admin' AND u.role != 'developer'"
+        )
+        page['items'] = [{
+            'customer_id': row[5],
+            'user_id': row[0],
+            'notes': row[6],
+            'status': row[7] if row[7] else 'new',
+            'created_at': row[8] if row[8] else row[3],
+            'updated_at': row[9] if row[9] else row[3],
+            'username': row[1],
+            'full_name': row[2],
+            'role': row[4]
+        } for row in page.pop('rows')]
+        return page
+    
+    async def get_users_page(self, role: Optional[str] = None, cursor: Optional[Tuple[str, int, int]] = None,
+                             limit: int = LIST_PAGE_SIZE) -> Dict:
+        """Страница пользователей (всех или с указанной ролью), новые первыми"""
+        page = await self._keyset_page(
+            'user_id, username, full_name, role, created_at', 'users',
+            'created_at', 'user_id', cursor, limit,
+            where_sql='role = ?' if role else '1', params=(role,) if role else ()
+        )
+        page['items'] = [{
+            'user_id': row[0],
+            'username': row[1],
+            'full_name': row[2],
+            'role': row[3],
+            'created_at': row[4]
+        } for row in page.pop('rows')]
+        return page
+    
+    async def get_reviews_page(self, cursor: Optional[Tuple[str, int, int]] = None, limit: int = LIST_PAGE_SIZE) -> Dict:
+        """Страница отзывов (новые первыми)"""
+        page = await self._keyset_page(
+            'r.review_id, r.user_id, r.room_id, r.review_text, r.admin_reply, r.created_at, r.updated_at, '
+            'u.username, u.full_name, rm.room_name',
+            'reviews r JOIN users u ON r.user_id = u.user_id LEFT JOIN rooms rm ON r.room_id = rm.room_id',
+            'r.created_at', 'r.review_id', cursor, limit
+        )
+        page['items'] = [{
+            'review_id': row[0],
+            'user_id': row[1],
+            'room_id': row[2],
+            'review_text': row[3],
+            'admin_reply': row[4],
+            'created_at': row[5],
+            'updated_at': row[6],
+            'username': row[7],
+            'full_name': row[8],
+            'room_name': row[9]
+        } for row in page.pop('rows')]
+        return page
+    
+    async def get_order_history_page(self, cursor: Optional[Tuple[str, int, int]] = None,
+                                     limit: int = LIST_PAGE_SIZE) -> Dict:
+        """Страница истории заказов (недавно закрытые первыми)"""
+        page = await self._keyset_page(
+            ORDER_HISTORY_COLUMNS, ORDER_HISTORY_FROM, 'h.closed_at', 'h.history_id', cursor, limit
+        )
+        page['items'] = [_order_history_row(row) for row in page.pop('rows')]
+        return page
+    
+    def get_role_counts(self) -> Dict[str, int]:
+        """Количество пользователей по ролям (из кэша ролей, без запроса к базе)"""
+        counts = {'admin': 0, 'customer': 0, 'developer': 0}
+        for role in self._roles.values():
+            counts[role] = counts.get(role, 0) + 1
+        counts['all'] = len(self._known_users)
+        return counts
@@ -0,0 +1,33 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, Iterable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class FanOut:
+    """Параллельная рассылка с ограничением числа одновременных отправок.
+
+    Каждому получателю send вызывается один раз; порядок сообщений одному
+    получателю обеспечивает вызывающий код (OutboxDispatcher отправляет
+    сообщения чата последовательно внутри одного вызова send).
+    """
+
+    def __init__(self, concurrency: int):
+        self._semaphore = asyncio.Semaphore(max(1, concurrency))
+
+    async def _deliver(self, recipient_id: int, send: Callable[[int], Awaitable]) -> Optional[Exception]:
+        """Доставить сообщение одному получателю"""
+        async with self._semaphore:
+            try:
+                await send(recipient_id)
+                return None
+            except Exception as e:
+                logger.error(f"Ошибка отправки сообщения пользователю {recipient_id}: {e}")
+                return e
+
+    async def send(self, recipients: Iterable[int], send: Callable[[int], Awaitable]) -> Dict[int, Optional[Exception]]:
+        """Разослать сообщение и дождаться доставки всем получателям: user_id -> None (доставлено) или ошибка"""
+        recipient_ids = list(dict.fromkeys(recipients))
+        results = await asyncio.gather(*(self._deliver(recipient_id, send) for recipient_id in recipient_ids))
+        return dict(zip(recipient_ids, results))
@@ -1,12 +1,34 @@
 import asyncio
+import html
 import logging
-import aiosqlite
 from aiogram import Bot, Dispatcher, types
-from aiogram.filters import Command
+from aiogram.filters import Command, CommandObject
 from aiogram.types import Message, CallbackQuery, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
 from aiogram.utils.keyboard import InlineKeyboardBuilder, ReplyKeyboardBuilder
-from config import BOT_TOKEN, ADMIN_IDS
-from database import Database
+from config import (
+    BOT_TOKEN, ADMIN_IDS, FANOUT_CONCURRENCY,
+    TELEGRAM_GLOBAL_RATE, TELEGRAM_CHAT_RATE, TELEGRAM_CHAT_BURST,
+    TELEGRAM_GROUP_RATE_PER_MIN, TELEGRAM_MAX_RETRIES,
+    OUTBOX_BATCH_SIZE, OUTBOX_POLL_INTERVAL, OUTBOX_MAX_ATTEMPTS,
+    OUTBOX_RETRY_BASE_DELAY, OUTBOX_RETRY_MAX_DELAY, OUTBOX_COMPACT_BATCH_SIZE, OUTBOX_FAILED_RETENTION,
+    SESSION_STATE_TTL, SESSION_STATE_FLUSH_INTERVAL, LIST_PAGE_SIZE, HISTORY_MESSAGE_PREVIEW,
+    ARCHIVE_GRACE_DAYS, ARCHIVE_INTERVAL, ARCHIVE_CHUNK_SIZE,
+)
+from archive import MessageArchiver
+from callbacks import CallbackRouter
+from database import Database, SEARCH_MARK_END, SEARCH_MARK_START, fts_match_query
+from fanout import FanOut
+from outbox import OutboxDispatcher, outbox_entries
+from paging import Paginator
+from pipeline import MessageContext, MessagePipeline
+from ratelimit import RateLimiter
+from sessions import PresenceMap, SessionStore
+from states import (
+    StateRouter, CreateRoom, AddAccess, RemoveAccess, DeleteRoom, AddAdmin, ChooseRole,
+    AddRole, CreateRoomFromChat, EditNotes, AddReview, ReviewReply, EditRoom, RoomAccess,
+    SearchMessages, state_from_dict, state_to_dict,
+)
+from unitofwork import UnitOfWorkMiddleware, CommitBeforeRequestMiddleware
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
@@ -19,17 +41,82 @@ dp = Dispatcher()
 # Инициализация базы данных
 db = Database()
 
-# Словарь для хранения активных комнат пользователей (user_id -> room_id)
-user_active_rooms = {}
+# Одна транзакция на обновление: фиксация перед запросами к Telegram и в конце обработки
+dp.update.outer_middleware(UnitOfWorkMiddleware(db))
+bot.session.middleware(CommitBeforeRequestMiddleware(db))
+
+# Маршрутизация inline-кнопок по ключу действия (callback_data формируется через callbacks.pack)
+callbacks = CallbackRouter()
+
+# Ограничение исходящих запросов: применяется ко всем вызовам bot.* и message.answer()
+rate_limiter = RateLimiter(
+    global_rate=TELEGRAM_GLOBAL_RATE,
+    chat_rate=TELEGRAM_CHAT_RATE,
+    chat_burst=TELEGRAM_CHAT_BURST,
+    group_rate=TELEGRAM_GROUP_RATE_PER_MIN / 60,
+    max_retries=TELEGRAM_MAX_RETRIES,
+)
+bot.session.middleware(rate_limiter)
+
+# Параллельная рассылка сообщений получателям
+fanout = FanOut(FANOUT_CONCURRENCY)
+
+# Фоновая доставка исходящих сообщений из outbox (переживает перезапуск бота)
+outbox = OutboxDispatcher(
+    db, bot, fanout,
+    batch_size=OUTBOX_BATCH_SIZE,
+    poll_interval=OUTBOX_POLL_INTERVAL,
+    max_attempts=OUTBOX_MAX_ATTEMPTS,
+    retry_base_delay=OUTBOX_RETRY_BASE_DELAY,
+    retry_max_delay=OUTBOX_RETRY_MAX_DELAY,
+    compact_batch_size=OUTBOX_COMPACT_BATCH_SIZE,
+    failed_retention=OUTBOX_FAILED_RETENTION * 86400,
+)
+
+# Перенос переписки закрытых заказов в архив
+archiver = MessageArchiver(
+    db,
+    grace_period=ARCHIVE_GRACE_DAYS * 86400,
+    interval=ARCHIVE_INTERVAL,
+    chunk_size=ARCHIVE_CHUNK_SIZE,
+)
+
+# Состояние сессий: словари ниже сохраняются в базе и восстанавливаются после перезапуска
+sessions = SessionStore(db, ttl=SESSION_STATE_TTL, flush_interval=SESSION_STATE_FLUSH_INTERVAL)
+
+# Активные комнаты пользователей (user_id -> room_id) с обратным индексом комната -> пользователи
+user_active_rooms = sessions.map('active_room', map_class=PresenceMap)
 
 # Словарь для хранения активных чатов администраторов (admin_id -> chat_id)
-admin_active_chats = {}
+admin_active_chats = sessions.map('admin_chat')
 
-# Словарь для хранения состояния пользователей (user_id -> 'add_access' или 'remove_access')
-user_action_state = {}
+# Ожидаемый ввод пользователей (user_id -> состояние из states.py, например EditRoom(room_id=5))
+user_action_state = sessions.map('action', encode=state_to_dict, decode=state_from_dict)
 
-# Словарь для хранения данных о добавлении доступа (user_id -> {'room_id': int, 'role': str})
-room_access_state = {}
+# Последний поисковый запрос пользователя (user_id -> текст) для кнопок страниц результатов
+search_queries = sessions.map('search')
+
+# Обработчики ожидаемого ввода по типу состояния
+input_states = StateRouter()
+
+# Этапы обработки обычных сообщений (process_message)
+message_pipeline = MessagePipeline()
+
+# Кнопки «Назад/Вперед» постраничных списков
+rooms_pages = Paginator(callbacks, "rooms_page")
+users_pages = Paginator(callbacks, "users_page", str)
+chats_pages = Paginator(callbacks, "chats_page")
+customers_pages = Paginator(callbacks, "customers_page")
+reviews_pages = Paginator(callbacks, "reviews_page")
+history_pages = Paginator(callbacks, "history_page")
+
+# Тексты Reply кнопок (обрабатываются handle_reply_buttons, а не пересылаются в комнату)
+REPLY_BUTTONS = frozenset([
+    "🏠 Создать комнату", "📂 Мои комнаты", "🌐 Все комнаты",
+    "➕ Добавить доступ", "➖ Удалить доступ", "🗑️ Удалить комнату",
+    "👑 Управление ролями", "🚪 Выйти из комнаты", "🔙 Главное меню",
+    "✏️ Изменить название", "➕ Добавить участника", "👥 Участники",
+])
 
 
 def is_admin(user_id: int) -> bool:
@@ -55,21 +142,60 @@ async def set_user_admin(user_id: int):
     await db.add_user(user_id, role='admin')
 
 
+def build_forward_sends(message: Message, header: str, message_text: str, text_after_voice: bool = False) -> list:
+    """Сформировать отправки для пересылки сообщения: список (метод bot.send_*, параметры)"""
+    caption = header + message_text if message_text else header.rstrip()
+    if message.photo:
+        # Фото
+        return [('send_photo', {'photo': message.photo[-1].file_id, 'caption': caption, 'parse_mode': "HTML"})]
+    if message.video:
+        # Видео
+        return [('send_video', {'video': message.video.file_id, 'caption': caption, 'parse_mode': "HTML"})]
+    if message.document:
+        # Документ
+        return [('send_document', {'document': message.document.file_id, 'caption': caption, 'parse_mode': "HTML"})]
+    if message.audio:
+        # Аудио
+        return [('send_audio', {'audio': message.audio.file_id, 'caption': caption, 'parse_mode': "HTML"})]
+    
+    sends = []
+    if message.voice:
+        # Голосовое сообщение
+        sends.append(('send_voice', {
+            'voice': message.voice.file_id,
+            'caption': header.rstrip() if not message_text else None,
+            'parse_mode': "HTML"
+        }))
+        if not text_after_voice:
+            return sends
+    elif message.video_note:
+        # Видео-кружок
+        sends.append(('send_video_note', {'video_note': message.video_note.file_id}))
+    elif message.sticker:
+        # Стикер
+        sends.append(('send_sticker', {'sticker': message.sticker.file_id}))
+    
+    # Текст отдельным сообщением (после кружка, стикера или как обычное сообщение)
+    if message_text:
+        sends.append(('send_message', {'text': header + message_text, 'parse_mode': "HTML"}))
+    return sends
+
+
 def get_admin_keyboard():
     """Создать клавиатуру для администратора"""
     builder = InlineKeyboardBuilder()
-    builder.button(text="🏠 Создать комнату", callback_data="action_create_room")
-    builder.button(text="📂 Мои комнаты", callback_data="action_my_rooms")
-    builder.button(text="🌐 Все комнаты", callback_data="action_all_rooms")
-    builder.button(text="💬 Чаты", callback_data="action_chats")
-    builder.button(text="👥 База заказчиков", callback_data="action_customers")
-    builder.button(text="🔔 Уведомления", callback_data="action_notifications")
-    builder.button(text="⭐ Отзывы", callback_data="action_reviews")
-    builder.button(text="📜 История заказов", callback_data="action_order_history")
-    builder.button(text="➕ Добавить доступ", callback_data="action_add_access")
-    builder.button(text="➖ Удалить доступ", callback_data="action_remove_access")
-    builder.button(text="🗑️ Удалить комнату", callback_data="action_delete_room")
-    builder.button(text="👑 Управление ролями", callback_data="action_manage_roles")
+    builder.button(text="🏠 Создать комнату", callback_data=callbacks.pack("action_create_room"))
+    builder.button(text="📂 Мои комнаты", callback_data=callbacks.pack("action_my_rooms"))
+    builder.button(text="🌐 Все комнаты", callback_data=callbacks.pack("action_all_rooms"))
+    builder.button(text="💬 Чаты", callback_data=callbacks.pack("action_chats"))
+    builder.button(text="👥 База заказчиков", callback_data=callbacks.pack("action_customers"))
+    builder.button(text="🔔 Уведомления", callback_data=callbacks.pack("action_notifications"))
+    builder.button(text="⭐ Отзывы", callback_data=callbacks.pack("action_reviews"))
+    builder.button(text="📜 История заказов", callback_data=callbacks.pack("action_order_history"))
+    builder.button(text="➕ Добавить доступ", callback_data=callbacks.pack("action_add_access"))
+    builder.button(text="➖ Удалить доступ", callback_data=callbacks.pack("action_remove_access"))
+    builder.button(text="🗑️ Удалить комнату", callback_data=callbacks.pack("action_delete_room"))
+    builder.button(text="👑 Управление ролями", callback_data=callbacks.pack("action_manage_roles"))
     builder.adjust(2, 2, 2, 2, 2)
     return builder.as_markup()
 
@@ -77,18 +203,106 @@ def get_admin_keyboard():
 def get_user_keyboard():
     """Создать клавиатуру для обычного пользователя"""
     builder = InlineKeyboardBuilder()
-    builder.button(text="📂 Мои комнаты", callback_data="action_my_rooms")
-    builder.button(text="⭐ Отзывы", callback_data="action_reviews")
-    builder.button(text="✍️ Оставить отзыв", callback_data="action_add_review")
-    builder.button(text="🔄 Обновить меню", callback_data="action_refresh")
+    builder.button(text="📂 Мои комнаты", callback_data=callbacks.pack("action_my_rooms"))
+    builder.button(text="⭐ Отзывы", callback_data=callbacks.pack("action_reviews"))
+    builder.button(text="✍️ Оставить отзыв", callback_data=callbacks.pack("action_add_review"))
+    builder.button(text="🔄 Обновить меню", callback_data=callbacks.pack("action_refresh"))
     builder.adjust(2, 1, 1)
     return builder.as_markup()
 
 
+def build_rooms_page(page: dict, page_no: int):
+    """Текст и клавиатура страницы списка всех комнат"""
+    text = f"🌐 <b>Все комнаты в системе</b>\n\n"
+    text += f"📄 Страница <b>{page_no}</b>\n\n"
+    text += "━━━━━━━━━━━━━━━━━━━━\n\n"
+    
+    for room in page['items']:
+        text += f"🏠 <b>{room['room_name']}</b>\n"
+        text += f"🆔 ID: <code>{room['room_id']}</code>\n"
+        text += f"👤 Заказчик: <code>{room['customer_id']}</code>\n"
+        text += f"👑 Создатель: <code>{room['created_by']}</code>\n"
+        text += "━━━━━━━━━━━━━━━━━━━━\n\n"
+    
+    builder = InlineKeyboardBuilder()
+    nav_buttons = rooms_pages.add_buttons(builder, page, page_no)
+    builder.button(text="🔙 Главное меню", callback_data=callbacks.pack("action_menu"))
+    builder.adjust(nav_buttons or 1, 1)
+    return text, builder.as_markup()
+
+
+def format_history(messages: list, sender_label) -> str:
+    """Текст страницы истории: время, отправитель (sender_label(сообщение)) и текст сообщения"""
+    text = ""
+    for msg in messages:
+        message_text = msg['message_text'] or ""
+        if len(message_text) > HISTORY_MESSAGE_PREVIEW:
+            message_text = message_text[:HISTORY_MESSAGE_PREVIEW] + "…"
+        text += f"🕐 {str(msg['created_at'])[:16]} {sender_label(msg)}\n{html.escape(message_text)}\n\n"
+    return text
+
+
+def add_history_buttons(builder: InlineKeyboardBuilder, action: str, owner_id: int, page: dict) -> int:
+    """Добавить кнопки перехода по истории (курсор - message_id); возвращает количество кнопок"""
+    buttons = 0
+    if page['before']:
+        builder.button(text="⬆️ Старые сообщения", callback_data=callbacks.pack(action, owner_id, 'b', page['before']))
+        buttons += 1
+    if page['after']:
+        builder.button(text="⬇️ Новые сообщения", callback_data=callbacks.pack(action, owner_id, 'a', page['after']))
+        buttons += 1
+    return buttons
+
+
+async def build_search_page(user_id: int, query: str, page_no: int):
+    """Текст и клавиатура страницы результатов поиска (None, если в запросе нет слов)"""
+    match = fts_match_query(query)
+    if match is None:
+        return None
+    # Администратор ищет во всех комнатах и чатах, остальные - в своих комнатах
+    is_user_admin = await check_is_admin(user_id)
+    page = await db.search_messages(
+        match, member_id=None if is_user_admin else user_id, include_chats=is_user_admin,
+        limit=LIST_PAGE_SIZE, offset=(page_no - 1) * LIST_PAGE_SIZE
+    )
+    
+    text = f"🔍 <b>Поиск:</b> {html.escape(query)}\n"
+    text += f"📄 Страница <b>{page_no}</b>\n\n"
+    builder = InlineKeyboardBuilder()
+    if not page['items']:
+        text += "😔 Ничего не найдено.\n\n"
+    if page['truncated']:
+        text += "ℹ️ Показаны только самые новые совпадения, более старые не вошли. Уточните запрос, чтобы найти их.\n\n"
+    for idx, item in enumerate(page['items'], (page_no - 1) * LIST_PAGE_SIZE + 1):
+        snippet = html.escape(item['snippet'] or "").replace(SEARCH_MARK_START, "<b>").replace(SEARCH_MARK_END, "</b>")
+        if item['source'] == 'room':
+            text += f"{idx}. 🏠 <b>{html.escape(item['title'] or '')}</b>"
+            # Кнопка открывает историю комнаты, начиная с найденного сообщения
+            open_data = callbacks.pack("room_history_page", item['owner_id'], 'a', item['message_id'] - 1)
+        else:
+            text += f"{idx}. 💬 <b>{html.escape(item['title'] or 'Чат')}</b>"
+            open_data = callbacks.pack("chat_history", item['owner_id'], 'a', item['message_id'] - 1)
+        text += f" 🕐 {str(item['created_at'])[:16]}\n{snippet}\n\n"
+        builder.button(text=str(idx), callback_data=open_data)
+    result_buttons = len(page['items'])
+    
+    nav_buttons = 0
+    if page_no > 1:
+        builder.button(text="◀️ Назад", callback_data=callbacks.pack("search_page", page_no - 1))
+        nav_buttons += 1
+    if page['has_more']:
+        builder.button(text="Вперед ▶️", callback_data=callbacks.pack("search_page", page_no + 1))
+        nav_buttons += 1
+    builder.button(text="🔙 Главное меню", callback_data=callbacks.pack("action_menu"))
+    result_rows = [5] * (result_buttons // 5) + ([result_buttons % 5] if result_buttons % 5 else [])
+    builder.adjust(*result_rows, *([nav_buttons] if nav_buttons else []), 1)
+    return text, builder.as_markup()
+
+
 def get_back_to_menu_keyboard(is_admin_user: bool):
     """Создать кнопку возврата в меню"""
     builder = InlineKeyboardBuilder()
-    builder.button(text="🔙 Главное меню", callback_data="action_menu")
+    builder.button(text="🔙 Главное меню", callback_data=callbacks.pack("action_menu"))
     return builder.as_markup()
 
 
@@ -161,9 +375,7 @@ async def cmd_start(message: Message):
         )
     else:
         # Проверяем, есть ли у пользователя комнаты
-        rooms = await db.get_user_rooms(user_id, False)
-        
-        if not rooms:
+        if not await db.user_has_any_room(user_id):
             # У пользователя нет комнат - он может писать в бота
             text = (
                 "👋 <b>Добро пожаловать!</b>\n\n"
@@ -209,7 +421,7 @@ async def cmd_create_room(message: Message):
         )
         return
     
-    user_action_state[message.from_user.id] = 'create_room'
+    user_action_state[message.from_user.id] = CreateRoom()
     await message.answer(
         "🏠 <b>Создание новой комнаты</b>\n\n"
         "📝 Отправьте название комнаты:\n\n"
@@ -260,10 +472,10 @@ async def cmd_my_rooms(message: Message):
             access_type = "👨‍💻 Разработчик"
         builder.button(
             text=f"🏠 {room_name} ({access_type})",
-            callback_data=f"room_{room_id}"
+            callback_data=callbacks.pack("room", room_id)
         )
     
-    builder.button(text="🔙 Главное меню", callback_data="action_menu")
+    builder.button(text="🔙 Главное меню", callback_data=callbacks.pack("action_menu"))
     builder.adjust(1)
     
     await message.answer(
@@ -291,7 +503,7 @@ async def cmd_add_access(message: Message):
         )
         return
     
-    user_action_state[message.from_user.id] = 'add_access'
+    user_action_state[message.from_user.id] = AddAccess()
     await message.answer(
         "➕ <b>Добавление доступа к комнате</b>\n\n"
         "📝 Отправьте сообщение в следующем формате:\n\n"
@@ -317,7 +529,7 @@ async def cmd_remove_access(message: Message):
         )
         return
     
-    user_action_state[message.from_user.id] = 'remove_access'
+    user_action_state[message.from_user.id] = RemoveAccess()
     await message.answer(
         "➖ <b>Удаление доступа к комнате</b>\n\n"
         "📝 Отправьте сообщение в следующем формате:\n\n"
@@ -343,9 +555,9 @@ async def cmd_all_rooms(message: Message):
         )
         return
     
-    rooms = await db.get_all_rooms()
+    page = await db.get_rooms_page()
     
-    if not rooms:
+    if not page['items']:
         await message.answer(
             "📭 <b>Комнаты не найдены</b>\n\n"
             "😔 В системе пока нет созданных комнат.\n\n"
@@ -355,18 +567,8 @@ async def cmd_all_rooms(message: Message):
         )
         return
     
-    text = f"🌐 <b>Все комнаты в системе</b>\n\n"
-    text += f"📊 Всего комнат: <b>{len(rooms)}</b>\n\n"
-    text += "━━━━━━━━━━━━━━━━━━━━\n\n"
-    
-    for room in rooms:
-        text += f"🏠 <b>{room['room_name']}</b>\n"
-        text += f"🆔 ID: <code>{room['room_id']}</code>\n"
-        text += f"👤 Заказчик: <code>{room['customer_id']}</code>\n"
-        text += f"👑 Создатель: <code>{room['created_by']}</code>\n"
-        text += "━━━━━━━━━━━━━━━━━━━━\n\n"
-    
-    await message.answer(text, parse_mode="HTML", reply_markup=get_back_to_menu_keyboard(True))
+    text, keyboard = build_rooms_page(page, 1)
+    await message.answer(text, parse_mode="HTML", reply_markup=keyboard)
 
 
 @dp.message(Command("delete_room"))
@@ -381,7 +583,7 @@ async def cmd_delete_room(message: Message):
         )
         return
     
-    user_action_state[message.from_user.id] = 'delete_room'
+    user_action_state[message.from_user.id] = DeleteRoom()
     await message.answer(
         "🗑️ <b>Удаление комнаты</b>\n\n"
         "⚠️ <b>ВНИМАНИЕ:</b> Это действие необратимо!\n"
@@ -407,7 +609,7 @@ async def cmd_add_admin(message: Message):
         )
         return
     
-    user_action_state[message.from_user.id] = 'add_admin'
+    user_action_state[message.from_user.id] = AddAdmin()
     await message.answer(
         "👑 <b>Добавление администратора</b>\n\n"
         "📝 Отправьте <b>Telegram ID</b> пользователя, которого хотите сделать администратором:\n\n"
@@ -420,7 +622,63 @@ async def cmd_add_admin(message: Message):
     )
 
 
-@dp.callback_query(lambda c: c.data == "action_menu")
+@dp.message(Command("search"))
+async def cmd_search(message: Message, command: CommandObject):
+    """Поиск по сообщениям: /search текст (или текст следующим сообщением)"""
+    user_id = message.from_user.id
+    if command.args:
+        await send_search_results(message, command.args)
+        return
+    
+    user_action_state[user_id] = SearchMessages()
+    await message.answer(
+        "🔍 <b>Поиск по сообщениям</b>\n\n"
+        "📝 Отправьте слова, которые нужно найти:\n\n"
+        "💡 <b>Пример:</b>\n"
+        "<code>макет главной страницы</code>\n\n"
+        "ℹ️ Поиск идет по комнатам, к которым у вас есть доступ.\n\n"
+        "❌ Для отмены используйте <code>/cancel</code>",
+        parse_mode="HTML",
+        reply_markup=get_back_to_menu_keyboard(await check_is_admin(user_id))
+    )
+
+
+async def send_search_results(message: Message, query: str):
+    """Показать первую страницу результатов поиска и запомнить запрос для кнопок страниц"""
+    user_id = message.from_user.id
+    result = await build_search_page(user_id, query, 1)
+    if result is None:
+        await message.answer(
+            "❌ <b>Ошибка</b>\n\n"
+            "📝 В запросе нет слов для поиска.",
+            parse_mode="HTML"
+        )
+        return
+    search_queries[user_id] = query
+    text, keyboard = result
+    await message.answer(text, parse_mode="HTML", reply_markup=keyboard)
+
+
+@callbacks.route("search_page", int)
+async def process_search_page(callback: CallbackQuery, page_no: int):
+    """Переход по страницам результатов последнего поиска"""
+    query = search_queries.get(callback.from_user.id)
+    result = await build_search_page(callback.from_user.id, query, page_no) if query else None
+    if result is None:
+        await callback.answer("⌛ Поиск устарел, выполните его заново: /search", show_alert=True)
+        return
+    text, keyboard = result
+    await callback.message.edit_text(text, parse_mode="HTML", reply_markup=keyboard)
+    await callback.answer()
+
+
+@dp.callback_query()
+async def process_callback(callback: CallbackQuery):
+    """Единая точка входа для всех inline-кнопок: обработчик выбирается по ключу действия"""
+    await callbacks.dispatch(callback)
+
+
+@callbacks.route("action_menu")
 async def process_menu(callback: CallbackQuery):
     """Обработка возврата в главное меню"""
     user_id = callback.from_user.id
@@ -441,14 +699,14 @@ async def process_menu(callback: CallbackQuery):
     await callback.answer()
 
 
-@dp.callback_query(lambda c: c.data == "action_create_room")
+@callbacks.route("action_create_room")
 async def process_create_room_button(callback: CallbackQuery):
     """Обработка кнопки создания комнаты"""
     if not await check_is_admin(callback.from_user.id):
         await callback.answer("🚫 У вас нет прав для этого действия.", show_alert=True)
         return
     
-    user_action_state[callback.from_user.id] = 'create_room'
+    user_action_state[callback.from_user.id] = CreateRoom()
     await callback.message.edit_text(
         "🏠 <b>Создание новой комнаты</b>\n\n"
         "📝 Отправьте название комнаты:\n\n"
@@ -463,7 +721,7 @@ async def process_create_room_button(callback: CallbackQuery):
     await callback.answer()
 
 
-@dp.callback_query(lambda c: c.data == "action_my_rooms")
+@callbacks.route("action_my_rooms")
 async def process_my_rooms_button(callback: CallbackQuery):
     """Обработка кнопки моих комнат"""
     user_id = callback.from_user.id
@@ -491,10 +749,10 @@ async def process_my_rooms_button(callback: CallbackQuery):
             access_type = "👨‍💻 Разработчик"
         builder.button(
             text=f"🏠 {room_name} ({access_type})",
-            callback_data=f"room_{room_id}"
+            callback_data=callbacks.pack("room", room_id)
         )
     
-    builder.button(text="🔙 Главное меню", callback_data="action_menu")
+    builder.button(text="🔙 Главное меню", callback_data=callbacks.pack("action_menu"))
     builder.adjust(1)
     
     await callback.message.edit_text(
@@ -507,16 +765,17 @@ async def process_my_rooms_button(callback: CallbackQuery):
     await callback.answer()
 
 
-@dp.callback_query(lambda c: c.data == "action_all_rooms")
-async def process_all_rooms_button(callback: CallbackQuery):
-    """Обработка кнопки всех комнат"""
+@callbacks.route("action_all_rooms")
+@rooms_pages.route
+async def process_all_rooms_button(callback: CallbackQuery, cursor: tuple = None, page_no: int = 1):
+    """Обработка кнопки всех комнат (постранично)"""
     if not await check_is_admin(callback.from_user.id):
         await callback.answer("🚫 У вас нет прав для этого действия.", show_alert=True)
         return
     
-    rooms = await db.get_all_rooms()
+    page = await db.get_rooms_page(cursor)
     
-    if not rooms:
+    if not page['items']:
         await callback.message.edit_text(
             "📭 <b>Комнаты не найдены</b>\n\n"
             "😔 В системе пока нет созданных комнат.\n\n"
@@ -527,29 +786,19 @@ async def process_all_rooms_button(callback: CallbackQuery):
         await callback.answer()
         return
     
-    text = f"🌐 <b>Все комнаты в системе</b>\n\n"
-    text += f"📊 Всего комнат: <b>{len(rooms)}</b>\n\n"
-    text += "━━━━━━━━━━━━━━━━━━━━\n\n"
-    
-    for room in rooms:
-        text += f"🏠 <b>{room['room_name']}</b>\n"
-        text += f"🆔 ID: <code>{room['room_id']}</code>\n"
-        text += f"👤 Заказчик: <code>{room['customer_id']}</code>\n"
-        text += f"👑 Создатель: <code>{room['created_by']}</code>\n"
-        text += "━━━━━━━━━━━━━━━━━━━━\n\n"
-    
-    await callback.message.edit_text(text, parse_mode="HTML", reply_markup=get_back_to_menu_keyboard(True))
+    text, keyboard = build_rooms_page(page, page_no)
+    await callback.message.edit_text(text, parse_mode="HTML", reply_markup=keyboard)
     await callback.answer()
 
 
-@dp.callback_query(lambda c: c.data == "action_add_access")
+@callbacks.route("action_add_access")
 async def process_add_access_button(callback: CallbackQuery):
     """Обработка кнопки добавления доступа"""
     if not await check_is_admin(callback.from_user.id):
         await callback.answer("🚫 У вас нет прав для этого действия.", show_alert=True)
         return
     
-    user_action_state[callback.from_user.id] = 'add_access'
+    user_action_state[callback.from_user.id] = AddAccess()
     await callback.message.edit_text(
         "➕ <b>Добавление доступа к комнате</b>\n\n"
         "📝 Отправьте сообщение в следующем формате:\n\n"
@@ -564,14 +813,14 @@ async def process_add_access_button(callback: CallbackQuery):
     await callback.answer()
 
 
-@dp.callback_query(lambda c: c.data == "action_remove_access")
+@callbacks.route("action_remove_access")
 async def process_remove_access_button(callback: CallbackQuery):
     """Обработка кнопки удаления доступа"""
     if not await check_is_admin(callback.from_user.id):
         await callback.answer("🚫 У вас нет прав для этого действия.", show_alert=True)
         return
     
-    user_action_state[callback.from_user.id] = 'remove_access'
+    user_action_state[callback.from_user.id] = RemoveAccess()
     await callback.message.edit_text(
         "➖ <b>Удаление доступа к комнате</b>\n\n"
         "📝 Отправьте сообщение в следующем формате:\n\n"
@@ -586,14 +835,14 @@ async def process_remove_access_button(callback: CallbackQuery):
     await callback.answer()
 
 
-@dp.callback_query(lambda c: c.data == "action_delete_room")
+@callbacks.route("action_delete_room")
 async def process_delete_room_button(callback: CallbackQuery):
     """Обработка кнопки удаления комнаты"""
     if not await check_is_admin(callback.from_user.id):
         await callback.answer("🚫 У вас нет прав для этого действия.", show_alert=True)
         return
     
-    user_action_state[callback.from_user.id] = 'delete_room'
+    user_action_state[callback.from_user.id] = DeleteRoom()
     await callback.message.edit_text(
         "🗑️ <b>Удаление комнаты</b>\n\n"
         "⚠️ <b>ВНИМАНИЕ:</b> Это действие необратимо!\n"
@@ -608,7 +857,7 @@ async def process_delete_room_button(callback: CallbackQuery):
     await callback.answer()
 
 
-@dp.callback_query(lambda c: c.data == "action_manage_roles")
+@callbacks.route("action_manage_roles")
 async def process_manage_roles_button(callback: CallbackQuery):
     """Обработка кнопки управления ролями"""
     if not await check_is_admin(callback.from_user.id):
@@ -616,26 +865,23 @@ async def process_manage_roles_button(callback: CallbackQuery):
         return
     
     builder = InlineKeyboardBuilder()
-    builder.button(text="👑 Администраторы", callback_data="role_list_admin")
-    builder.button(text="👥 Клиенты", callback_data="role_list_customer")
-    builder.button(text="👨‍💻 Разработчики", callback_data="role_list_developer")
-    builder.button(text="👤 Все пользователи", callback_data="role_list_all")
-    builder.button(text="➕ Добавить роль", callback_data="role_add_select")
-    builder.button(text="🔙 Главное меню", callback_data="action_menu")
+    builder.button(text="👑 Администраторы", callback_data=callbacks.pack("role_list", "admin"))
+    builder.button(text="👥 Клиенты", callback_data=callbacks.pack("role_list", "customer"))
+    builder.button(text="👨‍💻 Разработчики", callback_data=callbacks.pack("role_list", "developer"))
+    builder.button(text="👤 Все пользователи", callback_data=callbacks.pack("role_list", "all"))
+    builder.button(text="➕ Добавить роль", callback_data=callbacks.pack("role_add_select"))
+    builder.button(text="🔙 Главное меню", callback_data=callbacks.pack("action_menu"))
     builder.adjust(1, 1, 1, 1, 1, 1)
     
-    # Получаем статистику по ролям
-    admins = await db.get_users_by_role('admin')
-    customers = await db.get_users_by_role('customer')
-    developers = await db.get_users_by_role('developer')
-    all_users = await db.get_all_users()
+    # Статистика по ролям (из кэша ролей)
+    role_counts = db.get_role_counts()
     
     text = "👑 <b>Управление ролями</b>\n\n"
     text += "📊 <b>Статистика:</b>\n"
-    text += f"👑 Администраторы: <b>{len(admins)}</b>\n"
-    text += f"👥 Клиенты: <b>{len(customers)}</b>\n"
-    text += f"👨‍💻 Разработчики: <b>{len(developers)}</b>\n"
-    text += f"👤 Всего пользователей: <b>{len(all_users)}</b>\n\n"
+    text += f"👑 Администраторы: <b>{role_counts['admin']}</b>\n"
+    text += f"👥 Клиенты: <b>{role_counts['customer']}</b>\n"
+    text += f"👨‍💻 Разработчики: <b>{role_counts['developer']}</b>\n"
+    text += f"👤 Всего пользователей: <b>{role_counts['all']}</b>\n\n"
     text += "👇 Выберите действие:"
     
     await callback.message.edit_text(
@@ -646,35 +892,33 @@ async def process_manage_roles_button(callback: CallbackQuery):
     await callback.answer()
 
 
-@dp.callback_query(lambda c: c.data.startswith("role_list_"))
-async def process_role_list(callback: CallbackQuery):
-    """Показать список пользователей с определенной ролью"""
+@callbacks.route("role_list", str)
+@users_pages.route
+async def process_role_list(callback: CallbackQuery, role_type: str, cursor: tuple = None, page_no: int = 1):
+    """Показать список пользователей с определенной ролью (постранично)"""
     if not await check_is_admin(callback.from_user.id):
         await callback.answer("🚫 У вас нет прав для этого действия.", show_alert=True)
         return
     
-    role_type = callback.data.split("_")[2]
-    
     if role_type == "all":
-        users = await db.get_all_users()
         role_name = "Все пользователи"
         role_emoji = "👤"
     elif role_type == "admin":
-        users = await db.get_users_by_role('admin')
         role_name = "Администраторы"
         role_emoji = "👑"
     elif role_type == "customer":
-        users = await db.get_users_by_role('customer')
         role_name = "Клиенты"
         role_emoji = "👥"
     elif role_type == "developer":
-        users = await db.get_users_by_role('developer')
         role_name = "Разработчики"
         role_emoji = "👨‍💻"
     else:
         await callback.answer("❌ Неизвестная роль", show_alert=True)
         return
     
+    page = await db.get_users_page(None if role_type == "all" else role_type, cursor)
+    users = page['items']
+    
     if not users:
         await callback.message.edit_text(
             f"{role_emoji} <b>{role_name}</b>\n\n"
@@ -691,14 +935,16 @@ async def process_role_list(callback: CallbackQuery):
         username = f"@{user['username']}" if user['username'] else "Без username"
         full_name = user['full_name'] or "Без имени"
         button_text = f"{username} - {full_name}"
-        builder.button(text=button_text, callback_data=f"user_role_{user['user_id']}")
+        builder.button(text=button_text, callback_data=callbacks.pack("user_role", user['user_id']))
     
-    builder.button(text="🔙 К управлению ролями", callback_data="action_manage_roles")
-    builder.button(text="🔙 Главное меню", callback_data="action_menu")
-    builder.adjust(1, 2)
+    nav_buttons = users_pages.add_buttons(builder, page, page_no, role_type)
+    builder.button(text="🔙 К управлению ролями", callback_data=callbacks.pack("action_manage_roles"))
+    builder.button(text="🔙 Главное меню", callback_data=callbacks.pack("action_menu"))
+    builder.adjust(*[1] * len(users), nav_buttons or 2, 2)
     
     text = f"{role_emoji} <b>{role_name}</b>\n\n"
-    text += f"📊 Всего: <b>{len(users)}</b>\n\n"
+    text += f"📊 Всего: <b>{db.get_role_counts()[role_type]}</b>\n"
+    text += f"📄 Страница <b>{page_no}</b>\n\n"
     text += "👇 Выберите пользователя для управления:"
     
     await callback.message.edit_text(
@@ -709,33 +955,18 @@ async def process_role_list(callback: CallbackQuery):
     await callback.answer()
 
 
-@dp.callback_query(lambda c: c.data.startswith("user_role_"))
-async def process_user_role(callback: CallbackQuery):
+@callbacks.route("user_role", int)
+async def process_user_role(callback: CallbackQuery, user_id: int):
     """Показать информацию о пользователе и управление его ролью"""
     if not await check_is_admin(callback.from_user.id):
         await callback.answer("🚫 У вас нет прав для этого действия.", show_alert=True)
         return
     
-    user_id = int(callback.data.split("_")[2])
-    
     # Получаем информацию о пользователе
-    async with aiosqlite.connect(db.db_path) as db_conn:
-        async with db_conn.execute('''
-            SELECT user_id, username, full_name, role, created_at
-            FROM users WHERE user_id = ?
-        ''', (user_id,)) as cursor:
-            row = await cursor.fetchone()
-            if not row:
-                await callback.answer("❌ Пользователь не найден", show_alert=True)
-                return
-            
-            user_info = {
-                'user_id': row[0],
-                'username': row[1],
-                'full_name': row[2],
-                'role': row[3],
-                'created_at': row[4]
-            }
+    user_info = await db.get_user(user_id)
+    if not user_info:
+        await callback.answer("❌ Пользователь не найден", show_alert=True)
+        return
     
     role_emoji = {
         'admin': '👑',
@@ -763,17 +994,17 @@ async def process_user_role(callback: CallbackQuery):
     builder = InlineKeyboardBuilder()
     # Кнопки для смены роли
     if user_info['role'] != 'admin':
-        builder.button(text="👑 Сделать администратором", callback_data=f"role_set_{user_id}_admin")
+        builder.button(text="👑 Сделать администратором", callback_data=callbacks.pack("role_set", user_id, "admin"))
     if user_info['role'] != 'customer':
-        builder.button(text="👥 Сделать клиентом", callback_data=f"role_set_{user_id}_customer")
+        builder.button(text="👥 Сделать клиентом", callback_data=callbacks.pack("role_set", user_id, "customer"))
     if user_info['role'] != 'developer':
-        builder.button(text="👨‍💻 Сделать разработчиком", callback_data=f"role_set_{user_id}_developer")
+        builder.button(text="👨‍💻 Сделать разработчиком", callback_data=callbacks.pack("role_set", user_id, "developer"))
     if user_info['role'] != 'user':
-        builder.button(text="👤 Сделать пользователем", callback_data=f"role_set_{user_id}_user")
+        builder.button(text="👤 Сделать пользователем", callback_data=callbacks.pack("role_set", user_id, "user"))
     
-    builder.button(text="🗑️ Удалить роль (сбросить)", callback_data=f"role_remove_{user_id}")
-    builder.button(text="🔙 К списку ролей", callback_data=f"role_list_{user_info['role']}")
-    builder.button(text="🔙 К управлению ролями", callback_data="action_manage_roles")
+    builder.button(text="🗑️ Удалить роль (сбросить)", callback_data=callbacks.pack("role_remove", user_id))
+    builder.button(text="🔙 К списку ролей", callback_data=callbacks.pack("role_list", user_info['role']))
+    builder.button(text="🔙 К управлению ролями", callback_data=callbacks.pack("action_manage_roles"))
     builder.adjust(1, 1, 1, 1, 1, 2)
     
     await callback.message.edit_text(
@@ -784,17 +1015,13 @@ async def process_user_role(callback: CallbackQuery):
     await callback.answer()
 
 
-@dp.callback_query(lambda c: c.data.startswith("role_set_"))
-async def process_role_set(callback: CallbackQuery):
+@callbacks.route("role_set", int, str)
+async def process_role_set(callback: CallbackQuery, user_id: int, new_role: str):
     """Установить роль пользователю"""
     if not await check_is_admin(callback.from_user.id):
         await callback.answer("🚫 У вас нет прав для этого действия.", show_alert=True)
         return
     
-    parts = callback.data.split("_")
-    user_id = int(parts[2])
-    new_role = parts[3]
-    
     # Обновляем роль
     await db.update_user_role(user_id, new_role)
     
@@ -825,44 +1052,40 @@ async def process_role_set(callback: CallbackQuery):
     )
     
     # Обновляем информацию о пользователе
-    callback.data = f"user_role_{user_id}"
-    await process_user_role(callback)
+    await process_user_role(callback, user_id)
 
 
-@dp.callback_query(lambda c: c.data.startswith("role_remove_"))
-async def process_role_remove(callback: CallbackQuery):
+@callbacks.route("role_remove", int)
+async def process_role_remove(callback: CallbackQuery, user_id: int):
     """Удалить роль (сбросить на user)"""
     if not await check_is_admin(callback.from_user.id):
         await callback.answer("🚫 У вас нет прав для этого действия.", show_alert=True)
         return
     
-    user_id = int(callback.data.split("_")[2])
-    
     # Сбрасываем роль на 'user'
     await db.update_user_role(user_id, 'user')
     
     await callback.answer("👤 Роль сброшена на 'Пользователь'", show_alert=True)
     
     # Обновляем информацию о пользователе
-    callback.data = f"user_role_{user_id}"
-    await process_user_role(callback)
+    await process_user_role(callback, user_id)
 
 
-@dp.callback_query(lambda c: c.data == "role_add_select")
+@callbacks.route("role_add_select")
 async def process_role_add_select(callback: CallbackQuery):
     """Выбор роли для добавления"""
     if not await check_is_admin(callback.from_user.id):
         await callback.answer("🚫 У вас нет прав для этого действия.", show_alert=True)
         return
     
-    user_action_state[callback.from_user.id] = 'add_role'
+    user_action_state[callback.from_user.id] = ChooseRole()
     
     builder = InlineKeyboardBuilder()
-    builder.button(text="👑 Администратор", callback_data="role_add_admin")
-    builder.button(text="👥 Клиент", callback_data="role_add_customer")
-    builder.button(text="👨‍💻 Разработчик", callback_data="role_add_developer")
-    builder.button(text="👤 Пользователь", callback_data="role_add_user")
-    builder.button(text="🔙 К управлению ролями", callback_data="action_manage_roles")
+    builder.button(text="👑 Администратор", callback_data=callbacks.pack("role_add", "admin"))
+    builder.button(text="👥 Клиент", callback_data=callbacks.pack("role_add", "customer"))
+    builder.button(text="👨‍💻 Разработчик", callback_data=callbacks.pack("role_add", "developer"))
+    builder.button(text="👤 Пользователь", callback_data=callbacks.pack("role_add", "user"))
+    builder.button(text="🔙 К управлению ролями", callback_data=callbacks.pack("action_manage_roles"))
     builder.adjust(1, 1, 1, 1, 1)
     
     await callback.message.edit_text(
@@ -875,15 +1098,13 @@ async def process_role_add_select(callback: CallbackQuery):
     await callback.answer()
 
 
-@dp.callback_query(lambda c: c.data.startswith("role_add_"))
-async def process_role_add(callback: CallbackQuery):
+@callbacks.route("role_add", str)
+async def process_role_add(callback: CallbackQuery, role: str):
     """Начать процесс добавления роли"""
     if not await check_is_admin(callback.from_user.id):
         await callback.answer("🚫 У вас нет прав для этого действия.", show_alert=True)
         return
     
-    role = callback.data.split("_")[2]
-    
     role_names = {
         'admin': 'Администратор',
         'customer': 'Клиент',
@@ -898,7 +1119,7 @@ async def process_role_add(callback: CallbackQuery):
         'user': '👤'
     }
     
-    user_action_state[callback.from_user.id] = f'add_role_{role}'
+    user_action_state[callback.from_user.id] = AddRole(role)
     
     await callback.message.edit_text(
         f"➕ <b>Добавление роли</b>\n\n"
@@ -914,7 +1135,7 @@ async def process_role_add(callback: CallbackQuery):
     await callback.answer()
 
 
-@dp.callback_query(lambda c: c.data == "action_exit_room")
+@callbacks.route("action_exit_room")
 async def process_exit_room_button(callback: CallbackQuery):
     """Обработка кнопки выхода из комнаты"""
     user_id = callback.from_user.id
@@ -937,14 +1158,16 @@ async def process_exit_room_button(callback: CallbackQuery):
         await callback.answer("ℹ️ Вы не находитесь ни в одной комнате.", show_alert=True)
 
 
-@dp.callback_query(lambda c: c.data == "action_chats")
-async def process_chats_button(callback: CallbackQuery):
-    """Обработка кнопки просмотра чатов"""
+@callbacks.route("action_chats")
+@chats_pages.route
+async def process_chats_button(callback: CallbackQuery, cursor: tuple = None, page_no: int = 1):
+    """Обработка кнопки просмотра чатов (постранично)"""
     if not await check_is_admin(callback.from_user.id):
         await callback.answer("🚫 У вас нет прав для этого действия.", show_alert=True)
         return
     
-    chats = await db.get_all_chats()
+    page = await db.get_chats_page(cursor)
+    chats = page['items']
     
     if not chats:
         await callback.message.edit_text(
@@ -962,13 +1185,14 @@ async def process_chats_button(callback: CallbackQuery):
         unread_badge = f" ({chat['unread_count']})" if chat['unread_count'] > 0 else ""
         username = f"@{chat['username']}" if chat['username'] else "Без username"
         button_text = f"{username}{unread_badge}"
-        builder.button(text=button_text, callback_data=f"chat_{chat['chat_id']}")
+        builder.button(text=button_text, callback_data=callbacks.pack("chat", chat['chat_id']))
     
-    builder.button(text="🔙 Главное меню", callback_data="action_menu")
-    builder.adjust(1)
+    nav_buttons = chats_pages.add_buttons(builder, page, page_no)
+    builder.button(text="🔙 Главное меню", callback_data=callbacks.pack("action_menu"))
+    builder.adjust(*[1] * len(chats), nav_buttons or 1, 1)
     
     text = "💬 <b>Чаты</b>\n\n"
-    text += f"📊 Всего чатов: <b>{len(chats)}</b>\n\n"
+    text += f"📄 Страница <b>{page_no}</b>\n\n"
     text += "👇 Выберите чат для просмотра:"
     
     await callback.message.edit_text(
@@ -979,14 +1203,13 @@ async def process_chats_button(callback: CallbackQuery):
     await callback.answer()
 
 
-@dp.callback_query(lambda c: c.data.startswith("chat_"))
-async def process_chat_view(callback: CallbackQuery):
+@callbacks.route("chat", int)
+async def process_chat_view(callback: CallbackQuery, chat_id: int):
     """Обработка просмотра конкретного чата"""
     if not await check_is_admin(callback.from_user.id):
         await callback.answer("🚫 У вас нет прав для этого действия.", show_alert=True)
         return
     
-    chat_id = int(callback.data.split("_")[1])
     chat = await db.get_chat_by_chat_id(chat_id)
     
     if not chat:
@@ -996,18 +1219,15 @@ async def process_chat_view(callback: CallbackQuery):
     # Получаем информацию о пользователе
     await db.add_user(chat['user_id'], None, None, 'user')
     # Получаем username и full_name из базы
-    async with aiosqlite.connect(db.db_path) as db_conn:
-        async with db_conn.execute('SELECT username, full_name FROM users WHERE user_id = ?', (chat['user_id'],)) as cursor:
-            row = await cursor.fetchone()
-            username = row[0] if row else None
-            full_name = row[1] if row else "Без имени"
+    user_info = await db.get_user(chat['user_id'])
+    username = user_info['username'] if user_info else None
+    full_name = user_info['full_name'] if user_info else "Без имени"
     
     # Отмечаем чат как прочитанный
     await db.mark_chat_as_read(chat_id)
     
-    # Получаем последние сообщения
-    messages = await db.get_chat_messages(chat_id, limit=10)
-    messages.reverse()  # Показываем в хронологическом порядке
+    # Получаем последние сообщения (в хронологическом порядке)
+    history = await db.get_chat_history(chat_id)
     
     # Устанавливаем активный чат для администратора
     admin_active_chats[callback.from_user.id] = chat_id
@@ -1018,13 +1238,9 @@ async def process_chat_view(callback: CallbackQuery):
         text += f"📱 <b>Username:</b> @{username}\n"
     text += f"🆔 <b>ID:</b> <code>{chat['user_id']}</code>\n\n"
     
-    if messages:
+    if history['messages']:
         text += "📜 <b>Последние сообщения:</b>\n\n"
-        for msg in messages:
-            if msg['is_from_user']:
-                text += f"👤 <b>Пользователь:</b> {msg['message_text'][:100]}\n\n"
-            else:
-                text += f"👨‍💼 <b>Администратор:</b> {msg['message_text'][:100]}\n\n"
+        text += format_history(history['messages'], chat_sender_label)
     else:
         text += "📭 Пока нет сообщений в этом чате.\n\n"
     
@@ -1032,12 +1248,58 @@ async def process_chat_view(callback: CallbackQuery):
     text += "📝 Просто отправьте сообщение, и оно будет доставлено пользователю."
     
     builder = InlineKeyboardBuilder()
-    builder.button(text="🏠 Создать комнату", callback_data=f"create_room_from_chat_{chat_id}")
-    builder.button(text="📝 Добавить пометку", callback_data=f"add_note_{chat['user_id']}")
-    builder.button(text="👥 База заказчиков", callback_data="action_customers")
-    builder.button(text="🔙 К списку чатов", callback_data="action_chats")
-    builder.button(text="🔙 Главное меню", callback_data="action_menu")
-    builder.adjust(1, 1, 1, 2)
+    history_buttons = add_history_buttons(builder, "chat_history", chat_id, history)
+    builder.button(text="🏠 Создать комнату", callback_data=callbacks.pack("create_room_from_chat", chat_id))
+    builder.button(text="📝 Добавить пометку", callback_data=callbacks.pack("add_note", chat['user_id']))
+    builder.button(text="👥 База заказчиков", callback_data=callbacks.pack("action_customers"))
+    builder.button(text="🔙 К списку чатов", callback_data=callbacks.pack("action_chats"))
+    builder.button(text="🔙 Главное меню", callback_data=callbacks.pack("action_menu"))
+    builder.adjust(*([1] * history_buttons), 1, 1, 1, 2)
+    
+    await callback.message.edit_text(
+        text,
+        parse_mode="HTML",
+        reply_markup=builder.as_markup()
+    )
+    await callback.answer()
+
+
+def chat_sender_label(msg: dict) -> str:
+    """Отправитель сообщения чата для истории"""
+    return "👤 <b>Пользователь:</b>" if msg['is_from_user'] else "👨‍💼 <b>Администратор:</b>"
+
+
+@callbacks.route("chat_history", int, str, int)
+async def process_chat_history(callback: CallbackQuery, chat_id: int, direction: str, message_id: int):
+    """Просмотр истории чата: страницы старше ('b') или новее ('a') сообщения message_id"""
+    if not await check_is_admin(callback.from_user.id):
+        await callback.answer("🚫 У вас нет прав для этого действия.", show_alert=True)
+        return
+    
+    chat = await db.get_chat_by_chat_id(chat_id)
+    if not chat:
+        await callback.answer("❌ Чат не найден", show_alert=True)
+        return
+    
+    if direction == 'a':
+        history = await db.get_chat_history(chat_id, after_id=message_id)
+    else:
+        history = await db.get_chat_history(chat_id, before_id=message_id)
+    if not history['messages']:
+        # Сообщения по курсору удалены - показываем последние
+        history = await db.get_chat_history(chat_id)
+    
+    text = f"📜 <b>История чата</b>\n"
+    text += f"🆔 <b>Пользователь ID:</b> <code>{chat['user_id']}</code>\n\n"
+    if history['messages']:
+        text += format_history(history['messages'], chat_sender_label)
+    else:
+        text += "📭 Пока нет сообщений в этом чате.\n\n"
+    
+    builder = InlineKeyboardBuilder()
+    history_buttons = add_history_buttons(builder, "chat_history", chat_id, history)
+    builder.button(text="🔙 К чату", callback_data=callbacks.pack("chat", chat_id))
+    builder.adjust(history_buttons or 1, 1)
     
     await callback.message.edit_text(
         text,
@@ -1047,14 +1309,13 @@ async def process_chat_view(callback: CallbackQuery):
     await callback.answer()
 
 
-@dp.callback_query(lambda c: c.data.startswith("create_room_from_chat_"))
-async def process_create_room_from_chat(callback: CallbackQuery):
+@callbacks.route("create_room_from_chat", int)
+async def process_create_room_from_chat(callback: CallbackQuery, chat_id: int):
     """Создание комнаты из чата"""
     if not await check_is_admin(callback.from_user.id):
         await callback.answer("🚫 У вас нет прав для этого действия.", show_alert=True)
         return
     
-    chat_id = int(callback.data.split("_")[-1])
     chat = await db.get_chat_by_chat_id(chat_id)
     
     if not chat:
@@ -1063,9 +1324,9 @@ async def process_create_room_from_chat(callback: CallbackQuery):
     
     # Показываем выбор роли для пользователя
     builder = InlineKeyboardBuilder()
-    builder.button(text="👤 Заказчик", callback_data=f"create_room_role_{chat['user_id']}_customer")
-    builder.button(text="👨‍💻 Разработчик", callback_data=f"create_room_role_{chat['user_id']}_developer")
-    builder.button(text="🔙 Назад", callback_data=f"chat_{chat_id}")
+    builder.button(text="👤 Заказчик", callback_data=callbacks.pack("create_room_role", chat['user_id'], "customer"))
+    builder.button(text="👨‍💻 Разработчик", callback_data=callbacks.pack("create_room_role", chat['user_id'], "developer"))
+    builder.button(text="🔙 Назад", callback_data=callbacks.pack("chat", chat_id))
     builder.adjust(2, 1)
     
     await callback.message.edit_text(
@@ -1078,18 +1339,14 @@ async def process_create_room_from_chat(callback: CallbackQuery):
     await callback.answer()
 
 
-@dp.callback_query(lambda c: c.data.startswith("create_room_role_"))
-async def process_create_room_role_selection(callback: CallbackQuery):
+@callbacks.route("create_room_role", int, str)
+async def process_create_room_role_selection(callback: CallbackQuery, target_user_id: int, role: str):
     """Выбор роли при создании комнаты из чата"""
     if not await check_is_admin(callback.from_user.id):
         await callback.answer("🚫 У вас нет прав для этого действия.", show_alert=True)
         return
     
-    parts = callback.data.split("_")
-    target_user_id = int(parts[3])
-    role = parts[4]  # customer или developer
-    
-    user_action_state[callback.from_user.id] = f'create_room_from_chat_{target_user_id}_{role}'
+    user_action_state[callback.from_user.id] = CreateRoomFromChat(target_user_id, role)
     
     role_name = "Заказчик" if role == 'customer' else "Разработчик"
     
@@ -1107,14 +1364,16 @@ async def process_create_room_role_selection(callback: CallbackQuery):
     await callback.answer()
 
 
-@dp.callback_query(lambda c: c.data == "action_customers")
-async def process_customers_button(callback: CallbackQuery):
-    """Обработка кнопки базы заказчиков"""
+@callbacks.route("action_customers")
+@customers_pages.route
+async def process_customers_button(callback: CallbackQuery, cursor: tuple = None, page_no: int = 1):
+    """Обработка кнопки базы заказчиков (постранично)"""
     if not await check_is_admin(callback.from_user.id):
         await callback.answer("🚫 У вас нет прав для этого действия.", show_alert=True)
         return
     
-    customers = await db.get_all_customers()
+    page = await db.get_customers_page(cursor)
+    customers = page['items']
     
     if not customers:
         await callback.message.edit_text(
@@ -1131,13 +1390,14 @@ async def process_customers_button(callback: CallbackQuery):
     for customer in customers:
         username = f"@{customer['username']}" if customer['username'] else "Без username"
         button_text = f"{username} - {customer['full_name'] or 'Без имени'}"
-        builder.button(text=button_text, callback_data=f"customer_{customer['user_id']}")
+        builder.button(text=button_text, callback_data=callbacks.pack("customer", customer['user_id']))
     
-    builder.button(text="🔙 Главное меню", callback_data="action_menu")
-    builder.adjust(1)
+    nav_buttons = customers_pages.add_buttons(builder, page, page_no)
+    builder.button(text="🔙 Главное меню", callback_data=callbacks.pack("action_menu"))
+    builder.adjust(*[1] * len(customers), nav_buttons or 1, 1)
     
     text = "👥 <b>База заказчиков</b>\n\n"
-    text += f"📊 Всего заказчиков: <b>{len(customers)}</b>\n\n"
+    text += f"📄 Страница <b>{page_no}</b>\n\n"
     text += "👇 Выберите заказчика для просмотра:"
     
     await callback.message.edit_text(
@@ -1148,22 +1408,19 @@ async def process_customers_button(callback: CallbackQuery):
     await callback.answer()
 
 
-@dp.callback_query(lambda c: c.data.startswith("customer_"))
-async def process_customer_view(callback: CallbackQuery):
+@callbacks.route("customer", int)
+async def process_customer_view(callback: CallbackQuery, user_id: int):
     """Просмотр информации о заказчике"""
     if not await check_is_admin(callback.from_user.id):
         await callback.answer("🚫 У вас нет прав для этого действия.", show_alert=True)
         return
     
-    user_id = int(callback.data.split("_")[1])
     customer = await db.get_customer_info(user_id)
     
     # Получаем информацию о пользователе
-    async with aiosqlite.connect(db.db_path) as db_conn:
-        async with db_conn.execute('SELECT username, full_name FROM users WHERE user_id = ?', (user_id,)) as cursor:
-            row = await cursor.fetchone()
-            username = row[0] if row else None
-            full_name = row[1] if row else "Без имени"
+    user_info = await db.get_user(user_id)
+    username = user_info['username'] if user_info else None
+    full_name = user_info['full_name'] if user_info else "Без имени"
     
     text = f"👤 <b>Информация о заказчике</b>\n\n"
     text += f"👤 <b>Имя:</b> {full_name}\n"
@@ -1183,11 +1440,11 @@ async def process_customer_view(callback: CallbackQuery):
         text += "💡 Заказчик еще не добавлен в базу с пометками."
     
     builder = InlineKeyboardBuilder()
-    builder.button(text="📝 Редактировать пометки", callback_data=f"edit_notes_{user_id}")
-    builder.button(text="🗑️ Удалить пометки", callback_data=f"delete_notes_{user_id}")
-    builder.button(text="💬 Открыть чат", callback_data=f"chat_from_customer_{user_id}")
-    builder.button(text="🔙 К списку заказчиков", callback_data="action_customers")
-    builder.button(text="🔙 Главное меню", callback_data="action_menu")
+    builder.button(text="📝 Редактировать пометки", callback_data=callbacks.pack("edit_notes", user_id))
+    builder.button(text="🗑️ Удалить пометки", callback_data=callbacks.pack("delete_notes", user_id))
+    builder.button(text="💬 Открыть чат", callback_data=callbacks.pack("chat_from_customer", user_id))
+    builder.button(text="🔙 К списку заказчиков", callback_data=callbacks.pack("action_customers"))
+    builder.button(text="🔙 Главное меню", callback_data=callbacks.pack("action_menu"))
     builder.adjust(1, 1, 1, 2)
     
     await callback.message.edit_text(
@@ -1198,15 +1455,14 @@ async def process_customer_view(callback: CallbackQuery):
     await callback.answer()
 
 
-@dp.callback_query(lambda c: c.data.startswith("edit_notes_"))
-async def process_edit_notes(callback: CallbackQuery):
+@callbacks.route("edit_notes", int)
+async def process_edit_notes(callback: CallbackQuery, user_id: int):
     """Редактирование пометок о заказчике"""
     if not await check_is_admin(callback.from_user.id):
         await callback.answer("🚫 У вас нет прав для этого действия.", show_alert=True)
         return
     
-    user_id = int(callback.data.split("_")[2])
-    user_action_state[callback.from_user.id] = f'edit_notes_{user_id}'
+    user_action_state[callback.from_user.id] = EditNotes(user_id)
     
     customer = await db.get_customer_info(user_id)
     current_notes = customer['notes'] if customer and customer['notes'] else ""
@@ -1224,34 +1480,30 @@ async def process_edit_notes(callback: CallbackQuery):
     await callback.answer()
 
 
-@dp.callback_query(lambda c: c.data.startswith("delete_notes_"))
-async def process_delete_notes(callback: CallbackQuery):
+@callbacks.route("delete_notes", int)
+async def process_delete_notes(callback: CallbackQuery, user_id: int):
     """Удаление пометок о заказчике"""
     if not await check_is_admin(callback.from_user.id):
         await callback.answer("🚫 У вас нет прав для этого действия.", show_alert=True)
         return
     
-    user_id = int(callback.data.split("_")[2])
-    
     # Удаляем пометки (устанавливаем в NULL)
     await db.update_customer_notes(user_id, "")
     
     await callback.answer("🗑️ Пометки удалены", show_alert=True)
     
     # Обновляем информацию о заказчике
-    callback.data = f"customer_{user_id}"
-    await process_customer_view(callback)
+    await process_customer_view(callback, user_id)
 
 
-@dp.callback_query(lambda c: c.data.startswith("add_note_"))
-async def process_add_note(callback: CallbackQuery):
+@callbacks.route("add_note", int)
+async def process_add_note(callback: CallbackQuery, user_id: int):
     """Добавление пометки о заказчике"""
     if not await check_is_admin(callback.from_user.id):
         await callback.answer("🚫 У вас нет прав для этого действия.", show_alert=True)
         return
     
-    user_id = int(callback.data.split("_")[2])
-    user_action_state[callback.from_user.id] = f'edit_notes_{user_id}'
+    user_action_state[callback.from_user.id] = EditNotes(user_id)
     
     customer = await db.get_customer_info(user_id)
     current_notes = customer['notes'] if customer and customer['notes'] else ""
@@ -1268,14 +1520,13 @@ async def process_add_note(callback: CallbackQuery):
     await callback.answer()
 
 
-@dp.callback_query(lambda c: c.data.startswith("chat_from_customer_"))
-async def process_chat_from_customer(callback: CallbackQuery):
+@callbacks.route("chat_from_customer", int)
+async def process_chat_from_customer(callback: CallbackQuery, user_id: int):
     """Открытие чата из базы заказчиков"""
     if not await check_is_admin(callback.from_user.id):
         await callback.answer("🚫 У вас нет прав для этого действия.", show_alert=True)
         return
     
-    user_id = int(callback.data.split("_")[3])
     chat = await db.get_chat_by_user_id(user_id)
     
     if not chat:
@@ -1284,12 +1535,11 @@ async def process_chat_from_customer(callback: CallbackQuery):
     else:
         chat_id = chat['chat_id']
     
-    # Вызываем process_chat_view напрямую, изменяя callback.data
-    callback.data = f'chat_{chat_id}'
-    await process_chat_view(callback)
+    # Показываем чат напрямую
+    await process_chat_view(callback, chat_id)
 
 
-@dp.callback_query(lambda c: c.data == "action_notifications")
+@callbacks.route("action_notifications")
 async def process_notifications_button(callback: CallbackQuery):
     """Обработка кнопки управления уведомлениями"""
     if not await check_is_admin(callback.from_user.id):
@@ -1314,9 +1564,9 @@ async def process_notifications_button(callback: CallbackQuery):
     for room in rooms:
         status_emoji = "🔔" if room['enabled'] else "🔕"
         button_text = f"{status_emoji} {room['room_name']}"
-        builder.button(text=button_text, callback_data=f"toggle_notification_{room['room_id']}")
+        builder.button(text=button_text, callback_data=callbacks.pack("toggle_notification", room['room_id']))
     
-    builder.button(text="🔙 Главное меню", callback_data="action_menu")
+    builder.button(text="🔙 Главное меню", callback_data=callbacks.pack("action_menu"))
     builder.adjust(1)
     
     enabled_count = sum(1 for r in rooms if r['enabled'])
@@ -1336,14 +1586,13 @@ async def process_notifications_button(callback: CallbackQuery):
     await callback.answer()
 
 
-@dp.callback_query(lambda c: c.data.startswith("toggle_notification_"))
-async def process_toggle_notification(callback: CallbackQuery):
+@callbacks.route("toggle_notification", int)
+async def process_toggle_notification(callback: CallbackQuery, room_id: int):
     """Переключение уведомлений для комнаты"""
     if not await check_is_admin(callback.from_user.id):
         await callback.answer("🚫 У вас нет прав для этого действия.", show_alert=True)
         return
     
-    room_id = int(callback.data.split("_")[2])
     user_id = callback.from_user.id
     
     # Получаем текущее состояние
@@ -1370,7 +1619,7 @@ async def process_toggle_notification(callback: CallbackQuery):
 
 
 # Обработчики для отзывов
-@dp.callback_query(lambda c: c.data == "action_add_review")
+@callbacks.route("action_add_review")
 async def process_add_review_button(callback: CallbackQuery):
     """Обработка кнопки 'Оставить отзыв'"""
     user_id = callback.from_user.id
@@ -1415,21 +1664,23 @@ async def process_add_review_button(callback: CallbackQuery):
         
         builder.button(
             text=f"⭐ {order['room_name'][:30]}",
-            callback_data=f"add_review_{order['room_id']}"
+            callback_data=callbacks.pack("add_review", order['room_id'])
         )
     
-    builder.button(text="🔙 Главное меню", callback_data="action_menu")
+    builder.button(text="🔙 Главное меню", callback_data=callbacks.pack("action_menu"))
     builder.adjust(1)
     
     await callback.message.edit_text(text, parse_mode="HTML", reply_markup=builder.as_markup())
     await callback.answer()
 
 
-@dp.callback_query(lambda c: c.data == "action_reviews")
-async def process_reviews_button(callback: CallbackQuery):
-    """Обработка кнопки отзывов"""
+@callbacks.route("action_reviews")
+@reviews_pages.route
+async def process_reviews_button(callback: CallbackQuery, cursor: tuple = None, page_no: int = 1):
+    """Обработка кнопки отзывов (постранично)"""
     user_id = callback.from_user.id
-    reviews = await db.get_all_reviews()
+    page = await db.get_reviews_page(cursor)
+    reviews = page['items']
     
     # Проверяем, есть ли у пользователя закрытые заказы для отзыва
     closed_orders = await db.get_customer_closed_orders(user_id)
@@ -1448,19 +1699,18 @@ async def process_reviews_button(callback: CallbackQuery):
         
         builder = InlineKeyboardBuilder()
         if can_write_review:
-            builder.button(text="✍️ Написать отзыв", callback_data="action_add_review")
-        builder.button(text="🔙 Главное меню", callback_data="action_menu")
+            builder.button(text="✍️ Написать отзыв", callback_data=callbacks.pack("action_add_review"))
+        builder.button(text="🔙 Главное меню", callback_data=callbacks.pack("action_menu"))
         builder.adjust(1) if can_write_review else builder.adjust(1)
         await callback.message.edit_text(text, parse_mode="HTML", reply_markup=builder.as_markup())
         await callback.answer()
         return
     
     text = f"⭐ <b>Отзывы</b>\n\n"
-    text += f"📊 Всего отзывов: <b>{len(reviews)}</b>\n\n"
+    text += f"📄 Страница <b>{page_no}</b>\n\n"
     text += "━━━━━━━━━━━━━━━━━━━━\n\n"
     
-    # Показываем первые 10 отзывов
-    for idx, review in enumerate(reviews[:10], 1):
+    for idx, review in enumerate(reviews, (page_no - 1) * LIST_PAGE_SIZE + 1):
         text += f"<b>{idx}. Отзыв от {review['full_name'] or 'Пользователь'}</b>\n"
         if review['room_name']:
             text += f"🏠 Комната: {review['room_name']}\n"
@@ -1471,28 +1721,26 @@ async def process_reviews_button(callback: CallbackQuery):
         text += "━━━━━━━━━━━━━━━━━━━━\n\n"
     
     builder = InlineKeyboardBuilder()
-    for review in reviews[:10]:
+    for review in reviews:
         username = f"@{review['username']}" if review['username'] else f"ID:{review['user_id']}"
         builder.button(
             text=f"⭐ {username} - {review['created_at'][:10]}",
-            callback_data=f"review_{review['review_id']}"
+            callback_data=callbacks.pack("review", review['review_id'])
         )
     
+    nav_buttons = reviews_pages.add_buttons(builder, page, page_no)
     if can_write_review:
-        builder.button(text="✍️ Написать отзыв", callback_data="action_add_review")
-    builder.button(text="🔙 Главное меню", callback_data="action_menu")
-    builder.adjust(1)
+        builder.button(text="✍️ Написать отзыв", callback_data=callbacks.pack("action_add_review"))
+    builder.button(text="🔙 Главное меню", callback_data=callbacks.pack("action_menu"))
+    builder.adjust(*[1] * len(reviews), nav_buttons or 1, 1)
     
     await callback.message.edit_text(text, parse_mode="HTML", reply_markup=builder.as_markup())
     await callback.answer()
 
 
-@dp.callback_query(lambda c: c.data.startswith("add_review_") and 
-                   not c.data.startswith("action_add_review") and
-                   len(c.data.split("_")) == 3)
-async def process_add_review_select(callback: CallbackQuery):
+@callbacks.route("add_review", int)
+async def process_add_review_select(callback: CallbackQuery, room_id: int):
     """Обработка выбора заказа для отзыва"""
-    room_id = int(callback.data.split("_")[2])
     
     # Проверяем, является ли пользователь клиентом этого заказа
     closed_orders = await db.get_customer_closed_orders(callback.from_user.id)
@@ -1510,8 +1758,7 @@ async def process_add_review_select(callback: CallbackQuery):
     room = await db.get_room(room_id)
     if not room:
         # Если комнаты нет, используем данные из истории
-        history = await db.get_order_history()
-        order_history = next((h for h in history if h['room_id'] == room_id), None)
+        order_history = await db.get_order_history_by_room(room_id)
         if not order_history:
             await callback.answer("❌ Заказ не найден.", show_alert=True)
             return
@@ -1520,7 +1767,7 @@ async def process_add_review_select(callback: CallbackQuery):
         room_name = room['room_name']
     
     # Устанавливаем состояние для добавления отзыва
-    user_action_state[callback.from_user.id] = f'add_review_{room_id}'
+    user_action_state[callback.from_user.id] = AddReview(room_id)
     
     await callback.message.edit_text(
         "⭐ <b>Оставить отзыв</b>\n\n"
@@ -1533,13 +1780,9 @@ async def process_add_review_select(callback: CallbackQuery):
     await callback.answer()
 
 
-@dp.callback_query(lambda c: c.data.startswith("review_") and 
-                   not c.data.startswith("review_reply_") and 
-                   not c.data.startswith("review_delete_") and
-                   len(c.data.split("_")) == 2)
-async def process_review_view(callback: CallbackQuery):
+@callbacks.route("review", int)
+async def process_review_view(callback: CallbackQuery, review_id: int):
     """Просмотр отзыва"""
-    review_id = int(callback.data.split("_")[1])
     review = await db.get_review(review_id)
     
     if not review:
@@ -1547,11 +1790,9 @@ async def process_review_view(callback: CallbackQuery):
         return
     
     # Получаем информацию о пользователе
-    async with aiosqlite.connect(db.db_path) as db_conn:
-        async with db_conn.execute('SELECT username, full_name FROM users WHERE user_id = ?', (review['user_id'],)) as cursor:
-            row = await cursor.fetchone()
-            username = row[0] if row else None
-            full_name = row[1] if row else "Без имени"
+    user_info = await db.get_user(review['user_id'])
+    username = user_info['username'] if user_info else None
+    full_name = user_info['full_name'] if user_info else "Без имени"
     
     text = f"⭐ <b>Отзыв</b>\n\n"
     text += f"👤 <b>Автор:</b> {full_name}\n"
@@ -1573,26 +1814,25 @@ async def process_review_view(callback: CallbackQuery):
     
     if is_admin:
         if not review['admin_reply']:
-            builder.button(text="✏️ Ответить на отзыв", callback_data=f"review_reply_{review_id}")
-        builder.button(text="🗑️ Удалить отзыв", callback_data=f"review_delete_{review_id}")
+            builder.button(text="✏️ Ответить на отзыв", callback_data=callbacks.pack("review_reply", review_id))
+        builder.button(text="🗑️ Удалить отзыв", callback_data=callbacks.pack("review_delete", review_id))
     
-    builder.button(text="🔙 К списку отзывов", callback_data="action_reviews")
-    builder.button(text="🔙 Главное меню", callback_data="action_menu")
+    builder.button(text="🔙 К списку отзывов", callback_data=callbacks.pack("action_reviews"))
+    builder.button(text="🔙 Главное меню", callback_data=callbacks.pack("action_menu"))
     builder.adjust(1, 1, 2) if is_admin else builder.adjust(1, 1)
     
     await callback.message.edit_text(text, parse_mode="HTML", reply_markup=builder.as_markup())
     await callback.answer()
 
 
-@dp.callback_query(lambda c: c.data.startswith("review_reply_"))
-async def process_review_reply(callback: CallbackQuery):
+@callbacks.route("review_reply", int)
+async def process_review_reply(callback: CallbackQuery, review_id: int):
     """Обработка ответа на отзыв"""
     if not await check_is_admin(callback.from_user.id):
         await callback.answer("🚫 У вас нет прав для этого действия.", show_alert=True)
         return
     
-    review_id = int(callback.data.split("_")[2])
-    user_action_state[callback.from_user.id] = f'review_reply_{review_id}'
+    user_action_state[callback.from_user.id] = ReviewReply(review_id)
     
     await callback.message.edit_text(
         "✏️ <b>Ответ на отзыв</b>\n\n"
@@ -1604,32 +1844,32 @@ async def process_review_reply(callback: CallbackQuery):
     await callback.answer()
 
 
-@dp.callback_query(lambda c: c.data.startswith("review_delete_"))
-async def process_review_delete(callback: CallbackQuery):
+@callbacks.route("review_delete", int)
+async def process_review_delete(callback: CallbackQuery, review_id: int):
     """Удаление отзыва"""
     if not await check_is_admin(callback.from_user.id):
         await callback.answer("🚫 У вас нет прав для этого действия.", show_alert=True)
         return
     
-    review_id = int(callback.data.split("_")[2])
     await db.delete_review(review_id)
     
     await callback.answer("🗑️ Отзыв удален", show_alert=True)
     
     # Возвращаемся к списку отзывов
-    callback.data = "action_reviews"
     await process_reviews_button(callback)
 
 
 # Обработчики для истории заказов
-@dp.callback_query(lambda c: c.data == "action_order_history")
-async def process_order_history_button(callback: CallbackQuery):
-    """Обработка кнопки истории заказов"""
+@callbacks.route("action_order_history")
+@history_pages.route
+async def process_order_history_button(callback: CallbackQuery, cursor: tuple = None, page_no: int = 1):
+    """Обработка кнопки истории заказов (постранично)"""
     if not await check_is_admin(callback.from_user.id):
         await callback.answer("🚫 У вас нет прав для этого действия.", show_alert=True)
         return
     
-    history = await db.get_order_history()
+    page = await db.get_order_history_page(cursor)
+    history = page['items']
     
     if not history:
         text = (
@@ -1638,17 +1878,16 @@ async def process_order_history_button(callback: CallbackQuery):
             "💡 Закрытые заказы будут отображаться здесь."
         )
         builder = InlineKeyboardBuilder()
-        builder.button(text="🔙 Главное меню", callback_data="action_menu")
+        builder.button(text="🔙 Главное меню", callback_data=callbacks.pack("action_menu"))
         await callback.message.edit_text(text, parse_mode="HTML", reply_markup=builder.as_markup())
         await callback.answer()
         return
     
     text = f"📜 <b>История заказов</b>\n\n"
-    text += f"📊 Всего закрытых заказов: <b>{len(history)}</b>\n\n"
+    text += f"📄 Страница <b>{page_no}</b>\n\n"
     text += "━━━━━━━━━━━━━━━━━━━━\n\n"
     
-    # Показываем первые 10 заказов
-    for idx, order in enumerate(history[:10], 1):
+    for idx, order in enumerate(history, (page_no - 1) * LIST_PAGE_SIZE + 1):
         text += f"<b>{idx}. {order['room_name']}</b>\n"
         if order['customer_name']:
             text += f"👤 Заказчик: {order['customer_name']}\n"
@@ -1658,29 +1897,28 @@ async def process_order_history_button(callback: CallbackQuery):
         text += "━━━━━━━━━━━━━━━━━━━━\n\n"
     
     builder = InlineKeyboardBuilder()
-    for order in history[:10]:
+    for order in history:
         builder.button(
             text=f"📜 {order['room_name'][:30]}",
-            callback_data=f"order_history_{order['history_id']}"
+            callback_data=callbacks.pack("order_history", order['history_id'])
         )
     
-    builder.button(text="🔙 Главное меню", callback_data="action_menu")
-    builder.adjust(1)
+    nav_buttons = history_pages.add_buttons(builder, page, page_no)
+    builder.button(text="🔙 Главное меню", callback_data=callbacks.pack("action_menu"))
+    builder.adjust(*[1] * len(history), nav_buttons or 1, 1)
     
     await callback.message.edit_text(text, parse_mode="HTML", reply_markup=builder.as_markup())
     await callback.answer()
 
 
-@dp.callback_query(lambda c: c.data.startswith("order_history_"))
-async def process_order_history_view(callback: CallbackQuery):
+@callbacks.route("order_history", int)
+async def process_order_history_view(callback: CallbackQuery, history_id: int):
     """Просмотр заказа из истории"""
     if not await check_is_admin(callback.from_user.id):
         await callback.answer("🚫 У вас нет прав для этого действия.", show_alert=True)
         return
     
-    history_id = int(callback.data.split("_")[2])
-    history_list = await db.get_order_history()
-    order = next((h for h in history_list if h['history_id'] == history_id), None)
+    order = await db.get_order_history_entry(history_id)
     
     if not order:
         await callback.answer("❌ Заказ не найден.", show_alert=True)
@@ -1711,51 +1949,141 @@ async def process_order_history_view(callback: CallbackQuery):
     text += f"📅 <b>Создан:</b> {order['room_created_at']}\n"
     text += f"📅 <b>Закрыт:</b> {order['closed_at']}\n"
     
+    # Переписка заказа: из архива, если она уже перенесена, иначе из основной базы
+    archive = await db.get_room_archive_info(order['room_id'])
+    if archive:
+        text += f"📦 <b>Переписка в архиве:</b> {archive['message_count']} сообщений\n"
+    
     builder = InlineKeyboardBuilder()
-    builder.button(text="🗑️ Окончательно удалить", callback_data=f"order_history_delete_{history_id}")
-    builder.button(text="🔙 К истории заказов", callback_data="action_order_history")
-    builder.button(text="🔙 Главное меню", callback_data="action_menu")
-    builder.adjust(1, 2)
+    layout = (1, 2)
+    if archive:
+        builder.button(text="📦 Переписка (архив)", callback_data=callbacks.pack("archive_history", history_id))
+        layout = (1, 1, 2)
+    elif await db.get_room(order['room_id']):
+        builder.button(text="📜 Переписка", callback_data=callbacks.pack("room_history", order['room_id']))
+        layout = (1, 1, 2)
+    builder.button(text="🗑️ Окончательно удалить", callback_data=callbacks.pack("order_history_delete", history_id))
+    builder.button(text="🔙 К истории заказов", callback_data=callbacks.pack("action_order_history"))
+    builder.button(text="🔙 Главное меню", callback_data=callbacks.pack("action_menu"))
+    builder.adjust(*layout)
     
     await callback.message.edit_text(text, parse_mode="HTML", reply_markup=builder.as_markup())
     await callback.answer()
 
 
-@dp.callback_query(lambda c: c.data.startswith("order_history_delete_"))
-async def process_order_history_delete(callback: CallbackQuery):
+@callbacks.route("archive_history", int)
+@callbacks.route("archive_history_page", int, str, int)
+async def process_archive_history(callback: CallbackQuery, history_id: int, direction: str = None, message_id: int = None):
+    """Просмотр архивной переписки заказа из истории"""
+    if not await check_is_admin(callback.from_user.id):
+        await callback.answer("🚫 У вас нет прав для этого действия.", show_alert=True)
+        return
+    
+    order = await db.get_order_history_entry(history_id)
+    if not order:
+        await callback.answer("❌ Заказ не найден.", show_alert=True)
+        return
+    room_id = order['room_id']
+    
+    if direction == 'a':
+        history = await db.get_archived_room_history(room_id, after_id=message_id)
+    elif direction == 'b':
+        history = await db.get_archived_room_history(room_id, before_id=message_id)
+    else:
+        history = await db.get_archived_room_history(room_id)
+    if not history['messages'] and direction is not None:
+        history = await db.get_archived_room_history(room_id)
+    
+    # Имена отправителей - из участников комнаты, если они еще есть
+    members = {member['user_id']: member for member in await db.get_room_members(room_id)}
+    
+    def sender_label(msg: dict) -> str:
+        member = members.get(msg['sender_id'])
+        name = (member['full_name'] or member['username']) if member else None
+        if not name:
+            name = f"ID {msg['sender_id']}"
+        role_emoji = "👤" if msg['is_from_customer'] else "👨‍💻"
+        return f"{role_emoji} <b>{html.escape(name)}:</b>"
+    
+    text = f"📦 <b>Архив переписки</b> {html.escape(order['room_name'])}\n\n"
+    if history['messages']:
+        text += format_history(history['messages'], sender_label)
+    else:
+        text += "📭 В архиве нет сообщений этого заказа.\n\n"
+    
+    builder = InlineKeyboardBuilder()
+    history_buttons = add_history_buttons(builder, "archive_history_page", history_id, history)
+    builder.button(text="🔙 К заказу", callback_data=callbacks.pack("order_history", history_id))
+    builder.adjust(history_buttons or 1, 1)
+    
+    await callback.message.edit_text(
+        text,
+        parse_mode="HTML",
+        reply_markup=builder.as_markup()
+    )
+    await callback.answer()
+
+
+@callbacks.route("order_history_delete", int)
+async def process_order_history_delete(callback: CallbackQuery, history_id: int):
     """Окончательное удаление заказа из истории"""
     if not await check_is_admin(callback.from_user.id):
         await callback.answer("🚫 У вас нет прав для этого действия.", show_alert=True)
         return
     
-    history_id = int(callback.data.split("_")[3])
     await db.delete_from_order_history(history_id)
     
     await callback.answer("🗑️ Заказ окончательно удален", show_alert=True)
     
     # Возвращаемся к истории заказов
-    callback.data = "action_order_history"
     await process_order_history_button(callback)
 
 
 # Обработчики для закрытия заказа
-@dp.callback_query(lambda c: c.data.startswith("room_close_") and 
-                   not c.data.startswith("room_close_confirm_"))
-async def process_room_close(callback: CallbackQuery):
+@callbacks.route("room_close", int)
+async def process_room_close(callback: CallbackQuery, room_id: int):
     """Обработка закрытия заказа администратором"""
     if not await check_is_admin(callback.from_user.id):
         await callback.answer("🚫 У вас нет прав для этого действия.", show_alert=True)
         return
     
-    room_id = int(callback.data.split("_")[2])
     room = await db.get_room(room_id)
     
     if not room:
         await callback.answer("❌ Комната не найдена.", show_alert=True)
         return
     
-    # Перемещаем в историю
-    await db.add_to_order_history(room_id, callback.from_user.id)
+    # Уведомляем всех участников
+    members = await db.get_room_members(room_id)
+    entries = outbox_entries(
+        [member['user_id'] for member in members],
+        [('send_message', {
+            'text': f"✅ <b>Заказ закрыт</b>\n\n"
+                    f"🏠 Комната: <b>{room['room_name']}</b>\n\n"
+                    f"💡 Заказ был закрыт администратором и перемещен в историю.",
+            'parse_mode': "HTML"
+        })]
+    )
+    
+    # Предлагаем клиенту оставить отзыв
+    customer_id = next((member['user_id'] for member in members if member['access_type'] == 'customer'), None)
+    if customer_id:
+        builder = InlineKeyboardBuilder()
+        builder.button(text="⭐ Оставить отзыв", callback_data=callbacks.pack("add_review", room_id))
+        builder.button(text="🔙 Главное меню", callback_data=callbacks.pack("action_menu"))
+        builder.adjust(1, 1)
+        
+        entries += outbox_entries([customer_id], [('send_message', {
+            'text': f"✅ <b>Заказ закрыт</b>\n\n"
+                    f"🏠 Комната: <b>{room['room_name']}</b>\n\n"
+                    f"⭐ <b>Оставить отзыв</b>\n\n"
+                    f"💬 Поделитесь вашим мнением о работе или нажмите кнопку ниже:",
+            'parse_mode': "HTML",
+            'reply_markup': builder.as_markup().model_dump(exclude_none=True)
+        })])
+    
+    # Перемещаем в историю вместе с уведомлениями (outbox) одной транзакцией
+    await db.add_to_order_history(room_id, callback.from_user.id, outbox=entries)
     
     # Удаляем из активных комнат
     if callback.from_user.id in user_active_rooms:
@@ -1764,47 +2092,7 @@ async def process_room_close(callback: CallbackQuery):
     await callback.answer("✅ Заказ закрыт и перемещен в историю", show_alert=True)
     
     # Удаляем из активных комнат всех пользователей этой комнаты
-    users_to_remove = [uid for uid, rid in user_active_rooms.items() if rid == room_id]
-    for uid in users_to_remove:
-        del user_active_rooms[uid]
-    
-    # Уведомляем всех участников
-    members = await db.get_room_members(room_id)
-    customer_id = None
-    for member in members:
-        try:
-            await bot.send_message(
-                member['user_id'],
-                f"✅ <b>Заказ закрыт</b>\n\n"
-                f"🏠 Комната: <b>{room['room_name']}</b>\n\n"
-                f"💡 Заказ был закрыт администратором и перемещен в историю.",
-                parse_mode="HTML"
-            )
-            # Находим клиента
-            if member['access_type'] == 'customer':
-                customer_id = member['user_id']
-        except:
-            pass
-    
-    # Предлагаем клиенту оставить отзыв
-    if customer_id:
-        try:
-            builder = InlineKeyboardBuilder()
-            builder.button(text="⭐ Оставить отзыв", callback_data=f"add_review_{room_id}")
-            builder.button(text="🔙 Главное меню", callback_data="action_menu")
-            builder.adjust(1, 1)
-            
-            await bot.send_message(
-                customer_id,
-                f"✅ <b>Заказ закрыт</b>\n\n"
-                f"🏠 Комната: <b>{room['room_name']}</b>\n\n"
-                f"⭐ <b>Оставить отзыв</b>\n\n"
-                f"💬 Поделитесь вашим мнением о работе или нажмите кнопку ниже:",
-                parse_mode="HTML",
-                reply_markup=builder.as_markup()
-            )
-        except:
-            pass
+    user_active_rooms.clear_room(room_id)
     
     # Возвращаемся в главное меню
     text = (
@@ -1814,10 +2102,9 @@ async def process_room_close(callback: CallbackQuery):
     await callback.message.edit_text(text, parse_mode="HTML", reply_markup=get_admin_keyboard())
 
 
-@dp.callback_query(lambda c: c.data.startswith("room_close_confirm_"))
-async def process_room_close_confirm(callback: CallbackQuery):
+@callbacks.route("room_close_confirm", int)
+async def process_room_close_confirm(callback: CallbackQuery, room_id: int):
     """Подтверждение закрытия заказа клиентом"""
-    room_id = int(callback.data.split("_")[3])
     room = await db.get_room(room_id)
     
     if not room:
@@ -1831,47 +2118,36 @@ async def process_room_close_confirm(callback: CallbackQuery):
         return
     
     # Проверяем, не закрыта ли комната уже
-    try:
-        from config import DATABASE_PATH
-        async with aiosqlite.connect(DATABASE_PATH) as conn:
-            async with conn.execute('SELECT COUNT(*) FROM order_history WHERE room_id = ?', (room_id,)) as cursor:
-                result = await cursor.fetchone()
-                if result and result[0] > 0:
-                    await callback.answer("⚠️ Этот заказ уже закрыт.", show_alert=True)
-                    return
-    except:
-        pass
-    
-    # Перемещаем в историю
-    await db.add_to_order_history(room_id, callback.from_user.id)
-    
-    # Удаляем из активных комнат всех пользователей этой комнаты
-    users_to_remove = [uid for uid, rid in user_active_rooms.items() if rid == room_id]
-    for uid in users_to_remove:
-        del user_active_rooms[uid]
+    if await db.is_room_in_order_history(room_id):
+        await callback.answer("⚠️ Этот заказ уже закрыт.", show_alert=True)
+        return
     
     # Уведомляем всех участников
     members = await db.get_room_members(room_id)
     customer_name = callback.from_user.full_name or callback.from_user.username or f"ID: {callback.from_user.id}"
-    for member in members:
-        try:
-            await bot.send_message(
-                member['user_id'],
-                f"✅ <b>Заказ закрыт</b>\n\n"
-                f"🏠 Комната: <b>{room['room_name']}</b>\n\n"
-                f"👤 Закрыл клиент: <b>{customer_name}</b>\n\n"
-                f"💡 Заказ был закрыт клиентом и перемещен в историю.",
-                parse_mode="HTML"
-            )
-        except:
-            pass
+    entries = outbox_entries(
+        [member['user_id'] for member in members],
+        [('send_message', {
+            'text': f"✅ <b>Заказ закрыт</b>\n\n"
+                    f"🏠 Комната: <b>{room['room_name']}</b>\n\n"
+                    f"👤 Закрыл клиент: <b>{customer_name}</b>\n\n"
+                    f"💡 Заказ был закрыт клиентом и перемещен в историю.",
+            'parse_mode': "HTML"
+        })]
+    )
+    
+    # Перемещаем в историю вместе с уведомлениями (outbox) одной транзакцией
+    await db.add_to_order_history(room_id, callback.from_user.id, outbox=entries)
+    
+    # Удаляем из активных комнат всех пользователей этой комнаты
+    user_active_rooms.clear_room(room_id)
     
     # Предлагаем оставить отзыв
-    user_action_state[callback.from_user.id] = f'add_review_{room_id}'
+    user_action_state[callback.from_user.id] = AddReview(room_id)
     
     builder = InlineKeyboardBuilder()
-    builder.button(text="⭐ Оставить отзыв", callback_data=f"add_review_{room_id}")
-    builder.button(text="🔙 Главное меню", callback_data="action_menu")
+    builder.button(text="⭐ Оставить отзыв", callback_data=callbacks.pack("add_review", room_id))
+    builder.button(text="🔙 Главное меню", callback_data=callbacks.pack("action_menu"))
     builder.adjust(1, 1)
     
     await callback.message.edit_text(
@@ -1885,7 +2161,7 @@ async def process_room_close_confirm(callback: CallbackQuery):
     await callback.answer("✅ Заказ закрыт!")
 
 
-@dp.callback_query(lambda c: c.data == "action_refresh")
+@callbacks.route("action_refresh")
 async def process_refresh_button(callback: CallbackQuery):
     """Обработка кнопки обновления меню"""
     user_id = callback.from_user.id
@@ -1906,37 +2182,19 @@ async def process_refresh_button(callback: CallbackQuery):
     await callback.answer("🔄 Меню обновлено")
 
 
-@dp.callback_query(lambda c: c.data.startswith("room_") and 
-                   not c.data.startswith("room_manage_") and
-                   not c.data.startswith("room_edit_") and
-                   not c.data.startswith("room_add_access_") and
-                   not c.data.startswith("room_members_") and
-                   not c.data.startswith("room_delete_") and
-                   not c.data.startswith("room_change_role_") and
-                   not c.data.startswith("room_remove_member_") and
-                   not c.data.startswith("room_role_") and
-                   len(c.data.split("_")) == 2)
-async def process_room_selection(callback: CallbackQuery):
+@callbacks.route("room", int)
+async def process_room_selection(callback: CallbackQuery, room_id: int):
     """Обработка выбора комнаты"""
-    room_id = int(callback.data.split("_")[1])
     user_id = callback.from_user.id
     is_user_admin = await check_is_admin(user_id)
     
-    # Проверяем доступ (админы видят все комнаты и автоматически получают доступ)
-    if not is_user_admin:
-        rooms = await db.get_user_rooms(user_id, False)
-        if not any(r['room_id'] == room_id for r in rooms):
-            await callback.answer(
-                "🚫 У вас нет доступа к этой комнате.",
-                show_alert=True
-            )
-            return
-    else:
-        # Администратор автоматически получает доступ к комнате, если его еще нет
-        rooms = await db.get_user_rooms(user_id, True)
-        if not any(r['room_id'] == room_id for r in rooms):
-            # Добавляем администратора в комнату с ролью developer
-            await db.add_room_access(room_id, user_id, 'developer')
+    # Проверяем доступ (админы видят все комнаты)
+    if not is_user_admin and not await db.has_room_access(room_id, user_id):
+        await callback.answer(
+            "🚫 У вас нет доступа к этой комнате.",
+            show_alert=True
+        )
+        return
     
     # Устанавливаем активную комнату
     user_active_rooms[user_id] = room_id
@@ -1977,14 +2235,15 @@ async def process_room_selection(callback: CallbackQuery):
             builder = InlineKeyboardBuilder()
             
             # Кнопки быстрого управления
-            builder.button(text="✏️ Изменить название", callback_data=f"room_edit_{room_id}")
-            builder.button(text="➕ Добавить участника", callback_data=f"room_add_access_{room_id}")
-            builder.button(text="👥 Управление участниками", callback_data=f"room_members_{room_id}")
-            builder.button(text="✅ Закрыть заказ", callback_data=f"room_close_{room_id}")
-            builder.button(text="🗑️ Удалить комнату", callback_data=f"room_delete_{room_id}")
-            builder.button(text="🔙 Главное меню", callback_data="action_menu")
-            builder.button(text="🚪 Выйти из комнаты", callback_data="action_exit_room")
-            builder.adjust(2, 2, 1, 2)
+            builder.button(text="✏️ Изменить название", callback_data=callbacks.pack("room_edit", room_id))
+            builder.button(text="➕ Добавить участника", callback_data=callbacks.pack("room_add_access", room_id))
+            builder.button(text="👥 Управление участниками", callback_data=callbacks.pack("room_members", room_id))
+            builder.button(text="✅ Закрыть заказ", callback_data=callbacks.pack("room_close", room_id))
+            builder.button(text="🗑️ Удалить комнату", callback_data=callbacks.pack("room_delete", room_id))
+            builder.button(text="📜 История сообщений", callback_data=callbacks.pack("room_history", room_id))
+            builder.button(text="🔙 Главное меню", callback_data=callbacks.pack("action_menu"))
+            builder.button(text="🚪 Выйти из комнаты", callback_data=callbacks.pack("action_exit_room"))
+            builder.adjust(2, 2, 2, 2)
         else:
             # Обычный интерфейс для пользователя
             text = f"✅ <b>Вы вошли в комнату!</b>\n\n"
@@ -2002,11 +2261,12 @@ async def process_room_selection(callback: CallbackQuery):
             is_customer = user_access and user_access.get('access_type') == 'customer'
             
             if is_customer:
-                builder.button(text="✅ Закрыть заказ", callback_data=f"room_close_confirm_{room_id}")
+                builder.button(text="✅ Закрыть заказ", callback_data=callbacks.pack("room_close_confirm", room_id))
             
-            builder.button(text="🔙 Главное меню", callback_data="action_menu")
-            builder.button(text="🚪 Выйти из комнаты", callback_data="action_exit_room")
-            builder.adjust(1, 2) if is_customer else builder.adjust(2)
+            builder.button(text="📜 История сообщений", callback_data=callbacks.pack("room_history", room_id))
+            builder.button(text="🔙 Главное меню", callback_data=callbacks.pack("action_menu"))
+            builder.button(text="🚪 Выйти из комнаты", callback_data=callbacks.pack("action_exit_room"))
+            builder.adjust(1, 1, 2) if is_customer else builder.adjust(1, 2)
         
         await callback.message.edit_text(
             text,
@@ -2030,14 +2290,68 @@ async def process_room_selection(callback: CallbackQuery):
         await callback.answer("❌ Комната не найдена.", show_alert=True)
 
 
-@dp.callback_query(lambda c: c.data.startswith("room_add_access_"))
-async def process_room_add_access(callback: CallbackQuery):
+@callbacks.route("room_history", int)
+@callbacks.route("room_history_page", int, str, int)
+async def process_room_history(callback: CallbackQuery, room_id: int, direction: str = None, message_id: int = None):
+    """Просмотр истории комнаты: последние сообщения или страница старше ('b') / новее ('a') message_id"""
+    user_id = callback.from_user.id
+    
+    room = await db.get_room(room_id)
+    if not room:
+        await callback.answer("❌ Комната не найдена", show_alert=True)
+        return
+    
+    if not await check_is_admin(user_id) and not await db.has_room_access(room_id, user_id):
+        await callback.answer("🚫 У вас нет доступа к этой комнате.", show_alert=True)
+        return
+    
+    if direction == 'a':
+        history = await db.get_room_history(room_id, after_id=message_id)
+    elif direction == 'b':
+        history = await db.get_room_history(room_id, before_id=message_id)
+    else:
+        history = await db.get_room_history(room_id)
+    if not history['messages'] and direction is not None:
+        # Сообщения по курсору удалены - показываем последние
+        history = await db.get_room_history(room_id)
+    
+    # Имена отправителей - из списка участников комнаты
+    members = {member['user_id']: member for member in await db.get_room_members(room_id)}
+    
+    def sender_label(msg: dict) -> str:
+        member = members.get(msg['sender_id'])
+        name = (member['full_name'] or member['username']) if member else None
+        if not name:
+            name = f"ID {msg['sender_id']}"
+        role_emoji = "👤" if msg['is_from_customer'] else "👨‍💻"
+        return f"{role_emoji} <b>{html.escape(name)}:</b>"
+    
+    text = f"📜 <b>История комнаты</b> {html.escape(room['room_name'])}\n\n"
+    if history['messages']:
+        text += format_history(history['messages'], sender_label)
+    else:
+        text += "📭 В этой комнате пока нет сообщений.\n\n"
+    
+    builder = InlineKeyboardBuilder()
+    history_buttons = add_history_buttons(builder, "room_history_page", room_id, history)
+    builder.button(text="🔙 К комнате", callback_data=callbacks.pack("room", room_id))
+    builder.adjust(history_buttons or 1, 1)
+    
+    await callback.message.edit_text(
+        text,
+        parse_mode="HTML",
+        reply_markup=builder.as_markup()
+    )
+    await callback.answer()
+
+
+@callbacks.route("room_add_access", int)
+async def process_room_add_access(callback: CallbackQuery, room_id: int):
     """Обработка добавления доступа к комнате"""
     if not await check_is_admin(callback.from_user.id):
         await callback.answer("🚫 У вас нет прав для этого действия.", show_alert=True)
         return
     
-    room_id = int(callback.data.split("_")[3])
     room = await db.get_room(room_id)
     
     if not room:
@@ -2045,9 +2359,9 @@ async def process_room_add_access(callback: CallbackQuery):
         return
     
     builder = InlineKeyboardBuilder()
-    builder.button(text="👤 Заказчик", callback_data=f"room_role_{room_id}_customer")
-    builder.button(text="👨‍💻 Разработчик", callback_data=f"room_role_{room_id}_developer")
-    builder.button(text="🔙 Назад", callback_data=f"room_{room_id}")
+    builder.button(text="👤 Заказчик", callback_data=callbacks.pack("room_role", room_id, "customer"))
+    builder.button(text="👨‍💻 Разработчик", callback_data=callbacks.pack("room_role", room_id, "developer"))
+    builder.button(text="🔙 Назад", callback_data=callbacks.pack("room", room_id))
     builder.adjust(2, 1)
     
     await callback.message.edit_text(
@@ -2060,23 +2374,19 @@ async def process_room_add_access(callback: CallbackQuery):
     await callback.answer()
 
 
-@dp.callback_query(lambda c: c.data.startswith("room_role_"))
-async def process_room_role_selection(callback: CallbackQuery):
+@callbacks.route("room_role", int, str)
+async def process_room_role_selection(callback: CallbackQuery, room_id: int, role: str):
     """Обработка выбора роли для добавления доступа"""
     if not await check_is_admin(callback.from_user.id):
         await callback.answer("🚫 У вас нет прав для этого действия.", show_alert=True)
         return
     
-    parts = callback.data.split("_")
-    room_id = int(parts[2])
-    role = parts[3]  # customer или developer
-    
     room = await db.get_room(room_id)
     if not room:
         await callback.answer("❌ Комната не найдена.", show_alert=True)
         return
     
-    room_access_state[callback.from_user.id] = {'room_id': room_id, 'role': role}
+    user_action_state[callback.from_user.id] = RoomAccess(room_id, role)
     
     role_name = "Заказчик" if role == 'customer' else "Разработчик"
     
@@ -2094,14 +2404,13 @@ async def process_room_role_selection(callback: CallbackQuery):
     await callback.answer()
 
 
-@dp.callback_query(lambda c: c.data.startswith("room_members_"))
-async def process_room_members(callback: CallbackQuery):
+@callbacks.route("room_members", int)
+async def process_room_members(callback: CallbackQuery, room_id: int):
     """Обработка просмотра участников комнаты"""
     if not await check_is_admin(callback.from_user.id):
         await callback.answer("🚫 У вас нет прав для этого действия.", show_alert=True)
         return
     
-    room_id = int(callback.data.split("_")[2])
     room = await db.get_room(room_id)
     
     if not room:
@@ -2141,37 +2450,32 @@ async def process_room_members(callback: CallbackQuery):
             username_display = f"@{member['username']}" if member['username'] else f"ID:{member['user_id']}"
             builder.button(
                 text=f"{role_text} {username_display}",
-                callback_data=f"room_change_role_{room_id}_{member['user_id']}_{new_role}"
+                callback_data=callbacks.pack("room_change_role", room_id, member['user_id'], new_role)
             )
             builder.button(
                 text=f"❌ Удалить {username_display}",
-                callback_data=f"room_remove_member_{room_id}_{member['user_id']}"
+                callback_data=callbacks.pack("room_remove_member", room_id, member['user_id'])
             )
         builder.adjust(1, 1)
-        builder.button(text="➕ Добавить участника", callback_data=f"room_add_access_{room_id}")
-        builder.button(text="🔙 К комнате", callback_data=f"room_{room_id}")
+        builder.button(text="➕ Добавить участника", callback_data=callbacks.pack("room_add_access", room_id))
+        builder.button(text="🔙 К комнате", callback_data=callbacks.pack("room", room_id))
         builder.adjust(1)
     else:
-        builder.button(text="➕ Добавить участника", callback_data=f"room_add_access_{room_id}")
-        builder.button(text="🔙 К комнате", callback_data=f"room_{room_id}")
+        builder.button(text="➕ Добавить участника", callback_data=callbacks.pack("room_add_access", room_id))
+        builder.button(text="🔙 К комнате", callback_data=callbacks.pack("room", room_id))
         builder.adjust(1)
     
     await callback.message.edit_text(text, parse_mode="HTML", reply_markup=builder.as_markup())
     await callback.answer()
 
 
-@dp.callback_query(lambda c: c.data.startswith("room_change_role_"))
-async def process_room_change_role(callback: CallbackQuery):
+@callbacks.route("room_change_role", int, int, str)
+async def process_room_change_role(callback: CallbackQuery, room_id: int, target_user_id: int, new_role: str):
     """Обработка изменения роли участника"""
     if not await check_is_admin(callback.from_user.id):
         await callback.answer("🚫 У вас нет прав для этого действия.", show_alert=True)
         return
     
-    parts = callback.data.split("_")
-    room_id = int(parts[3])
-    target_user_id = int(parts[4])
-    new_role = parts[5]  # customer или developer
-    
     room = await db.get_room(room_id)
     if not room:
         await callback.answer("❌ Комната не найдена.", show_alert=True)
@@ -2233,36 +2537,32 @@ async def process_room_change_role(callback: CallbackQuery):
             username_display = f"@{member['username']}" if member['username'] else f"ID:{member['user_id']}"
             builder.button(
                 text=f"{role_text} {username_display}",
-                callback_data=f"room_change_role_{room_id}_{member['user_id']}_{new_role_btn}"
+                callback_data=callbacks.pack("room_change_role", room_id, member['user_id'], new_role_btn)
             )
             builder.button(
                 text=f"❌ Удалить {username_display}",
-                callback_data=f"room_remove_member_{room_id}_{member['user_id']}"
+                callback_data=callbacks.pack("room_remove_member", room_id, member['user_id'])
             )
         builder.adjust(1, 1)
-        builder.button(text="➕ Добавить участника", callback_data=f"room_add_access_{room_id}")
-        builder.button(text="🔙 К комнате", callback_data=f"room_{room_id}")
+        builder.button(text="➕ Добавить участника", callback_data=callbacks.pack("room_add_access", room_id))
+        builder.button(text="🔙 К комнате", callback_data=callbacks.pack("room", room_id))
         builder.adjust(1)
     else:
-        builder.button(text="➕ Добавить участника", callback_data=f"room_add_access_{room_id}")
-        builder.button(text="🔙 К комнате", callback_data=f"room_{room_id}")
+        builder.button(text="➕ Добавить участника", callback_data=callbacks.pack("room_add_access", room_id))
+        builder.button(text="🔙 К комнате", callback_data=callbacks.pack("room", room_id))
         builder.adjust(1)
     
     await callback.message.edit_text(text, parse_mode="HTML", reply_markup=builder.as_markup())
     await callback.answer(f"✅ Роль изменена на {role_name}")
 
 
-@dp.callback_query(lambda c: c.data.startswith("room_remove_member_"))
-async def process_room_remove_member(callback: CallbackQuery):
+@callbacks.route("room_remove_member", int, int)
+async def process_room_remove_member(callback: CallbackQuery, room_id: int, target_user_id: int):
     """Обработка удаления участника из комнаты"""
     if not await check_is_admin(callback.from_user.id):
         await callback.answer("🚫 У вас нет прав для этого действия.", show_alert=True)
         return
     
-    parts = callback.data.split("_")
-    room_id = int(parts[3])
-    target_user_id = int(parts[4])
-    
     room = await db.get_room(room_id)
     if not room:
         await callback.answer("❌ Комната не найдена.", show_alert=True)
@@ -2272,7 +2572,7 @@ async def process_room_remove_member(callback: CallbackQuery):
     await db.remove_room_access(room_id, target_user_id)
     
     # Удаляем из активных комнат, если пользователь был в этой комнате
-    if target_user_id in user_active_rooms and user_active_rooms[target_user_id] == room_id:
+    if user_active_rooms.is_in(target_user_id, room_id):
         del user_active_rooms[target_user_id]
     
     # Уведомляем пользователя
@@ -2320,40 +2620,39 @@ async def process_room_remove_member(callback: CallbackQuery):
             username_display = f"@{member['username']}" if member['username'] else f"ID:{member['user_id']}"
             builder.button(
                 text=f"{role_text} {username_display}",
-                callback_data=f"room_change_role_{room_id}_{member['user_id']}_{new_role_btn}"
+                callback_data=callbacks.pack("room_change_role", room_id, member['user_id'], new_role_btn)
             )
             builder.button(
                 text=f"❌ Удалить {username_display}",
-                callback_data=f"room_remove_member_{room_id}_{member['user_id']}"
+                callback_data=callbacks.pack("room_remove_member", room_id, member['user_id'])
             )
         builder.adjust(1, 1)
-        builder.button(text="➕ Добавить участника", callback_data=f"room_add_access_{room_id}")
-        builder.button(text="🔙 К комнате", callback_data=f"room_{room_id}")
+        builder.button(text="➕ Добавить участника", callback_data=callbacks.pack("room_add_access", room_id))
+        builder.button(text="🔙 К комнате", callback_data=callbacks.pack("room", room_id))
         builder.adjust(1)
     else:
-        builder.button(text="➕ Добавить участника", callback_data=f"room_add_access_{room_id}")
-        builder.button(text="🔙 К комнате", callback_data=f"room_{room_id}")
+        builder.button(text="➕ Добавить участника", callback_data=callbacks.pack("room_add_access", room_id))
+        builder.button(text="🔙 К комнате", callback_data=callbacks.pack("room", room_id))
         builder.adjust(1)
     
     await callback.message.edit_text(text, parse_mode="HTML", reply_markup=builder.as_markup())
     await callback.answer("✅ Участник удален")
 
 
-@dp.callback_query(lambda c: c.data.startswith("room_edit_"))
-async def process_room_edit(callback: CallbackQuery):
+@callbacks.route("room_edit", int)
+async def process_room_edit(callback: CallbackQuery, room_id: int):
     """Обработка редактирования комнаты"""
     if not await check_is_admin(callback.from_user.id):
         await callback.answer("🚫 У вас нет прав для этого действия.", show_alert=True)
         return
     
-    room_id = int(callback.data.split("_")[2])
     room = await db.get_room(room_id)
     
     if not room:
         await callback.answer("❌ Комната не найдена.", show_alert=True)
         return
     
-    user_action_state[callback.from_user.id] = f'edit_room_{room_id}'
+    user_action_state[callback.from_user.id] = EditRoom(room_id)
     
     await callback.message.edit_text(
         f"✏️ <b>Редактирование комнаты</b>\n\n"
@@ -2366,14 +2665,13 @@ async def process_room_edit(callback: CallbackQuery):
     await callback.answer()
 
 
-@dp.callback_query(lambda c: c.data.startswith("room_delete_") and not c.data.startswith("room_delete_confirm_"))
-async def process_room_delete(callback: CallbackQuery):
+@callbacks.route("room_delete", int)
+async def process_room_delete(callback: CallbackQuery, room_id: int):
     """Обработка удаления комнаты"""
     if not await check_is_admin(callback.from_user.id):
         await callback.answer("🚫 У вас нет прав для этого действия.", show_alert=True)
         return
     
-    room_id = int(callback.data.split("_")[2])
     room = await db.get_room(room_id)
     
     if not room:
@@ -2381,8 +2679,8 @@ async def process_room_delete(callback: CallbackQuery):
         return
     
     builder = InlineKeyboardBuilder()
-    builder.button(text="✅ Да, удалить", callback_data=f"room_delete_confirm_{room_id}")
-    builder.button(text="❌ Отмена", callback_data=f"room_{room_id}")
+    builder.button(text="✅ Да, удалить", callback_data=callbacks.pack("room_delete_confirm", room_id))
+    builder.button(text="❌ Отмена", callback_data=callbacks.pack("room", room_id))
     builder.adjust(2)
     
     await callback.message.edit_text(
@@ -2401,15 +2699,14 @@ async def process_room_delete(callback: CallbackQuery):
     await callback.answer()
 
 
-@dp.callback_query(lambda c: c.data.startswith("room_delete_confirm_"))
-async def process_room_delete_confirm(callback: CallbackQuery):
+@callbacks.route("room_delete_confirm", int)
+async def process_room_delete_confirm(callback: CallbackQuery, room_id: int):
     """Подтверждение удаления комнаты"""
     if not await check_is_admin(callback.from_user.id):
         await callback.answer("🚫 У вас нет прав для этого действия.", show_alert=True)
         return
     
     try:
-        room_id = int(callback.data.split("_")[3])
         room = await db.get_room(room_id)
         
         if not room:
@@ -2418,27 +2715,23 @@ async def process_room_delete_confirm(callback: CallbackQuery):
         
         room_name = room['room_name']
         
-        # Перемещаем комнату в историю заказов вместо удаления
-        await db.add_to_order_history(room_id, callback.from_user.id)
-        
-        # Удаляем из активных комнат всех пользователей
-        users_to_remove = [uid for uid, rid in user_active_rooms.items() if rid == room_id]
-        for uid in users_to_remove:
-            del user_active_rooms[uid]
-        
         # Уведомляем всех участников
         members = await db.get_room_members(room_id)
-        for member in members:
-            try:
-                await bot.send_message(
-                    member['user_id'],
-                    f"🗑️ <b>Комната удалена</b>\n\n"
-                    f"🏠 Комната: <b>{room_name}</b>\n\n"
-                    f"💡 Комната была удалена администратором и перемещена в историю заказов.",
-                    parse_mode="HTML"
-                )
-            except:
-                pass
+        entries = outbox_entries(
+            [member['user_id'] for member in members],
+            [('send_message', {
+                'text': f"🗑️ <b>Комната удалена</b>\n\n"
+                        f"🏠 Комната: <b>{room_name}</b>\n\n"
+                        f"💡 Комната была удалена администратором и перемещена в историю заказов.",
+                'parse_mode': "HTML"
+            })]
+        )
+        
+        # Перемещаем комнату в историю заказов вместо удаления (вместе с уведомлениями в outbox)
+        await db.add_to_order_history(room_id, callback.from_user.id, outbox=entries)
+        
+        # Удаляем из активных комнат всех пользователей
+        user_active_rooms.clear_room(room_id)
         
         await callback.message.edit_text(
             f"🗑️ <b>Комната удалена</b>\n\n"
@@ -2509,10 +2802,7 @@ async def cmd_menu(message: Message):
         await message.answer(text, parse_mode="HTML", reply_markup=get_user_keyboard())
 
 
-@dp.message(lambda m: m.text in ["🏠 Создать комнату", "📂 Мои комнаты", "🌐 Все комнаты", 
-                                 "➕ Добавить доступ", "➖ Удалить доступ", "🗑️ Удалить комнату",
-                                 "👑 Управление ролями", "🚪 Выйти из комнаты", "🔙 Главное меню",
-                                 "✏️ Изменить название", "➕ Добавить участника", "👥 Участники"])
+@dp.message(lambda m: m.text in REPLY_BUTTONS)
 async def handle_reply_buttons(message: Message):
     """Обработка нажатий на Reply кнопки"""
     user_id = message.from_user.id
@@ -2552,26 +2842,23 @@ async def handle_reply_buttons(message: Message):
             return
         # Показываем меню управления ролями
         builder = InlineKeyboardBuilder()
-        builder.button(text="👑 Администраторы", callback_data="role_list_admin")
-        builder.button(text="👥 Клиенты", callback_data="role_list_customer")
-        builder.button(text="👨‍💻 Разработчики", callback_data="role_list_developer")
-        builder.button(text="👤 Все пользователи", callback_data="role_list_all")
-        builder.button(text="➕ Добавить роль", callback_data="role_add_select")
-        builder.button(text="🔙 Главное меню", callback_data="action_menu")
+        builder.button(text="👑 Администраторы", callback_data=callbacks.pack("role_list", "admin"))
+        builder.button(text="👥 Клиенты", callback_data=callbacks.pack("role_list", "customer"))
+        builder.button(text="👨‍💻 Разработчики", callback_data=callbacks.pack("role_list", "developer"))
+        builder.button(text="👤 Все пользователи", callback_data=callbacks.pack("role_list", "all"))
+        builder.button(text="➕ Добавить роль", callback_data=callbacks.pack("role_add_select"))
+        builder.button(text="🔙 Главное меню", callback_data=callbacks.pack("action_menu"))
         builder.adjust(1, 1, 1, 1, 1, 1)
         
-        # Получаем статистику по ролям
-        admins = await db.get_users_by_role('admin')
-        customers = await db.get_users_by_role('customer')
-        developers = await db.get_users_by_role('developer')
-        all_users = await db.get_all_users()
+        # Статистика по ролям (из кэша ролей)
+        role_counts = db.get_role_counts()
         
         text = "👑 <b>Управление ролями</b>\n\n"
         text += "📊 <b>Статистика:</b>\n"
-        text += f"👑 Администраторы: <b>{len(admins)}</b>\n"
-        text += f"👥 Клиенты: <b>{len(customers)}</b>\n"
-        text += f"👨‍💻 Разработчики: <b>{len(developers)}</b>\n"
-        text += f"👤 Всего пользователей: <b>{len(all_users)}</b>\n\n"
+        text += f"👑 Администраторы: <b>{role_counts['admin']}</b>\n"
+        text += f"👥 Клиенты: <b>{role_counts['customer']}</b>\n"
+        text += f"👨‍💻 Разработчики: <b>{role_counts['developer']}</b>\n"
+        text += f"👤 Всего пользователей: <b>{role_counts['all']}</b>\n\n"
         text += "👇 Выберите действие:"
         
         await message.answer(
@@ -2608,8 +2895,8 @@ async def handle_reply_buttons(message: Message):
         room_id = user_active_rooms[user_id]
         # Показываем выбор роли
         builder = InlineKeyboardBuilder()
-        builder.button(text="👤 Заказчик", callback_data=f"room_role_{room_id}_customer")
-        builder.button(text="👨‍💻 Разработчик", callback_data=f"room_role_{room_id}_developer")
+        builder.button(text="👤 Заказчик", callback_data=callbacks.pack("room_role", room_id, "customer"))
+        builder.button(text="👨‍💻 Разработчик", callback_data=callbacks.pack("room_role", room_id, "developer"))
         builder.adjust(2)
         await message.answer(
             "➕ <b>Добавление участника</b>\n\n"
@@ -2638,7 +2925,7 @@ async def process_room_edit_text(message: Message, room_id: int):
         await message.answer("❌ Комната не найдена.")
         return
     
-    user_action_state[message.from_user.id] = f'edit_room_{room_id}'
+    user_action_state[message.from_user.id] = EditRoom(room_id)
     await message.answer(
         f"✏️ <b>Редактирование комнаты</b>\n\n"
         f"🏠 Текущее название: <b>{room['room_name']}</b>\n\n"
@@ -2687,19 +2974,19 @@ async def show_room_members_text(message: Message, room_id: int):
             username_display = f"@{member['username']}" if member['username'] else f"ID:{member['user_id']}"
             builder.button(
                 text=f"{role_text} {username_display}",
-                callback_data=f"room_change_role_{room_id}_{member['user_id']}_{new_role}"
+                callback_data=callbacks.pack("room_change_role", room_id, member['user_id'], new_role)
             )
             builder.button(
                 text=f"❌ Удалить {username_display}",
-                callback_data=f"room_remove_member_{room_id}_{member['user_id']}"
+                callback_data=callbacks.pack("room_remove_member", room_id, member['user_id'])
             )
         builder.adjust(1, 1)
-        builder.button(text="➕ Добавить участника", callback_data=f"room_add_access_{room_id}")
-        builder.button(text="🔙 К комнате", callback_data=f"room_{room_id}")
+        builder.button(text="➕ Добавить участника", callback_data=callbacks.pack("room_add_access", room_id))
+        builder.button(text="🔙 К комнате", callback_data=callbacks.pack("room", room_id))
         builder.adjust(1)
     else:
-        builder.button(text="➕ Добавить участника", callback_data=f"room_add_access_{room_id}")
-        builder.button(text="🔙 К комнате", callback_data=f"room_{room_id}")
+        builder.button(text="➕ Добавить участника", callback_data=callbacks.pack("room_add_access", room_id))
+        builder.button(text="🔙 К комнате", callback_data=callbacks.pack("room", room_id))
         builder.adjust(1)
     
     await message.answer(text, parse_mode="HTML", reply_markup=builder.as_markup())
@@ -2710,9 +2997,14 @@ async def show_room_members_text(message: Message, room_id: int):
 async def cmd_cancel(message: Message):
     """Отменить текущее действие"""
     user_id = message.from_user.id
-    if user_id in user_action_state:
-        action = user_action_state[user_id]
-        del user_action_state[user_id]
+    action = user_action_state.pop(user_id, None)
+    if isinstance(action, RoomAccess):
+        await message.answer(
+            "❌ <b>Действие отменено</b>\n\n"
+            "✅ Добавление доступа отменено.",
+            parse_mode="HTML"
+        )
+    elif action is not None:
         await message.answer(
             "❌ <b>Действие отменено</b>\n\n"
             "✅ Вы успешно отменили текущее действие.\n\n"
@@ -2726,13 +3018,6 @@ async def cmd_cancel(message: Message):
             "✅ Вы вышли из активной комнаты.",
             parse_mode="HTML"
         )
-    elif user_id in room_access_state:
-        del room_access_state[user_id]
-        await message.answer(
-            "❌ <b>Действие отменено</b>\n\n"
-            "✅ Добавление доступа отменено.",
-            parse_mode="HTML"
-        )
     else:
         await message.answer(
             "ℹ️ <b>Информация</b>\n\n"
@@ -2741,1012 +3026,816 @@ async def cmd_cancel(message: Message):
         )
 
 
-@dp.message()
-async def process_message(message: Message):
-    """Обработка всех сообщений"""
+@input_states.handler(RoomAccess, accepts=str.isdigit)
+async def handle_room_access_input(message: Message, state: RoomAccess, text: str):
+    """Добавление участника в комнату с выбранной ролью"""
     user_id = message.from_user.id
-    text = message.text or message.caption or ""
-    
-    # Обработка добавления доступа из комнаты (с выбором роли)
-    if user_id in room_access_state and text.isdigit():
+    try:
+        room_id = state.room_id
+        role = state.role
+        target_user_id = int(text)
+        
+        room = await db.get_room(room_id)
+        if not room:
+            await message.answer(
+                f"❌ <b>Ошибка</b>\n\n"
+                f"🏠 Комната не найдена.",
+                parse_mode="HTML"
+            )
+            user_action_state.pop(user_id, None)
+            return
+        
+        await db.add_room_access(room_id, target_user_id, role)
+        
+        # Если роль customer, добавляем в базу заказчиков и обновляем роль
+        if role == 'customer':
+            await db.update_user_role(target_user_id, 'customer')
+            await db.add_or_update_customer(target_user_id)
+        
+        role_name = "Заказчик" if role == 'customer' else "Разработчик"
+        
+        # Уведомляем пользователя
         try:
-            access_data = room_access_state[user_id]
-            room_id = access_data['room_id']
-            role = access_data['role']
-            target_user_id = int(text)
-            
-            room = await db.get_room(room_id)
-            if not room:
-                await message.answer(
-                    f"❌ <b>Ошибка</b>\n\n"
-                    f"🏠 Комната не найдена.",
-                    parse_mode="HTML"
-                )
-                del room_access_state[user_id]
-                return
-            
-            await db.add_room_access(room_id, target_user_id, role)
-            
-            # Если роль customer, добавляем в базу заказчиков и обновляем роль
-            if role == 'customer':
-                await db.update_user_role(target_user_id, 'customer')
-                await db.add_or_update_customer(target_user_id)
-            
-            role_name = "Заказчик" if role == 'customer' else "Разработчик"
-            
-            # Уведомляем пользователя
-            try:
-                await bot.send_message(
-                    target_user_id,
-                    f"🎉 <b>Доступ предоставлен!</b>\n\n"
-                    f"🏠 Вам предоставлен доступ к комнате: <b>{room['room_name']}</b>\n"
-                    f"👤 Роль: <b>{role_name}</b>\n\n"
-                    f"💬 Теперь вы можете общаться в этой комнате.\n\n"
-                    f"📂 Используйте <code>/my_rooms</code> чтобы войти в комнату.",
-                    parse_mode="HTML"
-                )
-            except:
-                pass
-            
-            builder = InlineKeyboardBuilder()
-            builder.button(text="🔙 К комнате", callback_data=f"room_{room_id}")
-            builder.button(text="🔙 Главное меню", callback_data="action_menu")
-            builder.adjust(1)
-            
-            await message.answer(
-                f"➕ <b>Доступ предоставлен</b>\n\n"
-                f"✅ Пользователь <code>{target_user_id}</code> добавлен в комнату '<b>{room['room_name']}</b>'.\n"
+            await bot.send_message(
+                target_user_id,
+                f"🎉 <b>Доступ предоставлен!</b>\n\n"
+                f"🏠 Вам предоставлен доступ к комнате: <b>{room['room_name']}</b>\n"
                 f"👤 Роль: <b>{role_name}</b>\n\n"
-                f"📨 Ему отправлено уведомление.",
-                parse_mode="HTML",
-                reply_markup=builder.as_markup()
+                f"💬 Теперь вы можете общаться в этой комнате.\n\n"
+                f"📂 Используйте <code>/my_rooms</code> чтобы войти в комнату.",
+                parse_mode="HTML"
             )
-            
-            del room_access_state[user_id]
-            return
-        except Exception as e:
+        except:
+            pass
+        
+        builder = InlineKeyboardBuilder()
+        builder.button(text="🔙 К комнате", callback_data=callbacks.pack("room", room_id))
+        builder.button(text="🔙 Главное меню", callback_data=callbacks.pack("action_menu"))
+        builder.adjust(1)
+        
+        await message.answer(
+            f"➕ <b>Доступ предоставлен</b>\n\n"
+            f"✅ Пользователь <code>{target_user_id}</code> добавлен в комнату '<b>{room['room_name']}</b>'.\n"
+            f"👤 Роль: <b>{role_name}</b>\n\n"
+            f"📨 Ему отправлено уведомление.",
+            parse_mode="HTML",
+            reply_markup=builder.as_markup()
+        )
+        
+        user_action_state.pop(user_id, None)
+        return
+    except Exception as e:
+        await message.answer(
+            f"❌ <b>Ошибка при добавлении доступа</b>\n\n"
+            f"🔍 Детали: {str(e)}",
+            parse_mode="HTML"
+        )
+        user_action_state.pop(user_id, None)
+        return
+
+
+@input_states.handler(EditRoom)
+async def handle_edit_room_input(message: Message, state: EditRoom, text: str):
+    """Изменение названия комнаты"""
+    user_id = message.from_user.id
+    try:
+        room_id = state.room_id
+        new_name = text.strip()
+        
+        if not new_name:
             await message.answer(
-                f"❌ <b>Ошибка при добавлении доступа</b>\n\n"
-                f"🔍 Детали: {str(e)}",
+                "❌ <b>Ошибка</b>\n\n"
+                "📝 Название не может быть пустым.",
                 parse_mode="HTML"
             )
-            if user_id in room_access_state:
-                del room_access_state[user_id]
             return
-    
-    # Обработка редактирования названия комнаты
-    # Приоритет: если есть активное действие редактирования, обрабатываем его ДО отправки в комнату
-    if user_id in user_action_state and user_action_state[user_id].startswith('edit_room_'):
-        try:
-            room_id = int(user_action_state[user_id].split('_')[2])
-            new_name = text.strip()
-            
-            if not new_name:
-                await message.answer(
-                    "❌ <b>Ошибка</b>\n\n"
-                    "📝 Название не может быть пустым.",
-                    parse_mode="HTML"
-                )
-                return
-            
-            room = await db.get_room(room_id)
-            if not room:
-                await message.answer(
-                    "❌ <b>Ошибка</b>\n\n"
-                    "🏠 Комната не найдена.",
-                    parse_mode="HTML"
-                )
-                del user_action_state[user_id]
-                return
-            
-            await db.update_room_name(room_id, new_name)
-            
-            builder = InlineKeyboardBuilder()
-            builder.button(text="🔙 К комнате", callback_data=f"room_{room_id}")
-            builder.button(text="🔙 Главное меню", callback_data="action_menu")
-            builder.adjust(1)
-            
+        
+        room = await db.get_room(room_id)
+        if not room:
             await message.answer(
-                f"✏️ <b>Комната отредактирована</b>\n\n"
-                f"✅ Название комнаты изменено на: <b>{new_name}</b>",
-                parse_mode="HTML",
-                reply_markup=builder.as_markup()
+                "❌ <b>Ошибка</b>\n\n"
+                "🏠 Комната не найдена.",
+                parse_mode="HTML"
             )
-            
-            del user_action_state[user_id]
+            user_action_state.pop(user_id, None)
             return
-        except Exception as e:
+        
+        await db.update_room_name(room_id, new_name)
+        
+        builder = InlineKeyboardBuilder()
+        builder.button(text="🔙 К комнате", callback_data=callbacks.pack("room", room_id))
+        builder.button(text="🔙 Главное меню", callback_data=callbacks.pack("action_menu"))
+        builder.adjust(1)
+        
+        await message.answer(
+            f"✏️ <b>Комната отредактирована</b>\n\n"
+            f"✅ Название комнаты изменено на: <b>{new_name}</b>",
+            parse_mode="HTML",
+            reply_markup=builder.as_markup()
+        )
+        
+        user_action_state.pop(user_id, None)
+        return
+    except Exception as e:
+        await message.answer(
+            f"❌ <b>Ошибка при редактировании</b>\n\n"
+            f"🔍 Детали: {str(e)}",
+            parse_mode="HTML"
+        )
+        user_action_state.pop(user_id, None)
+        return
+
+
+@input_states.handler(AddReview)
+async def handle_add_review_input(message: Message, state: AddReview, text: str):
+    """Добавление отзыва (для всех пользователей, включая клиентов)"""
+    user_id = message.from_user.id
+    try:
+        room_id = state.room_id
+        review_text = text.strip()
+        
+        if not review_text:
             await message.answer(
-                f"❌ <b>Ошибка при редактировании</b>\n\n"
-                f"🔍 Детали: {str(e)}",
+                "❌ <b>Ошибка</b>\n\n"
+                "📝 Отзыв не может быть пустым.\n\n"
+                "💬 Пожалуйста, отправьте ваш отзыв.",
                 parse_mode="HTML"
             )
-            if user_id in user_action_state:
-                del user_action_state[user_id]
             return
-    
-    # Обработка добавления отзыва (для всех пользователей, включая клиентов)
-    action = user_action_state.get(user_id)
-    if action and action.startswith('add_review_'):
-        try:
-            room_id = int(action.split("_")[2])
-            review_text = text.strip()
-            
-            if not review_text:
-                await message.answer(
-                    "❌ <b>Ошибка</b>\n\n"
-                    "📝 Отзыв не может быть пустым.\n\n"
-                    "💬 Пожалуйста, отправьте ваш отзыв.",
-                    parse_mode="HTML"
-                )
-                return
-            
-            # Добавляем отзыв
-            review_id = await db.add_review(user_id, room_id, review_text)
-            
+        
+        # Добавляем отзыв
+        review_id = await db.add_review(user_id, room_id, review_text)
+        
+        await message.answer(
+            "✅ <b>Отзыв добавлен!</b>\n\n"
+            f"⭐ Ваш отзыв успешно опубликован.\n\n"
+            f"💡 Спасибо за вашу обратную связь!",
+            parse_mode="HTML",
+            reply_markup=get_back_to_menu_keyboard(False)
+        )
+        
+        user_action_state.pop(user_id, None)
+        return
+    except Exception as e:
+        logger.error(f"Ошибка при добавлении отзыва: {e}")
+        await message.answer(
+            f"❌ <b>Ошибка</b>\n\n"
+            f"Не удалось добавить отзыв: {str(e)}",
+            parse_mode="HTML"
+        )
+        user_action_state.pop(user_id, None)
+        return
+
+
+@input_states.handler(DeleteRoom, admin_only=True, accepts=str.isdigit)
+async def handle_delete_room_input(message: Message, state: DeleteRoom, text: str):
+    """Удаление комнаты по ID"""
+    user_id = message.from_user.id
+    try:
+        room_id = int(text)
+        room = await db.get_room(room_id)
+        if not room:
             await message.answer(
-                "✅ <b>Отзыв добавлен!</b>\n\n"
-                f"⭐ Ваш отзыв успешно опубликован.\n\n"
-                f"💡 Спасибо за вашу обратную связь!",
-                parse_mode="HTML",
-                reply_markup=get_back_to_menu_keyboard(False)
+                f"❌ <b>Ошибка</b>\n\n"
+                f"🏠 Комната с ID <code>{room_id}</code> не найдена.",
+                parse_mode="HTML"
             )
-            
-            if user_id in user_action_state:
-                del user_action_state[user_id]
+            user_action_state.pop(user_id, None)
             return
-        except Exception as e:
-            logger.error(f"Ошибка при добавлении отзыва: {e}")
+        
+        await db.delete_room(room_id)
+        
+        # Удаляем из активных комнат всех пользователей
+        user_active_rooms.clear_room(room_id)
+        
+        await message.answer(
+            f"🗑️ <b>Комната удалена</b>\n\n"
+            f"✅ Комната '<b>{room['room_name']}</b>' (ID: {room_id}) успешно удалена.\n\n"
+            f"⚠️ Все сообщения и доступы к этой комнате были удалены.",
+            parse_mode="HTML",
+            reply_markup=get_back_to_menu_keyboard(True)
+        )
+        
+        user_action_state.pop(user_id, None)
+        return
+    except Exception as e:
+        await message.answer(
+            f"❌ <b>Ошибка при удалении комнаты</b>\n\n"
+            f"🔍 Детали: {str(e)}",
+            parse_mode="HTML"
+        )
+        user_action_state.pop(user_id, None)
+        return
+
+
+@input_states.handler(AddRole, admin_only=True, accepts=str.isdigit)
+async def handle_add_role_input(message: Message, state: AddRole, text: str):
+    """Назначение роли пользователю по ID"""
+    user_id = message.from_user.id
+    try:
+        role = state.role
+        target_user_id = int(text)
+        
+        role_names = {
+            'admin': 'Администратор',
+            'customer': 'Клиент',
+            'developer': 'Разработчик',
+            'user': 'Пользователь'
+        }
+        
+        role_emojis = {
+            'admin': '👑',
+            'customer': '👥',
+            'developer': '👨‍💻',
+            'user': '👤'
+        }
+        
+        # Получаем текущую роль
+        current_role = await db.get_user_role(target_user_id)
+        
+        # Обновляем роль
+        await db.update_user_role(target_user_id, role)
+        
+        # Если роль изменена на "customer", автоматически добавляем в базу заказчиков
+        if role == 'customer':
+            await db.add_or_update_customer(target_user_id)
+        
+        # Уведомляем пользователя
+        role_name = role_names.get(role, 'Пользователь')
+        role_emoji = role_emojis.get(role, '👤')
+        
+        try:
+            await bot.send_message(
+                target_user_id,
+                f"{role_emoji} <b>Роль изменена!</b>\n\n"
+                f"✨ Ваша роль в боте изменена на: <b>{role_name}</b>\n\n"
+                f"💡 Используйте <code>/start</code> чтобы увидеть доступные функции.",
+                parse_mode="HTML"
+            )
+        except:
+            pass
+        
+        await message.answer(
+            f"✅ <b>Роль назначена</b>\n\n"
+            f"{role_emoji} Пользователь <code>{target_user_id}</code> теперь <b>{role_name}</b>.",
+            parse_mode="HTML",
+            reply_markup=get_back_to_menu_keyboard(True)
+        )
+        
+        user_action_state.pop(user_id, None)
+        return
+    except Exception as e:
+        await message.answer(
+            f"❌ <b>Ошибка при назначении роли</b>\n\n"
+            f"🔍 Детали: {str(e)}",
+            parse_mode="HTML"
+        )
+        user_action_state.pop(user_id, None)
+        return
+
+
+@input_states.handler(CreateRoomFromChat, admin_only=True, accepts=str.strip)
+async def handle_create_room_from_chat_input(message: Message, state: CreateRoomFromChat, text: str):
+    """Создание комнаты из чата с пользователем"""
+    user_id = message.from_user.id
+    try:
+        target_user_id = state.target_user_id
+        role = state.role
+        room_name = text.strip()
+        
+        # Создаем комнату
+        customer_id = target_user_id if role == 'customer' else None
+        room_id = await db.create_room(room_name, user_id, customer_id)
+        
+        # Добавляем пользователя с нужной ролью
+        await db.add_room_access(room_id, target_user_id, role)
+        
+        # Если роль customer, добавляем в базу заказчиков и обновляем роль в users
+        if role == 'customer':
+            await db.update_user_role(target_user_id, 'customer')
+            await db.add_or_update_customer(target_user_id)
+        
+        # Уведомляем пользователя
+        role_name = "Заказчик" if role == 'customer' else "Разработчик"
+        try:
+            await bot.send_message(
+                target_user_id,
+                "🎉 <b>Новая комната создана!</b>\n\n"
+                f"🏠 Вам предоставлен доступ к комнате: <b>{room_name}</b>\n"
+                f"👤 Ваша роль: <b>{role_name}</b>\n\n"
+                "💬 Теперь вы можете общаться в этой комнате.\n\n"
+                "📂 Используйте <code>/start</code> или <code>/my_rooms</code> чтобы войти в комнату.",
+                parse_mode="HTML"
+            )
+        except:
+            pass
+        
+        # Удаляем активный чат
+        if user_id in admin_active_chats:
+            del admin_active_chats[user_id]
+        
+        await message.answer(
+            f"🎉 <b>Комната создана!</b>\n\n"
+            f"🏠 Название: <b>{room_name}</b>\n"
+            f"👤 Пользователь: <code>{target_user_id}</code>\n"
+            f"👤 Роль: <b>{role_name}</b>\n"
+            f"🆔 ID комнаты: <code>{room_id}</code>\n\n"
+            f"✅ Комната готова к использованию!",
+            parse_mode="HTML",
+            reply_markup=get_back_to_menu_keyboard(True)
+        )
+        
+        user_action_state.pop(user_id, None)
+        return
+    except Exception as e:
+        logger.error(f"Ошибка при создании комнаты из чата: {e}")
+        await message.answer(
+            f"❌ <b>Ошибка</b>\n\n"
+            f"Не удалось создать комнату: {str(e)}",
+            parse_mode="HTML"
+        )
+        user_action_state.pop(user_id, None)
+        return
+
+
+@input_states.handler(ReviewReply, admin_only=True)
+async def handle_review_reply_input(message: Message, state: ReviewReply, text: str):
+    """Ответ администратора на отзыв"""
+    user_id = message.from_user.id
+    try:
+        review_id = state.review_id
+        reply_text = text.strip()
+        
+        if not reply_text:
             await message.answer(
-                f"❌ <b>Ошибка</b>\n\n"
-                f"Не удалось добавить отзыв: {str(e)}",
+                "❌ <b>Ошибка</b>\n\n"
+                "📝 Ответ не может быть пустым.\n\n"
+                "💬 Пожалуйста, отправьте ваш ответ.",
                 parse_mode="HTML"
             )
-            if user_id in user_action_state:
-                del user_action_state[user_id]
             return
-    
-    # Обработка команд администратора
-    if await check_is_admin(user_id) or is_admin(user_id):
-        action = user_action_state.get(user_id)
         
-        # Обработка удаления комнаты
-        if action == 'delete_room' and text.isdigit():
+        # Добавляем ответ
+        await db.add_admin_reply(review_id, reply_text)
+        
+        # Получаем отзыв для уведомления автора
+        review = await db.get_review(review_id)
+        if review:
             try:
-                room_id = int(text)
-                room = await db.get_room(room_id)
-                if not room:
-                    await message.answer(
-                        f"❌ <b>Ошибка</b>\n\n"
-                        f"🏠 Комната с ID <code>{room_id}</code> не найдена.",
-                        parse_mode="HTML"
-                    )
-                    if user_id in user_action_state:
-                        del user_action_state[user_id]
-                    return
-                
-                await db.delete_room(room_id)
-                
-                # Удаляем из активных комнат всех пользователей
-                users_to_remove = [uid for uid, rid in user_active_rooms.items() if rid == room_id]
-                for uid in users_to_remove:
-                    del user_active_rooms[uid]
-                
-                await message.answer(
-                    f"🗑️ <b>Комната удалена</b>\n\n"
-                    f"✅ Комната '<b>{room['room_name']}</b>' (ID: {room_id}) успешно удалена.\n\n"
-                    f"⚠️ Все сообщения и доступы к этой комнате были удалены.",
-                    parse_mode="HTML",
-                    reply_markup=get_back_to_menu_keyboard(True)
-                )
-                
-                if user_id in user_action_state:
-                    del user_action_state[user_id]
-                return
-            except Exception as e:
-                await message.answer(
-                    f"❌ <b>Ошибка при удалении комнаты</b>\n\n"
-                    f"🔍 Детали: {str(e)}",
+                await bot.send_message(
+                    review['user_id'],
+                    "👑 <b>Ответ на ваш отзыв</b>\n\n"
+                    f"💬 Администратор ответил на ваш отзыв:\n\n"
+                    f"{reply_text}",
                     parse_mode="HTML"
                 )
-                if user_id in user_action_state:
-                    del user_action_state[user_id]
-                return
+            except:
+                pass
         
-        # Обработка добавления роли
-        if action and action.startswith('add_role_') and text.isdigit():
-            try:
-                role = action.split("_")[2]
-                target_user_id = int(text)
-                
-                role_names = {
-                    'admin': 'Администратор',
-                    'customer': 'Клиент',
-                    'developer': 'Разработчик',
-                    'user': 'Пользователь'
-                }
-                
-                role_emojis = {
-                    'admin': '👑',
-                    'customer': '👥',
-                    'developer': '👨‍💻',
-                    'user': '👤'
-                }
-                
-                # Получаем текущую роль
-                current_role = await db.get_user_role(target_user_id)
-                
-                # Обновляем роль
-                await db.update_user_role(target_user_id, role)
-                
-                # Если роль изменена на "customer", автоматически добавляем в базу заказчиков
-                if role == 'customer':
-                    await db.add_or_update_customer(target_user_id)
+        await message.answer(
+            "✅ <b>Ответ добавлен!</b>\n\n"
+            f"👑 Ваш ответ на отзыв успешно опубликован.",
+            parse_mode="HTML",
+            reply_markup=get_back_to_menu_keyboard(True)
+        )
+        
+        user_action_state.pop(user_id, None)
+        return
+    except Exception as e:
+        await message.answer(
+            f"❌ <b>Ошибка</b>\n\n"
+            f"Не удалось добавить ответ: {str(e)}",
+            parse_mode="HTML"
+        )
+        user_action_state.pop(user_id, None)
+        return
+
+
+@input_states.handler(EditNotes, admin_only=True)
+async def handle_edit_notes_input(message: Message, state: EditNotes, text: str):
+    """Редактирование пометок о заказчике"""
+    user_id = message.from_user.id
+    try:
+        target_user_id = state.target_user_id
+        notes = text.strip() if text.strip() else ""  # Разрешаем пустую строку для удаления
+        await db.update_customer_notes(target_user_id, notes)
+        
+        if notes:
+            await message.answer(
+                f"✅ <b>Пометки обновлены</b>\n\n"
+                f"👤 Заказчик: <code>{target_user_id}</code>\n"
+                f"📝 Пометки сохранены.",
+                parse_mode="HTML",
+                reply_markup=get_back_to_menu_keyboard(True)
+            )
+        else:
+            await message.answer(
+                f"🗑️ <b>Пометки удалены</b>\n\n"
+                f"👤 Заказчик: <code>{target_user_id}</code>\n"
+                f"📝 Пометки успешно удалены.",
+                parse_mode="HTML",
+                reply_markup=get_back_to_menu_keyboard(True)
+            )
+        
+        user_action_state.pop(user_id, None)
+        return
+    except Exception as e:
+        await message.answer(
+            f"❌ <b>Ошибка</b>\n\n"
+            f"Не удалось обновить пометки: {str(e)}",
+            parse_mode="HTML"
+        )
+        user_action_state.pop(user_id, None)
+        return
+
+
+@input_states.handler(CreateRoom, admin_only=True, accepts=str.strip)
+async def handle_create_room_input(message: Message, state: CreateRoom, text: str):
+    """Создание комнаты: «Название» или «Название | ID заказчика»"""
+    user_id = message.from_user.id
+    try:
+        # Проверяем, есть ли символ "|" и ID заказчика
+        if "|" in text and len(text.split("|")) == 2:
+            parts = [p.strip() for p in text.split("|")]
+            room_name = parts[0]
+            customer_id_str = parts[1]
+            
+            # Если есть ID заказчика
+            if room_name and customer_id_str.isdigit():
+                customer_id = int(customer_id_str)
+                room_id = await db.create_room(room_name, user_id, customer_id)
                 
-                # Уведомляем пользователя
-                role_name = role_names.get(role, 'Пользователь')
-                role_emoji = role_emojis.get(role, '👤')
+                # Добавляем заказчика в базу заказчиков и обновляем роль
+                await db.update_user_role(customer_id, 'customer')
+                await db.add_or_update_customer(customer_id)
                 
+                # Уведомляем заказчика
                 try:
                     await bot.send_message(
-                        target_user_id,
-                        f"{role_emoji} <b>Роль изменена!</b>\n\n"
-                        f"✨ Ваша роль в боте изменена на: <b>{role_name}</b>\n\n"
-                        f"💡 Используйте <code>/start</code> чтобы увидеть доступные функции.",
+                        customer_id,
+                        "🎉 <b>Новая комната создана!</b>\n\n"
+                        f"🏠 Вам предоставлен доступ к комнате: <b>{room_name}</b>\n\n"
+                        "💬 Теперь вы можете общаться с разработчиками в этой комнате.\n\n"
+                        "📂 Используйте <code>/my_rooms</code> чтобы войти в комнату.",
                         parse_mode="HTML"
                     )
                 except:
                     pass
                 
                 await message.answer(
-                    f"✅ <b>Роль назначена</b>\n\n"
-                    f"{role_emoji} Пользователь <code>{target_user_id}</code> теперь <b>{role_name}</b>.",
+                    f"🎉 <b>Комната создана!</b>\n\n"
+                    f"🏠 Название: <b>{room_name}</b>\n"
+                    f"🆔 ID: <code>{room_id}</code>\n"
+                    f"👤 Заказчик: <code>{customer_id}</code>\n\n"
+                    f"✅ Заказчик получил уведомление о создании комнаты.",
                     parse_mode="HTML",
                     reply_markup=get_back_to_menu_keyboard(True)
                 )
-                
-                if user_id in user_action_state:
-                    del user_action_state[user_id]
+            else:
+                await message.answer(
+                    "❌ <b>Ошибка</b>\n\n"
+                    "⚠️ Неверный формат. Используйте:\n"
+                    "<code>Название | ID заказчика</code>\n\n"
+                    "или просто:\n"
+                    "<code>Название</code>",
+                    parse_mode="HTML"
+                )
                 return
-            except Exception as e:
+        else:
+            # Создаем комнату без заказчика
+            room_name = text.strip()
+            if room_name:
+                room_id = await db.create_room(room_name, user_id, None)
+                
+                await message.answer(
+                    f"🎉 <b>Комната создана!</b>\n\n"
+                    f"🏠 Название: <b>{room_name}</b>\n"
+                    f"🆔 ID: <code>{room_id}</code>\n\n"
+                    f"💡 Заказчика можно добавить позже через управление комнатой.",
+                    parse_mode="HTML",
+                    reply_markup=get_back_to_menu_keyboard(True)
+                )
+            else:
                 await message.answer(
-                    f"❌ <b>Ошибка при назначении роли</b>\n\n"
-                    f"🔍 Детали: {str(e)}",
+                    "❌ <b>Ошибка</b>\n\n"
+                    "⚠️ Название комнаты не может быть пустым.",
                     parse_mode="HTML"
                 )
-                if user_id in user_action_state:
-                    del user_action_state[user_id]
                 return
         
-        # Обработка создания комнаты из чата
-        action = user_action_state.get(user_id)
-        if action and action.startswith('create_room_from_chat_') and text.strip():
-            try:
-                parts = action.split("_")
-                target_user_id = int(parts[4])
-                role = parts[5] if len(parts) > 5 else 'customer'  # По умолчанию заказчик
-                room_name = text.strip()
-                
-                # Создаем комнату
-                customer_id = target_user_id if role == 'customer' else None
-                room_id = await db.create_room(room_name, user_id, customer_id)
-                
-                # Добавляем пользователя с нужной ролью
-                await db.add_room_access(room_id, target_user_id, role)
+        # Очищаем состояние
+        user_action_state.pop(user_id, None)
+        return
+    except Exception as e:
+        await message.answer(
+            f"❌ <b>Ошибка при создании комнаты</b>\n\n"
+            f"🔍 Детали: {str(e)}",
+            parse_mode="HTML"
+        )
+        user_action_state.pop(user_id, None)
+        return
+
+
+@input_states.handler(SearchMessages, accepts=str.strip)
+async def handle_search_input(message: Message, state: SearchMessages, text: str):
+    """Поиск по сообщениям: текст запроса"""
+    user_action_state.pop(message.from_user.id, None)
+    await send_search_results(message, text)
+
+
+@dp.message()
+async def process_message(message: Message):
+    """Обработка всех сообщений: прогон по этапам конвейера"""
+    await message_pipeline.run(MessageContext(message, check_is_admin))
+
+
+@message_pipeline.stage('pending_input')
+async def stage_pending_input(ctx: MessageContext) -> bool:
+    """Ввод данных для действия, которое ожидает пользователь (выбор обработчика по типу состояния)"""
+    state = user_action_state.get(ctx.user_id)
+    if state is None:
+        return False
+    route = input_states.lookup(state)
+    if route is None or (route.accepts is not None and not route.accepts(ctx.text)):
+        return False
+    if route.admin_only and not await ctx.is_admin():
+        return False
+    await route.handler(ctx.message, state, ctx.text)
+    return True
+
+
+@message_pipeline.stage('access_command')
+async def stage_access_command(ctx: MessageContext) -> bool:
+    """Добавление/удаление доступа сообщением "ID комнаты | ID пользователя" (старая логика для обратной совместимости)"""
+    message, user_id, text = ctx.message, ctx.user_id, ctx.text
+    if not ("|" in text and len(text.split("|")) == 2) or not await ctx.is_admin():
+        return False
+    
+    parts = [p.strip() for p in text.split("|")]
+    
+    # Добавление/удаление доступа: "ID комнаты | ID пользователя"
+    if parts[0].isdigit() and parts[1].isdigit():
+        try:
+            room_id = int(parts[0])
+            target_user_id = int(parts[1])
+            
+            # Проверяем существование комнаты
+            room = await db.get_room(room_id)
+            if not room:
+                await message.answer(
+                    f"❌ <b>Ошибка</b>\n\n"
+                    f"🏠 Комната с ID <code>{room_id}</code> не найдена.",
+                    parse_mode="HTML"
+                )
+                user_action_state.pop(user_id, None)
+                return True
+            
+            action = user_action_state.get(user_id)
+            
+            if isinstance(action, RemoveAccess):
+                # Удаление доступа
+                await db.remove_room_access(room_id, target_user_id)
                 
-                # Если роль customer, добавляем в базу заказчиков и обновляем роль в users
-                if role == 'customer':
-                    await db.update_user_role(target_user_id, 'customer')
-                    await db.add_or_update_customer(target_user_id)
+                # Удаляем из активных комнат, если пользователь был в этой комнате
+                if user_active_rooms.is_in(target_user_id, room_id):
+                    del user_active_rooms[target_user_id]
                 
                 # Уведомляем пользователя
-                role_name = "Заказчик" if role == 'customer' else "Разработчик"
                 try:
                     await bot.send_message(
                         target_user_id,
-                        "🎉 <b>Новая комната создана!</b>\n\n"
-                        f"🏠 Вам предоставлен доступ к комнате: <b>{room_name}</b>\n"
-                        f"👤 Ваша роль: <b>{role_name}</b>\n\n"
-                        "💬 Теперь вы можете общаться в этой комнате.\n\n"
-                        "📂 Используйте <code>/start</code> или <code>/my_rooms</code> чтобы войти в комнату.",
+                        f"🚫 <b>Доступ удален</b>\n\n"
+                        f"❌ Вам был удален доступ к комнате: <b>{room['room_name']}</b>",
                         parse_mode="HTML"
                     )
                 except:
                     pass
                 
-                # Удаляем активный чат
-                if user_id in admin_active_chats:
-                    del admin_active_chats[user_id]
-                
                 await message.answer(
-                    f"🎉 <b>Комната создана!</b>\n\n"
-                    f"🏠 Название: <b>{room_name}</b>\n"
-                    f"👤 Пользователь: <code>{target_user_id}</code>\n"
-                    f"👤 Роль: <b>{role_name}</b>\n"
-                    f"🆔 ID комнаты: <code>{room_id}</code>\n\n"
-                    f"✅ Комната готова к использованию!",
+                    f"➖ <b>Доступ удален</b>\n\n"
+                    f"✅ Доступ к комнате '<b>{room['room_name']}</b>' удален у пользователя <code>{target_user_id}</code>.",
                     parse_mode="HTML",
                     reply_markup=get_back_to_menu_keyboard(True)
                 )
+            else:
+                # Добавление доступа
+                await db.add_room_access(room_id, target_user_id)
                 
-                if user_id in user_action_state:
-                    del user_action_state[user_id]
-                return
-            except Exception as e:
-                logger.error(f"Ошибка при создании комнаты из чата: {e}")
-                await message.answer(
-                    f"❌ <b>Ошибка</b>\n\n"
-                    f"Не удалось создать комнату: {str(e)}",
-                    parse_mode="HTML"
-                )
-                if user_id in user_action_state:
-                    del user_action_state[user_id]
-                return
-        
-        # Обработка ответа на отзыв (только для администраторов)
-        if action and action.startswith('review_reply_'):
-            try:
-                review_id = int(action.split("_")[2])
-                reply_text = text.strip()
-                
-                if not reply_text:
-                    await message.answer(
-                        "❌ <b>Ошибка</b>\n\n"
-                        "📝 Ответ не может быть пустым.\n\n"
-                        "💬 Пожалуйста, отправьте ваш ответ.",
+                # Уведомляем пользователя
+                try:
+                    await bot.send_message(
+                        target_user_id,
+                        "🎉 <b>Доступ предоставлен!</b>\n\n"
+                        f"🏠 Вам предоставлен доступ к комнате: <b>{room['room_name']}</b>\n\n"
+                        "💬 Теперь вы можете общаться в этой комнате.\n\n"
+                        "📂 Используйте <code>/my_rooms</code> чтобы войти в комнату.",
                         parse_mode="HTML"
                     )
-                    return
-                
-                # Добавляем ответ
-                await db.add_admin_reply(review_id, reply_text)
-                
-                # Получаем отзыв для уведомления автора
-                review = await db.get_review(review_id)
-                if review:
-                    try:
-                        await bot.send_message(
-                            review['user_id'],
-                            "👑 <b>Ответ на ваш отзыв</b>\n\n"
-                            f"💬 Администратор ответил на ваш отзыв:\n\n"
-                            f"{reply_text}",
-                            parse_mode="HTML"
-                        )
-                    except:
-                        pass
+                except:
+                    pass
                 
                 await message.answer(
-                    "✅ <b>Ответ добавлен!</b>\n\n"
-                    f"👑 Ваш ответ на отзыв успешно опубликован.",
+                    f"➕ <b>Доступ предоставлен</b>\n\n"
+                    f"✅ Доступ к комнате '<b>{room['room_name']}</b>' предоставлен пользователю <code>{target_user_id}</code>.",
                     parse_mode="HTML",
                     reply_markup=get_back_to_menu_keyboard(True)
                 )
-                
-                if user_id in user_action_state:
-                    del user_action_state[user_id]
-                return
-            except Exception as e:
-                await message.answer(
-                    f"❌ <b>Ошибка</b>\n\n"
-                    f"Не удалось добавить ответ: {str(e)}",
-                    parse_mode="HTML"
-                )
-                if user_id in user_action_state:
-                    del user_action_state[user_id]
-                return
+            
+            # Очищаем состояние
+            user_action_state.pop(user_id, None)
+            
+            return True
+        except Exception as e:
+            await message.answer(f"❌ Ошибка: {e}")
+            user_action_state.pop(user_id, None)
+            return True
+    return False
+
+
+@message_pipeline.stage('room_relay')
+async def stage_room_relay(ctx: MessageContext) -> bool:
+    """Пересылка сообщения участникам активной комнаты"""
+    message, user_id, text = ctx.message, ctx.user_id, ctx.text
+    # Только если нет ожидаемого ввода и это не Reply кнопка
+    if user_id not in user_active_rooms or user_id in user_action_state or text in REPLY_BUTTONS:
+        return False
+
+    room_id = user_active_rooms[user_id]
+    room = await db.get_room(room_id)
+    
+    if not room:
+        await message.answer(
+            "❌ <b>Ошибка</b>\n\n"
+            "🏠 Комната не найдена. Возможно, она была удалена.\n\n"
+            "💡 Используйте <code>/my_rooms</code> чтобы увидеть доступные комнаты.",
+            parse_mode="HTML"
+        )
+        del user_active_rooms[user_id]
+        return True
+    
+    # Определяем, является ли пользователь заказчиком
+    is_customer = (room['customer_id'] == user_id)
+    
+    # Формируем текст сообщения
+    message_text = text
+    if not message_text and message.caption:
+        message_text = message.caption
+    
+    # Получаем всех получателей одним запросом (роль, признак админа, уведомления)
+    members = await db.get_room_broadcast_recipients(room_id)
+    
+    # Формируем заголовок сообщения
+    if is_customer:
+        header = f"💬 <b>Сообщение из комнаты '{room['room_name']}':</b>\n\n"
+    else:
+        header = f"👨‍💻 <b>Разработчик в комнате '{room['room_name']}':</b>\n\n"
+    
+    # Выбираем получателей: все участники, кроме отправителя
+    # (администраторам вне комнаты - только при включенных уведомлениях)
+    recipients = []
+    members_outside_room = set()
+    for member in members:
+        if member['user_id'] == user_id:
+            continue
+        # Проверяем, находится ли пользователь в этой комнате
+        is_member_in_room = user_active_rooms.is_in(member['user_id'], room_id)
         
-        # Обработка редактирования пометок
-        if action and action.startswith('edit_notes_'):
-            try:
-                target_user_id = int(action.split("_")[2])
-                notes = text.strip() if text.strip() else ""  # Разрешаем пустую строку для удаления
-                await db.update_customer_notes(target_user_id, notes)
+        # Проверяем, является ли участник администратором
+        is_member_admin = member['is_admin'] or member['user_id'] in ADMIN_IDS
+        
+        # Если пользователь не в комнате, проверяем настройки уведомлений
+        if not is_member_in_room:
+            if is_member_admin and not member['notifications_enabled']:
+                continue  # Пропускаем, если уведомления выключены
+            # Для разработчиков и клиентов уведомления всегда включены
+            members_outside_room.add(member['user_id'])
+        recipients.append(member['user_id'])
+    
+    # Сообщение каждому получателю и уведомление тем, кто сейчас вне комнаты
+    entries = outbox_entries(recipients, build_forward_sends(message, header, message_text))
+    notification_text = (
+        f"🔔 <b>Новое сообщение в комнате</b>\n\n"
+        f"🏠 <b>Комната:</b> {room['room_name']}\n"
+        f"💬 Используйте <code>/my_rooms</code> чтобы войти в комнату."
+    )
+    entries += outbox_entries(
+        [member_id for member_id in recipients if member_id in members_outside_room],
+        [('send_message', {'text': notification_text, 'parse_mode': "HTML"})]
+    )
+    
+    # Сохраняем сообщение (если есть текст) вместе с рассылкой в outbox одной транзакцией;
+    # доставку выполняет фоновый диспетчер outbox
+    if message_text:
+        await db.save_message(room_id, user_id, message_text, is_customer, outbox=entries)
+    else:
+        await db.enqueue_outbox(entries)
+    
+    # Подтверждение отправителю
+    if is_customer:
+        await message.answer(
+            "✅ <b>Сообщение отправлено</b>\n\n"
+            "👨‍💻 Ваше сообщение доставлено разработчикам.",
+            parse_mode="HTML"
+        )
+    else:
+        await message.answer(
+            "✅ <b>Сообщение отправлено</b>\n\n"
+            "💬 Ваше сообщение доставлено в комнату.",
+            parse_mode="HTML"
+        )
+    return True
+
+
+@message_pipeline.stage('chat_relay')
+async def stage_chat_relay(ctx: MessageContext) -> bool:
+    """Пользователь не в комнате: ответ администратора в чат или сообщение пользователя администраторам"""
+    message, user_id, text = ctx.message, ctx.user_id, ctx.text
+    is_user_admin = await ctx.is_admin()
+    
+    if is_user_admin:
+        # Администратор может отвечать в активном чате
+        if user_id in admin_active_chats:
+            chat_id = admin_active_chats[user_id]
+            chat = await db.get_chat_by_chat_id(chat_id)
+            if chat:
+                target_user_id = chat['user_id']
                 
-                if notes:
-                    await message.answer(
-                        f"✅ <b>Пометки обновлены</b>\n\n"
-                        f"👤 Заказчик: <code>{target_user_id}</code>\n"
-                        f"📝 Пометки сохранены.",
-                        parse_mode="HTML",
-                        reply_markup=get_back_to_menu_keyboard(True)
-                    )
-                else:
-                    await message.answer(
-                        f"🗑️ <b>Пометки удалены</b>\n\n"
-                        f"👤 Заказчик: <code>{target_user_id}</code>\n"
-                        f"📝 Пометки успешно удалены.",
-                        parse_mode="HTML",
-                        reply_markup=get_back_to_menu_keyboard(True)
-                    )
+                # Формируем текст сообщения
+                message_text = text
+                if not message_text and message.caption:
+                    message_text = message.caption
                 
-                if user_id in user_action_state:
-                    del user_action_state[user_id]
-                return
-            except Exception as e:
-                await message.answer(
-                    f"❌ <b>Ошибка</b>\n\n"
-                    f"Не удалось обновить пометки: {str(e)}",
-                    parse_mode="HTML"
+                # Ответ пользователю доставляет outbox; сообщение и отправки сохраняются одной транзакцией
+                header = "💬 <b>Ответ от администратора:</b>\n\n"
+                entries = outbox_entries(
+                    [target_user_id], build_forward_sends(message, header, message_text, text_after_voice=True)
                 )
-                if user_id in user_action_state:
-                    del user_action_state[user_id]
-                return
-        
-        # Обработка создания комнаты
-        if action == 'create_room' and text.strip():
-            try:
-                # Проверяем, есть ли символ "|" и ID заказчика
-                if "|" in text and len(text.split("|")) == 2:
-                    parts = [p.strip() for p in text.split("|")]
-                    room_name = parts[0]
-                    customer_id_str = parts[1]
-                    
-                    # Если есть ID заказчика
-                    if room_name and customer_id_str.isdigit():
-                        customer_id = int(customer_id_str)
-                        room_id = await db.create_room(room_name, user_id, customer_id)
-                        
-                        # Добавляем заказчика в базу заказчиков и обновляем роль
-                        await db.update_user_role(customer_id, 'customer')
-                        await db.add_or_update_customer(customer_id)
-                        
-                        # Уведомляем заказчика
-                        try:
-                            await bot.send_message(
-                                customer_id,
-                                "🎉 <b>Новая комната создана!</b>\n\n"
-                                f"🏠 Вам предоставлен доступ к комнате: <b>{room_name}</b>\n\n"
-                                "💬 Теперь вы можете общаться с разработчиками в этой комнате.\n\n"
-                                "📂 Используйте <code>/my_rooms</code> чтобы войти в комнату.",
-                                parse_mode="HTML"
-                            )
-                        except:
-                            pass
-                        
-                        await message.answer(
-                            f"🎉 <b>Комната создана!</b>\n\n"
-                            f"🏠 Название: <b>{room_name}</b>\n"
-                            f"🆔 ID: <code>{room_id}</code>\n"
-                            f"👤 Заказчик: <code>{customer_id}</code>\n\n"
-                            f"✅ Заказчик получил уведомление о создании комнаты.",
-                            parse_mode="HTML",
-                            reply_markup=get_back_to_menu_keyboard(True)
-                        )
-                    else:
-                        await message.answer(
-                            "❌ <b>Ошибка</b>\n\n"
-                            "⚠️ Неверный формат. Используйте:\n"
-                            "<code>Название | ID заказчика</code>\n\n"
-                            "или просто:\n"
-                            "<code>Название</code>",
-                            parse_mode="HTML"
-                        )
-                        return
+                if message_text:
+                    await db.save_chat_message(chat_id, user_id, message_text, False, outbox=entries)
                 else:
-                    # Создаем комнату без заказчика
-                    room_name = text.strip()
-                    if room_name:
-                        room_id = await db.create_room(room_name, user_id, None)
-                        
-                        await message.answer(
-                            f"🎉 <b>Комната создана!</b>\n\n"
-                            f"🏠 Название: <b>{room_name}</b>\n"
-                            f"🆔 ID: <code>{room_id}</code>\n\n"
-                            f"💡 Заказчика можно добавить позже через управление комнатой.",
-                            parse_mode="HTML",
-                            reply_markup=get_back_to_menu_keyboard(True)
-                        )
-                    else:
-                        await message.answer(
-                            "❌ <b>Ошибка</b>\n\n"
-                            "⚠️ Название комнаты не может быть пустым.",
-                            parse_mode="HTML"
-                        )
-                        return
-                
-                # Очищаем состояние
-                if user_id in user_action_state:
-                    del user_action_state[user_id]
-                return
-            except Exception as e:
+                    await db.enqueue_outbox(entries)
+                return True
+            else:
                 await message.answer(
-                    f"❌ <b>Ошибка при создании комнаты</b>\n\n"
-                    f"🔍 Детали: {str(e)}",
+                    "ℹ️ <b>Информация</b>\n\n"
+                    "😊 Вы не находитесь ни в одной комнате.\n\n"
+                    "💡 Используйте <code>/my_rooms</code> или кнопку 'Чаты' чтобы начать работу.",
                     parse_mode="HTML"
                 )
-                if user_id in user_action_state:
-                    del user_action_state[user_id]
-                return
-        
-        # Обработка создания комнаты и управления доступом (старая логика для обратной совместимости)
-        if "|" in text and len(text.split("|")) == 2:
-            parts = [p.strip() for p in text.split("|")]
-            
-            # Добавление/удаление доступа: "ID комнаты | ID пользователя"
-            if parts[0].isdigit() and parts[1].isdigit():
-                try:
-                    room_id = int(parts[0])
-                    target_user_id = int(parts[1])
-                    
-                    # Проверяем существование комнаты
-                    room = await db.get_room(room_id)
-                    if not room:
-                        await message.answer(
-                            f"❌ <b>Ошибка</b>\n\n"
-                            f"🏠 Комната с ID <code>{room_id}</code> не найдена.",
-                            parse_mode="HTML"
-                        )
-                        if user_id in user_action_state:
-                            del user_action_state[user_id]
-                        return
-                    
-                    action = user_action_state.get(user_id, 'add_access')
-                    
-                    if action == 'remove_access':
-                        # Удаление доступа
-                        await db.remove_room_access(room_id, target_user_id)
-                        
-                        # Удаляем из активных комнат, если пользователь был в этой комнате
-                        if target_user_id in user_active_rooms and user_active_rooms[target_user_id] == room_id:
-                            del user_active_rooms[target_user_id]
-                        
-                        # Уведомляем пользователя
-                        try:
-                            await bot.send_message(
-                                target_user_id,
-                                f"🚫 <b>Доступ удален</b>\n\n"
-                                f"❌ Вам был удален доступ к комнате: <b>{room['room_name']}</b>",
-                                parse_mode="HTML"
-                            )
-                        except:
-                            pass
-                        
-                        await message.answer(
-                            f"➖ <b>Доступ удален</b>\n\n"
-                            f"✅ Доступ к комнате '<b>{room['room_name']}</b>' удален у пользователя <code>{target_user_id}</code>.",
-                            parse_mode="HTML",
-                            reply_markup=get_back_to_menu_keyboard(True)
-                        )
-                    else:
-                        # Добавление доступа
-                        await db.add_room_access(room_id, target_user_id)
-                        
-                        # Уведомляем пользователя
-                        try:
-                            await bot.send_message(
-                                target_user_id,
-                                "🎉 <b>Доступ предоставлен!</b>\n\n"
-                                f"🏠 Вам предоставлен доступ к комнате: <b>{room['room_name']}</b>\n\n"
-                                "💬 Теперь вы можете общаться в этой комнате.\n\n"
-                                "📂 Используйте <code>/my_rooms</code> чтобы войти в комнату.",
-                                parse_mode="HTML"
-                            )
-                        except:
-                            pass
-                        
-                        await message.answer(
-                            f"➕ <b>Доступ предоставлен</b>\n\n"
-                            f"✅ Доступ к комнате '<b>{room['room_name']}</b>' предоставлен пользователю <code>{target_user_id}</code>.",
-                            parse_mode="HTML",
-                            reply_markup=get_back_to_menu_keyboard(True)
-                        )
-                    
-                    # Очищаем состояние
-                    if user_id in user_action_state:
-                        del user_action_state[user_id]
-                    
-                    return
-                except Exception as e:
-                    await message.answer(f"❌ Ошибка: {e}")
-                    if user_id in user_action_state:
-                        del user_action_state[user_id]
-                    return
-    
-    # Обработка обычных сообщений в комнатах
-    # НО только если нет активных действий управления и это не Reply кнопка
-    reply_buttons_list = ["🏠 Создать комнату", "📂 Мои комнаты", "🌐 Все комнаты", 
-                         "➕ Добавить доступ", "➖ Удалить доступ", "🗑️ Удалить комнату",
-                         "👑 Управление ролями", "🚪 Выйти из комнаты", "🔙 Главное меню",
-                         "✏️ Изменить название", "➕ Добавить участника", "👥 Участники"]
-    
-    if user_id in user_active_rooms and user_id not in user_action_state and user_id not in room_access_state and text not in reply_buttons_list:
-        room_id = user_active_rooms[user_id]
-        room = await db.get_room(room_id)
-        
-        if not room:
+        else:
             await message.answer(
-                "❌ <b>Ошибка</b>\n\n"
-                "🏠 Комната не найдена. Возможно, она была удалена.\n\n"
-                "💡 Используйте <code>/my_rooms</code> чтобы увидеть доступные комнаты.",
+                "ℹ️ <b>Информация</b>\n\n"
+                "😊 Вы не находитесь ни в одной комнате.\n\n"
+                "💡 Используйте <code>/my_rooms</code> или кнопку 'Чаты' чтобы начать работу.",
                 parse_mode="HTML"
             )
-            del user_active_rooms[user_id]
-            return
-        
-        # Определяем, является ли пользователь заказчиком
-        is_customer = (room['customer_id'] == user_id)
-        
+    else:
+        # Обычный пользователь пишет в чат
         # Формируем текст сообщения
         message_text = text
         if not message_text and message.caption:
             message_text = message.caption
         
-        # Сохраняем сообщение (если есть текст)
-        if message_text:
-            await db.save_message(room_id, user_id, message_text, is_customer)
-        
-        # Получаем всех участников комнаты
-        members = await db.get_room_members(room_id)
+        # Отправляем сообщение всем администраторам
+        header = f"💬 <b>Новое сообщение от пользователя:</b>\n\n"
+        user_info = f"👤 <b>Пользователь:</b> {message.from_user.full_name or 'Без имени'}\n"
+        if message.from_user.username:
+            user_info += f"📱 <b>Username:</b> @{message.from_user.username}\n"
+        user_info += f"🆔 <b>ID:</b> <code>{user_id}</code>\n\n"
         
-        # Формируем заголовок сообщения
-        if is_customer:
-            header = f"💬 <b>Сообщение из комнаты '{room['room_name']}':</b>\n\n"
-        else:
-            header = f"👨‍💻 <b>Разработчик в комнате '{room['room_name']}':</b>\n\n"
+        entries = outbox_entries(
+            ADMIN_IDS, build_forward_sends(message, header + user_info, message_text, text_after_voice=True)
+        )
         
-        # Отправляем сообщение всем участникам, кроме отправителя
-        for member in members:
-            if member['user_id'] != user_id:
-                # Проверяем, находится ли пользователь в этой комнате
-                is_member_in_room = (member['user_id'] in user_active_rooms and 
-                                   user_active_rooms[member['user_id']] == room_id)
-                
-                # Проверяем, является ли участник администратором
-                is_member_admin = await check_is_admin(member['user_id'])
-                
-                # Если пользователь не в комнате, проверяем настройки уведомлений
-                notification_enabled = True  # По умолчанию включено
-                if not is_member_in_room:
-                    if is_member_admin:
-                        # Для администраторов проверяем настройки уведомлений
-                        notification_enabled = await db.get_room_notification(member['user_id'], room_id)
-                        if not notification_enabled:
-                            continue  # Пропускаем, если уведомления выключены
-                    # Для разработчиков и клиентов уведомления всегда включены (notification_enabled = True)
-                
-                try:
-                    # Отправляем медиа-файлы или текстовые сообщения
-                    if message.photo:
-                        # Фото
-                        await bot.send_photo(
-                            member['user_id'],
-                            message.photo[-1].file_id,
-                            caption=header + message_text if message_text else header.rstrip(),
-                            parse_mode="HTML"
-                        )
-                    elif message.video:
-                        # Видео
-                        await bot.send_video(
-                            member['user_id'],
-                            message.video.file_id,
-                            caption=header + message_text if message_text else header.rstrip(),
-                            parse_mode="HTML"
-                        )
-                    elif message.document:
-                        # Документ
-                        await bot.send_document(
-                            member['user_id'],
-                            message.document.file_id,
-                            caption=header + message_text if message_text else header.rstrip(),
-                            parse_mode="HTML"
-                        )
-                    elif message.audio:
-                        # Аудио
-                        await bot.send_audio(
-                            member['user_id'],
-                            message.audio.file_id,
-                            caption=header + message_text if message_text else header.rstrip(),
-                            parse_mode="HTML"
-                        )
-                    elif message.voice:
-                        # Голосовое сообщение
-                        await bot.send_voice(
-                            member['user_id'],
-                            message.voice.file_id,
-                            caption=header.rstrip() if not message_text else None,
-                            parse_mode="HTML"
-                        )
-                    elif message.video_note:
-                        # Видео-кружок
-                        await bot.send_video_note(
-                            member['user_id'],
-                            message.video_note.file_id
-                        )
-                        if message_text:
-                            await bot.send_message(
-                                member['user_id'],
-                                header + message_text,
-                                parse_mode="HTML"
-                            )
-                    elif message.sticker:
-                        # Стикер
-                        await bot.send_sticker(
-                            member['user_id'],
-                            message.sticker.file_id
-                        )
-                        if message_text:
-                            await bot.send_message(
-                                member['user_id'],
-                                header + message_text,
-                                parse_mode="HTML"
-                            )
-                    elif message_text:
-                        # Текстовое сообщение
-                        await bot.send_message(
-                            member['user_id'],
-                            header + message_text,
-                            parse_mode="HTML"
-                        )
-                    
-                    # Если пользователь не в комнате, отправляем уведомление с названием комнаты
-                    if not is_member_in_room:
-                        # notification_enabled уже проверено выше для администраторов
-                        # Для разработчиков и клиентов всегда отправляем уведомление
-                        notification_text = (
-                            f"🔔 <b>Новое сообщение в комнате</b>\n\n"
-                            f"🏠 <b>Комната:</b> {room['room_name']}\n"
-                            f"💬 Используйте <code>/my_rooms</code> чтобы войти в комнату."
-                        )
-                        try:
-                            await bot.send_message(
-                                member['user_id'],
-                                notification_text,
-                                parse_mode="HTML"
-                            )
-                        except Exception as e:
-                            logger.error(f"Ошибка отправки уведомления пользователю {member['user_id']}: {e}")
-                except Exception as e:
-                    logger.error(f"Ошибка отправки сообщения пользователю {member['user_id']}: {e}")
-        
-        # Подтверждение отправителю
-        if is_customer:
-            await message.answer(
-                "✅ <b>Сообщение отправлено</b>\n\n"
-                "👨‍💻 Ваше сообщение доставлено разработчикам.",
-                parse_mode="HTML"
-            )
-        else:
-            await message.answer(
-                "✅ <b>Сообщение отправлено</b>\n\n"
-                "💬 Ваше сообщение доставлено в комнату.",
-                parse_mode="HTML"
-            )
-    else:
-        # Пользователь не в комнате
-        is_user_admin = await check_is_admin(user_id) or is_admin(user_id)
+        # Одной транзакцией: профиль пользователя, чат, сообщение, заказчик (кроме админов
+        # и разработчиков) и пересылка администраторам через outbox
+        await db.record_user_chat_message(
+            user_id, message.from_user.username, message.from_user.full_name, 'user', message_text, outbox=entries
+        )
         
-        if is_user_admin:
-            # Администратор может отвечать в активном чате
-            if user_id in admin_active_chats:
-                chat_id = admin_active_chats[user_id]
-                chat = await db.get_chat_by_chat_id(chat_id)
-                if chat:
-                    target_user_id = chat['user_id']
-                    
-                    # Формируем текст сообщения
-                    message_text = text
-                    if not message_text and message.caption:
-                        message_text = message.caption
-                    
-                    # Сохраняем сообщение в чат
-                    if message_text:
-                        await db.save_chat_message(chat_id, user_id, message_text, False)
-                    
-                    # Отправляем сообщение пользователю
-                    header = "💬 <b>Ответ от администратора:</b>\n\n"
-                    try:
-                        if message.photo:
-                            await bot.send_photo(
-                                target_user_id,
-                                message.photo[-1].file_id,
-                                caption=header + message_text if message_text else header.rstrip(),
-                                parse_mode="HTML"
-                            )
-                        elif message.video:
-                            await bot.send_video(
-                                target_user_id,
-                                message.video.file_id,
-                                caption=header + message_text if message_text else header.rstrip(),
-                                parse_mode="HTML"
-                            )
-                        elif message.document:
-                            await bot.send_document(
-                                target_user_id,
-                                message.document.file_id,
-                                caption=header + message_text if message_text else header.rstrip(),
-                                parse_mode="HTML"
-                            )
-                        elif message.audio:
-                            await bot.send_audio(
-                                target_user_id,
-                                message.audio.file_id,
-                                caption=header + message_text if message_text else header.rstrip(),
-                                parse_mode="HTML"
-                            )
-                        elif message.voice:
-                            await bot.send_voice(
-                                target_user_id,
-                                message.voice.file_id,
-                                caption=header.rstrip() if not message_text else None,
-                                parse_mode="HTML"
-                            )
-                        elif message.video_note:
-                            await bot.send_video_note(
-                                target_user_id,
-                                message.video_note.file_id
-                            )
-                            if message_text:
-                                await bot.send_message(
-                                    target_user_id,
-                                    header + message_text,
-                                    parse_mode="HTML"
-                                )
-                        elif message.sticker:
-                            await bot.send_sticker(
-                                target_user_id,
-                                message.sticker.file_id
-                            )
-                            if message_text:
-                                await bot.send_message(
-                                    target_user_id,
-                                    header + message_text,
-                                    parse_mode="HTML"
-                                )
-                        else:
-                            await bot.send_message(
-                                target_user_id,
-                                header + message_text,
-                                parse_mode="HTML"
-                            )
-                        
-                        # Убираем подтверждение отправки в чате
-                        # await message.answer(
-                        #     "✅ <b>Сообщение отправлено</b>\n\n"
-                        #     "💬 Ваш ответ доставлен пользователю.",
-                        #     parse_mode="HTML"
-                        # )
-                    except Exception as e:
-                        await message.answer(
-                            f"❌ <b>Ошибка отправки</b>\n\n"
-                            f"Не удалось отправить сообщение: {str(e)}",
-                            parse_mode="HTML"
-                        )
-                    return
-                else:
-                    await message.answer(
-                        "ℹ️ <b>Информация</b>\n\n"
-                        "😊 Вы не находитесь ни в одной комнате.\n\n"
-                        "💡 Используйте <code>/my_rooms</code> или кнопку 'Чаты' чтобы начать работу.",
-                        parse_mode="HTML"
-                    )
-            else:
-                await message.answer(
-                    "ℹ️ <b>Информация</b>\n\n"
-                    "😊 Вы не находитесь ни в одной комнате.\n\n"
-                    "💡 Используйте <code>/my_rooms</code> или кнопку 'Чаты' чтобы начать работу.",
-                    parse_mode="HTML"
-                )
-        else:
-            # Обычный пользователь пишет в чат
-            # Сначала убеждаемся, что пользователь добавлен в базу
-            username = message.from_user.username
-            full_name = message.from_user.full_name
-            is_user_admin = await check_is_admin(user_id)
-            role = 'admin' if is_user_admin else 'user'
-            await db.add_user(user_id, username, full_name, role)
-            
-            # Создаем или получаем чат
-            chat_id = await db.get_or_create_chat(user_id)
-            
-            # Формируем текст сообщения
-            message_text = text
-            if not message_text and message.caption:
-                message_text = message.caption
-            
-            # Сохраняем сообщение в чат
-            if message_text:
-                await db.save_chat_message(chat_id, user_id, message_text, True)
-            
-            # Добавляем в базу заказчиков всех, кто пишет, кроме админов и разработчиков
-            user_role = await db.get_user_role(user_id)
-            # Добавляем если не админ и не разработчик
-            if not is_user_admin and user_role != 'developer':
-                await db.add_or_update_customer(user_id)
-            
-            # Отправляем сообщение всем администраторам
-            header = f"💬 <b>Новое сообщение от пользователя:</b>\n\n"
-            user_info = f"👤 <b>Пользователь:</b> {message.from_user.full_name or 'Без имени'}\n"
-            if message.from_user.username:
-                user_info += f"📱 <b>Username:</b> @{message.from_user.username}\n"
-            user_info += f"🆔 <b>ID:</b> <code>{user_id}</code>\n\n"
-            
-            for admin_id in ADMIN_IDS:
-                try:
-                    if message.photo:
-                        await bot.send_photo(
-                            admin_id,
-                            message.photo[-1].file_id,
-                            caption=header + user_info + message_text if message_text else header + user_info.rstrip(),
-                            parse_mode="HTML"
-                        )
-                    elif message.video:
-                        await bot.send_video(
-                            admin_id,
-                            message.video.file_id,
-                            caption=header + user_info + message_text if message_text else header + user_info.rstrip(),
-                            parse_mode="HTML"
-                        )
-                    elif message.document:
-                        await bot.send_document(
-                            admin_id,
-                            message.document.file_id,
-                            caption=header + user_info + message_text if message_text else header + user_info.rstrip(),
-                            parse_mode="HTML"
-                        )
-                    elif message.audio:
-                        await bot.send_audio(
-                            admin_id,
-                            message.audio.file_id,
-                            caption=header + user_info + message_text if message_text else header + user_info.rstrip(),
-                            parse_mode="HTML"
-                        )
-                    elif message.voice:
-                        await bot.send_voice(
-                            admin_id,
-                            message.voice.file_id,
-                            caption=header.rstrip() if not message_text else None,
-                            parse_mode="HTML"
-                        )
-                        if message_text:
-                            await bot.send_message(
-                                admin_id,
-                                header + user_info + message_text,
-                                parse_mode="HTML"
-                            )
-                    elif message.video_note:
-                        await bot.send_video_note(
-                            admin_id,
-                            message.video_note.file_id
-                        )
-                        if message_text:
-                            await bot.send_message(
-                                admin_id,
-                                header + user_info + message_text,
-                                parse_mode="HTML"
-                            )
-                    elif message.sticker:
-                        await bot.send_sticker(
-                            admin_id,
-                            message.sticker.file_id
-                        )
-                        if message_text:
-                            await bot.send_message(
-                                admin_id,
-                                header + user_info + message_text,
-                                parse_mode="HTML"
-                            )
-                    else:
-                        await bot.send_message(
-                            admin_id,
-                            header + user_info + message_text,
-                            parse_mode="HTML"
-                        )
-                except Exception as e:
-                    logger.error(f"Ошибка отправки сообщения администратору {admin_id}: {e}")
-            
-            # Подтверждение пользователю
-            await message.answer(
-                "✅ <b>Сообщение получено</b>\n\n"
-                "💬 Ваше сообщение доставлено администраторам.\n"
-                "⏳ Мы свяжемся с вами в ближайшее время.",
-                parse_mode="HTML"
-            )
-
+        # Подтверждение пользователю
+        await message.answer(
+            "✅ <b>Сообщение получено</b>\n\n"
+            "💬 Ваше сообщение доставлено администраторам.\n"
+            "⏳ Мы свяжемся с вами в ближайшее время.",
+            parse_mode="HTML"
+        )
+    return True
 
 async def main():
     """Главная функция запуска бота"""
     # Инициализация базы данных
     await db.init_db()
+    pragmas = await db.get_pragma_report()
+    logger.info(
+        f"Профиль SQLite: {db.pragma_profile} ("
+        + ", ".join(f"{name}={value}" for name, value in pragmas.items())
+        + ")"
+    )
+    
+    # Восстанавливаем активные комнаты, чаты и ожидаемый ввод с прошлого запуска
+    await sessions.load()
+    sessions.start()
     
     # Устанавливаем админов в базе
     for admin_id in ADMIN_IDS:
@@ -3754,8 +3843,25 @@ async def main():
     
     logger.info("Бот запущен!")
     
+    # Доставка сообщений, оставшихся в outbox (в том числе с прошлого запуска)
+    outbox.start()
+    archiver.start()
+    
     # Запуск бота
-    await dp.start_polling(bot)
+    try:
+        await dp.start_polling(bot)
+    finally:
+        # Останавливаем доставку, сохраняем состояние сессий и закрываем пул соединений с базой данных
+        await outbox.stop()
+        await archiver.stop()
+        await sessions.stop()
+        logger.info(f"Состояние сессий: {sessions.get_stats()}")
+        logger.info(f"Архивация переписки: {archiver.get_stats()}")
+        logger.info(f"Ограничение отправок: {rate_limiter.get_stats()}")
+        logger.info(f"Этапы обработки сообщений: {message_pipeline.get_stats()}")
+        logger.info(f"Кэши базы данных: {db.get_cache_stats()}")
+        logger.info(f"Запись в базу данных: {db.get_write_stats()}")
+        await db.close()
 
 
 if __name__ == "__main__":
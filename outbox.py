@@ -0,0 +1,148 @@
+import asyncio
+import logging
+import time
+from typing import Dict, List, Optional, Tuple
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+from aiogram.types import InlineKeyboardMarkup
+
+from database import Database
+from fanout import FanOut
+
+logger = logging.getLogger(__name__)
+
+
+def outbox_entries(recipients, sends: List[Tuple[str, Dict]]) -> List[Tuple[int, str, Dict]]:
+    """Размножить список отправок (метод bot.send_*, параметры) на всех получателей"""
+    return [(recipient_id, method, params) for recipient_id in recipients for method, params in sends]
+
+
+class OutboxDispatcher:
+    """Фоновая доставка исходящих сообщений из таблицы outbox.
+
+    Доставка "хотя бы один раз": сообщение отмечается доставленным только после
+    успешной отправки. Временные ошибки повторяются с экспоненциальной задержкой,
+    доставленные строки удаляются порциями, недоставляемые - через failed_retention секунд.
+    """
+
+    def __init__(
+        self,
+        db: Database,
+        bot: Bot,
+        fanout: FanOut,
+        batch_size: int,
+        poll_interval: float,
+        max_attempts: int,
+        retry_base_delay: float,
+        retry_max_delay: float,
+        compact_batch_size: int,
+        failed_retention: float,
+    ):
+        self.db = db
+        self.bot = bot
+        self.fanout = fanout
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.retry_base_delay = retry_base_delay
+        self.retry_max_delay = retry_max_delay
+        self.compact_batch_size = compact_batch_size
+        self.failed_retention = failed_retention
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+
+    def start(self):
+        """Запустить фоновую доставку"""
+        if self._task is None:
+            self._stopping = False
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Остановить фоновую доставку (недоставленное останется в outbox)"""
+        if self._task is None:
+            return
+        self._stopping = True
+        self.db.outbox_ready.set()
+        await self._task
+        self._task = None
+
+    async def _run(self):
+        """Цикл доставки: отправляем готовые сообщения, в простое уплотняем outbox"""
+        while not self._stopping:
+            self.db.outbox_ready.clear()
+            try:
+                delivered = await self.dispatch_once()
+                if delivered:
+                    continue
+                await self._compact()
+            except Exception as e:
+                logger.error(f"Ошибка доставки сообщений из outbox: {e}")
+            try:
+                await asyncio.wait_for(self.db.outbox_ready.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def _retry_delay(self, attempts: int, retry_after: float = 0) -> float:
+        """Экспоненциальная задержка перед повтором (не меньше, чем просит Telegram)"""
+        delay = min(self.retry_max_delay, self.retry_base_delay * (2 ** attempts))
+        return max(delay, retry_after)
+
+    async def _send(self, row: Dict):
+        """Выполнить сохраненный вызов bot.send_*"""
+        method = row['method']
+        if not method.startswith('send_'):
+            raise ValueError(f"Недопустимый метод outbox: {method}")
+        params = dict(row['params'])
+        if 'reply_markup' in params:
+            params['reply_markup'] = InlineKeyboardMarkup.model_validate(params['reply_markup'])
+        await getattr(self.bot, method)(row['chat_id'], **params)
+
+    async def dispatch_once(self) -> int:
+        """Отправить одну порцию готовых сообщений; возвращает количество обработанных"""
+        rows = await self.db.get_due_outbox(self.batch_size)
+        if not rows:
+            return 0
+
+        # Сообщения одного чата отправляем последовательно, разные чаты - параллельно
+        by_chat: Dict[int, List[Dict]] = {}
+        for row in rows:
+            by_chat.setdefault(row['chat_id'], []).append(row)
+
+        sent: List[int] = []
+        retries: List[Tuple[int, float, str]] = []
+        failures: List[Tuple[int, str]] = []
+
+        async def deliver_chat(chat_id: int):
+            for row in by_chat[chat_id]:
+                try:
+                    await self._send(row)
+                    sent.append(row['id'])
+                except (TelegramForbiddenError, TelegramBadRequest, ValueError) as e:
+                    # Бот заблокирован, чат не найден или запрос некорректен - повтор не поможет
+                    logger.warning(f"Сообщение outbox {row['id']} для {chat_id} не может быть доставлено: {e}")
+                    failures.append((row['id'], str(e)))
+                except Exception as e:
+                    attempts = row['attempts'] + 1
+                    if attempts >= self.max_attempts:
+                        logger.error(f"Сообщение outbox {row['id']} для {chat_id} не доставлено за {attempts} попыток: {e}")
+                        failures.append((row['id'], str(e)))
+                        continue
+                    retry_after = e.retry_after if isinstance(e, TelegramRetryAfter) else 0
+                    retries.append((row['id'], self._retry_delay(row['attempts'], retry_after), str(e)))
+                    # Остальные сообщения этого чата ждут повтора, чтобы не нарушить порядок
+                    return
+
+        await self.fanout.send(list(by_chat), deliver_chat)
+        await self.db.mark_outbox_sent(sent)
+        await self.db.reschedule_outbox(retries)
+        await self.db.mark_outbox_failed(failures)
+        return len(rows)
+
+    async def _compact(self):
+        """Удалить порциями доставленные сообщения и недоставляемые старше срока хранения"""
+        failed_before = time.time() - self.failed_retention
+        while not self._stopping:
+            deleted = await self.db.compact_outbox(self.compact_batch_size, failed_before)
+            if deleted < self.compact_batch_size:
+                break
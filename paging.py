@@ -0,0 +1,45 @@
+from typing import Awaitable, Callable, Dict
+
+from aiogram.utils.keyboard import InlineKeyboardBuilder
+
+from callbacks import CallbackRouter
+
+# Направление перехода в callback_data (коротко: лимит Telegram 64 байта)
+_DIRECTIONS = {'n': 'next', 'p': 'prev'}
+
+
+class Paginator:
+    """Кнопки «Назад/Вперед» для постраничного списка из Database.get_*_page.
+
+    Кнопка перехода кодирует курсор страницы (направление, время, id) и номер
+    страницы для отображения: "v1:<действие>:<доп. аргументы>:n:2:1700000000:15".
+    """
+
+    def __init__(self, router: CallbackRouter, action: str, *arg_types: type):
+        self.router = router
+        self.action = action
+        self.arg_types = arg_types
+
+    def route(self, handler: Callable[..., Awaitable]):
+        """Декоратор: обработчик страницы handler(callback, *доп. аргументы, cursor, page_no)"""
+        @self.router.route(self.action, *self.arg_types, str, int, int, int)
+        async def open_page(callback, *args):
+            *extra, direction, page_no, key, row_id = args
+            if direction not in _DIRECTIONS:
+                await callback.answer()
+                return
+            await handler(callback, *extra, cursor=(_DIRECTIONS[direction], key, row_id), page_no=page_no)
+        return handler
+
+    def add_buttons(self, builder: InlineKeyboardBuilder, page: Dict, page_no: int, *args) -> int:
+        """Добавить кнопки перехода для страницы; возвращает количество добавленных кнопок"""
+        buttons = 0
+        if page['prev']:
+            _, key, row_id = page['prev']
+            builder.button(text="◀️ Назад", callback_data=self.router.pack(self.action, *args, 'p', page_no - 1, key, row_id))
+            buttons += 1
+        if page['next']:
+            _, key, row_id = page['next']
+            builder.button(text="Вперед ▶️", callback_data=self.router.pack(self.action, *args, 'n', page_no + 1, key, row_id))
+            buttons += 1
+        return buttons
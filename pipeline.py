@@ -0,0 +1,69 @@
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from aiogram.types import Message
+
+
+class MessageContext:
+    """Входящее сообщение и данные, которые нужны нескольким этапам обработки"""
+
+    def __init__(self, message: Message, admin_check: Callable[[int], Awaitable[bool]]):
+        self.message = message
+        self.user_id = message.from_user.id
+        self.text = message.text or message.caption or ""
+        self._admin_check = admin_check
+        self._is_admin: Optional[bool] = None
+
+    async def is_admin(self) -> bool:
+        """Является ли отправитель администратором (проверяется один раз на сообщение)"""
+        if self._is_admin is None:
+            self._is_admin = await self._admin_check(self.user_id)
+        return self._is_admin
+
+
+class MessagePipeline:
+    """Последовательные этапы обработки сообщения с замером времени каждого этапа.
+
+    Этап - корутина, принимающая MessageContext; если она вернула True,
+    сообщение обработано и следующие этапы не вызываются.
+    """
+
+    def __init__(self):
+        self._stages: List[Tuple[str, Callable[[MessageContext], Awaitable[bool]]]] = []
+        # Этап -> [количество вызовов, суммарное время, максимальное время] (секунды)
+        self._timings: Dict[str, List[float]] = {}
+
+    def stage(self, name: str):
+        """Декоратор: добавить этап в конец конвейера"""
+        def decorator(stage):
+            self._stages.append((name, stage))
+            self._timings[name] = [0, 0.0, 0.0]
+            return stage
+        return decorator
+
+    async def run(self, ctx: MessageContext) -> Optional[str]:
+        """Прогнать сообщение по этапам; возвращает имя этапа, который его обработал"""
+        for name, stage in self._stages:
+            started = time.perf_counter()
+            try:
+                handled = await stage(ctx)
+            finally:
+                elapsed = time.perf_counter() - started
+                timing = self._timings[name]
+                timing[0] += 1
+                timing[1] += elapsed
+                timing[2] = max(timing[2], elapsed)
+            if handled:
+                return name
+        return None
+
+    def get_stats(self) -> Dict[str, Dict]:
+        """Статистика времени этапов: вызовы, среднее и максимальное время (мс)"""
+        return {
+            name: {
+                'calls': int(calls),
+                'avg_ms': round(total / calls * 1000, 3) if calls else 0.0,
+                'max_ms': round(longest * 1000, 3),
+            }
+            for name, (calls, total, longest) in self._timings.items()
+        }
@@ -0,0 +1,160 @@
+import asyncio
+import logging
+import time
+from typing import Dict, Optional
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Корзина токенов: rate токенов в секунду, не больше capacity подряд"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        # До этого момента отправки запрещены (после ответа 429 от Telegram)
+        self.blocked_until = 0.0
+        # asyncio.Lock выдает доступ по очереди, поэтому ожидающие обслуживаются честно
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float):
+        """Начислить токены за прошедшее время"""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def block(self, seconds: float):
+        """Запретить отправки на указанное время"""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def is_idle(self) -> bool:
+        """Корзина полна и никто ее не ждет - ее можно удалить"""
+        now = time.monotonic()
+        self._refill(now)
+        return not self._lock.locked() and self.tokens >= self.capacity and now >= self.blocked_until
+
+    async def acquire(self) -> float:
+        """Взять один токен; возвращает время ожидания в секундах"""
+        waited = 0.0
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.blocked_until:
+                    delay = self.blocked_until - now
+                else:
+                    self._refill(now)
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return waited
+                    delay = (1 - self.tokens) / self.rate
+                await asyncio.sleep(delay)
+                waited += delay
+
+
+class RateLimiter(BaseRequestMiddleware):
+    """Ограничение исходящих запросов к Telegram для всех вызовов bot.*.
+
+    Новые сообщения в чат (методы send*, forwardMessage, copyMessage) проходят
+    через корзину чата и общую корзину бота, остальные запросы с chat_id
+    (правки, ответы) - только через общую корзину. При ответе 429
+    (TelegramRetryAfter) чат блокируется на указанное время, а запрос
+    ставится в очередь заново.
+    """
+
+    # Количество корзин чатов, после которого удаляются неактивные
+    _PRUNE_THRESHOLD = 10000
+    # Методы, которые публикуют новое сообщение и расходуют лимит чата
+    _CHAT_LIMITED_PREFIXES = ('send', 'forwardMessage', 'copyMessage')
+
+    def __init__(
+        self,
+        global_rate: float,
+        chat_rate: float,
+        chat_burst: float,
+        group_rate: float,
+        max_retries: int,
+    ):
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chat_rate = chat_rate
+        self._chat_burst = chat_burst
+        self._group_rate = group_rate
+        self._max_retries = max_retries
+        self._chats: Dict[int, TokenBucket] = {}
+        # Метрики
+        self._throttled_seconds = 0.0
+        self._throttled_requests = 0
+        self._retry_after_count = 0
+        self._dropped_requests = 0
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        """Получить (или создать) корзину чата"""
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= self._PRUNE_THRESHOLD:
+                self._prune()
+            if chat_id < 0:
+                # Группы: не больше 20 сообщений в минуту
+                bucket = TokenBucket(self._group_rate, 1)
+            else:
+                bucket = TokenBucket(self._chat_rate, self._chat_burst)
+            self._chats[chat_id] = bucket
+        return bucket
+
+    def _prune(self):
+        """Удалить корзины чатов, которые сейчас не используются"""
+        for chat_id in [chat_id for chat_id, bucket in self._chats.items() if bucket.is_idle()]:
+            del self._chats[chat_id]
+
+    async def _throttle(self, chat_bucket: Optional[TokenBucket]):
+        """Дождаться токенов чата и бота, учитывая время ожидания в метриках"""
+        waited = 0.0
+        if chat_bucket is not None:
+            waited += await chat_bucket.acquire()
+        waited += await self._global.acquire()
+        if waited > 0:
+            self._throttled_seconds += waited
+            self._throttled_requests += 1
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        if not isinstance(chat_id, int):
+            # Запросы без чата (ответы на callback, getUpdates и т.п.) не ограничиваем
+            return await make_request(bot, method)
+
+        chat_bucket = None
+        if method.__api_method__.startswith(self._CHAT_LIMITED_PREFIXES):
+            chat_bucket = self._chat_bucket(chat_id)
+        attempt = 0
+        while True:
+            await self._throttle(chat_bucket)
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                self._retry_after_count += 1
+                if chat_bucket is not None:
+                    chat_bucket.block(e.retry_after)
+                if attempt >= self._max_retries:
+                    self._dropped_requests += 1
+                    raise
+                attempt += 1
+                logger.warning(
+                    f"Превышен лимит Telegram для чата {chat_id}: повтор через {e.retry_after} с "
+                    f"(попытка {attempt} из {self._max_retries})"
+                )
+                if chat_bucket is None:
+                    # Правки и ответы не блокируют отправку новых сообщений в чат
+                    await asyncio.sleep(e.retry_after)
+
+    def get_stats(self) -> dict:
+        """Статистика ограничения отправок"""
+        return {
+            'throttled_seconds': round(self._throttled_seconds, 3),
+            'throttled_requests': self._throttled_requests,
+            'retry_after_count': self._retry_after_count,
+            'dropped_requests': self._dropped_requests,
+            'chat_buckets': len(self._chats),
+        }
@@ -0,0 +1,253 @@
+import asyncio
+import json
+import logging
+import time
+from collections.abc import MutableMapping
+from typing import Any, Callable, Dict, Optional, Set, Tuple
+
+from database import Database
+
+logger = logging.getLogger(__name__)
+
+_MISSING = object()
+
+
+class SessionMap(MutableMapping):
+    """Словарь состояния (user_id -> значение) со сквозной записью в SessionStore.
+
+    Чтение и запись идут в память; изменения отмечаются и записываются в базу
+    пачкой при следующем сбросе хранилища.
+    """
+
+    def __init__(self, store: 'SessionStore', scope: str,
+                 encode: Callable[[Any], Any], decode: Callable[[Any], Any]):
+        self.store = store
+        self.scope = scope
+        self.encode = encode
+        self.decode = decode
+        self._data: Dict[int, Any] = {}
+        # user_id -> время последнего обращения (для истечения по TTL)
+        self._touched: Dict[int, float] = {}
+
+    def _touch(self, key: int):
+        """Продлить запись, к которой обращаются (в базу - не чаще touch_interval)"""
+        now = time.time()
+        if now - self._touched[key] >= self.store.touch_interval:
+            self._touched[key] = now
+            self.store._mark_dirty(self.scope, key)
+
+    def __getitem__(self, key: int):
+        value = self._data[key]
+        self._touch(key)
+        return value
+
+    def get(self, key: int, default=None):
+        value = self._data.get(key, _MISSING)
+        if value is _MISSING:
+            return default
+        self._touch(key)
+        return value
+
+    def __contains__(self, key) -> bool:
+        if key in self._data:
+            self._touch(key)
+            return True
+        return False
+
+    def __setitem__(self, key: int, value):
+        self._data[key] = value
+        self._touched[key] = time.time()
+        self.store._mark_dirty(self.scope, key)
+
+    def __delitem__(self, key: int):
+        del self._data[key]
+        del self._touched[key]
+        self.store._mark_dirty(self.scope, key)
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({self.scope!r}, {self._data!r})"
+
+    def _restore(self, key: int, value, touched: float):
+        """Положить запись, загруженную из базы (без отметки на запись)"""
+        self._data[key] = value
+        self._touched[key] = touched
+
+
+class PresenceMap(SessionMap):
+    """Активные комнаты пользователей (user_id -> room_id) с обратным индексом room_id -> user_id.
+
+    Оба направления обновляются вместе при каждом изменении, поэтому список
+    пользователей в комнате не требует перебора всех сессий.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._by_room: Dict[int, Set[int]] = {}
+
+    def _index(self, key: int, room_id):
+        self._by_room.setdefault(room_id, set()).add(key)
+
+    def _unindex(self, key: int, room_id):
+        users = self._by_room.get(room_id)
+        if users is not None:
+            users.discard(key)
+            if not users:
+                del self._by_room[room_id]
+
+    def __setitem__(self, key: int, room_id):
+        old_room_id = self._data.get(key, _MISSING)
+        if old_room_id is not _MISSING:
+            self._unindex(key, old_room_id)
+        super().__setitem__(key, room_id)
+        self._index(key, room_id)
+
+    def __delitem__(self, key: int):
+        room_id = self._data[key]
+        super().__delitem__(key)
+        self._unindex(key, room_id)
+
+    def _restore(self, key: int, room_id, touched: float):
+        super()._restore(key, room_id, touched)
+        self._index(key, room_id)
+
+    def is_in(self, user_id: int, room_id: int) -> bool:
+        """Находится ли пользователь сейчас в комнате (не продлевает его запись)"""
+        return self._data.get(user_id) == room_id
+
+    def users_in(self, room_id: int) -> Set[int]:
+        """Пользователи, находящиеся в комнате (копия множества)"""
+        return set(self._by_room.get(room_id, ()))
+
+    def clear_room(self, room_id: int) -> Set[int]:
+        """Вывести всех пользователей из комнаты; возвращает их ID"""
+        users = self.users_in(room_id)
+        for user_id in users:
+            del self[user_id]
+        return users
+
+
+class SessionStore:
+    """Состояние сессий пользователей, переживающее перезапуск бота.
+
+    Словари состояния живут в памяти (SessionMap), изменения пачками
+    записываются в таблицу session_state. При запуске все записи загружаются
+    одним запросом; записи, к которым не обращались дольше ttl, удаляются.
+    """
+
+    def __init__(self, db: Database, ttl: float, flush_interval: float):
+        self.db = db
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        # Обращение к записи продлевает ее в базе не чаще, чем раз в touch_interval
+        self.touch_interval = ttl / 10
+        self._maps: Dict[str, SessionMap] = {}
+        self._dirty: Set[Tuple[str, int]] = set()
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = asyncio.Event()
+        self._stats = {'loaded': 0, 'flushes': 0, 'written': 0, 'deleted': 0, 'expired': 0}
+
+    def map(self, scope: str, encode: Callable[[Any], Any] = None, decode: Callable[[Any], Any] = None,
+            map_class: type = SessionMap) -> SessionMap:
+        """Создать словарь состояния; encode/decode переводят значение в JSON-совместимый вид и обратно"""
+        if scope in self._maps:
+            raise ValueError(f"Словарь состояния уже создан: {scope}")
+        session_map = map_class(self, scope, encode or (lambda value: value), decode or (lambda value: value))
+        self._maps[scope] = session_map
+        return session_map
+
+    def _mark_dirty(self, scope: str, key: int):
+        """Отметить запись для записи в базу при следующем сбросе"""
+        self._dirty.add((scope, key))
+
+    async def load(self):
+        """Восстановить состояние из базы (одним запросом) и удалить устаревшие записи"""
+        cutoff = time.time() - self.ttl
+        self._stats['expired'] += await self.db.expire_session_state(cutoff)
+        rows = await self.db.load_session_state(cutoff)
+        for scope, user_id, value, updated_at in rows:
+            session_map = self._maps.get(scope)
+            if session_map is None:
+                continue
+            try:
+                decoded = session_map.decode(json.loads(value))
+            except (ValueError, TypeError) as e:
+                logger.warning(f"Пропущено состояние {scope} пользователя {user_id}: {e}")
+                continue
+            if decoded is None:
+                continue
+            session_map._restore(user_id, decoded, updated_at)
+            self._stats['loaded'] += 1
+        logger.info(f"Состояние сессий восстановлено: {self._stats['loaded']} записей")
+
+    async def flush(self):
+        """Записать накопленные изменения в базу одной транзакцией"""
+        if not self._dirty:
+            return
+        dirty, self._dirty = self._dirty, set()
+        upserts = []
+        deletes = []
+        for scope, key in dirty:
+            session_map = self._maps[scope]
+            if key in session_map._data:
+                value = json.dumps(session_map.encode(session_map._data[key]), ensure_ascii=False)
+                upserts.append((scope, key, value, session_map._touched[key]))
+            else:
+                deletes.append((scope, key))
+        try:
+            await self.db.save_session_state(upserts, deletes)
+        except Exception:
+            # Не потерять изменения: повторим при следующем сбросе
+            self._dirty |= dirty
+            raise
+        self._stats['flushes'] += 1
+        self._stats['written'] += len(upserts)
+        self._stats['deleted'] += len(deletes)
+
+    def expire(self) -> int:
+        """Удалить из памяти записи, к которым не обращались дольше ttl"""
+        cutoff = time.time() - self.ttl
+        expired = 0
+        for session_map in self._maps.values():
+            stale = [key for key, touched in session_map._touched.items() if touched < cutoff]
+            for key in stale:
+                del session_map[key]
+            expired += len(stale)
+        self._stats['expired'] += expired
+        return expired
+
+    def start(self):
+        """Запустить фоновую запись изменений"""
+        if self._task is None:
+            self._stopping.clear()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Остановить фоновую запись и сбросить оставшиеся изменения"""
+        if self._task is not None:
+            self._stopping.set()
+            await self._task
+            self._task = None
+        await self.flush()
+
+    async def _run(self):
+        """Цикл: раз в flush_interval удаляем устаревшее и записываем изменения"""
+        while not self._stopping.is_set():
+            try:
+                await asyncio.wait_for(self._stopping.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            try:
+                self.expire()
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Ошибка записи состояния сессий: {e}")
+
+    def get_stats(self) -> Dict:
+        """Статистика: загружено, сбросов, записано, удалено, истекло, ожидает записи"""
+        return {**self._stats, 'pending': len(self._dirty)}
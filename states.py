@@ -0,0 +1,143 @@
+from dataclasses import asdict, dataclass
+from typing import Awaitable, Callable, Dict, NamedTuple, Optional
+
+from aiogram.types import Message
+
+
+# Состояния ожидания ввода: пользователь нажал кнопку или команду,
+# и следующее его сообщение - это данные для этого действия
+
+
+@dataclass(frozen=True)
+class CreateRoom:
+    """Ожидается название комнаты (и, возможно, ID заказчика через "|")"""
+
+
+@dataclass(frozen=True)
+class AddAccess:
+    """Ожидается "ID комнаты | ID пользователя" для добавления доступа"""
+
+
+@dataclass(frozen=True)
+class RemoveAccess:
+    """Ожидается "ID комнаты | ID пользователя" для удаления доступа"""
+
+
+@dataclass(frozen=True)
+class DeleteRoom:
+    """Ожидается ID комнаты для удаления"""
+
+
+@dataclass(frozen=True)
+class AddAdmin:
+    """Ожидается ID нового администратора"""
+
+
+@dataclass(frozen=True)
+class ChooseRole:
+    """Администратор выбирает роль для назначения (кнопкой)"""
+
+
+@dataclass(frozen=True)
+class AddRole:
+    """Ожидается ID пользователя, которому назначается роль"""
+    role: str
+
+
+@dataclass(frozen=True)
+class CreateRoomFromChat:
+    """Ожидается название комнаты, создаваемой из чата с пользователем"""
+    target_user_id: int
+    role: str
+
+
+@dataclass(frozen=True)
+class EditNotes:
+    """Ожидается текст пометок о заказчике"""
+    target_user_id: int
+
+
+@dataclass(frozen=True)
+class AddReview:
+    """Ожидается текст отзыва о закрытом заказе"""
+    room_id: int
+
+
+@dataclass(frozen=True)
+class ReviewReply:
+    """Ожидается ответ администратора на отзыв"""
+    review_id: int
+
+
+@dataclass(frozen=True)
+class EditRoom:
+    """Ожидается новое название комнаты"""
+    room_id: int
+
+
+@dataclass(frozen=True)
+class RoomAccess:
+    """Ожидается ID пользователя, добавляемого в комнату с выбранной ролью"""
+    room_id: int
+    role: str
+
+
+@dataclass(frozen=True)
+class SearchMessages:
+    """Ожидается текст для поиска по сообщениям"""
+
+
+# Все типы состояний по имени (для сохранения состояния в базе)
+STATE_TYPES = {
+    state_type.__name__: state_type
+    for state_type in (
+        CreateRoom, AddAccess, RemoveAccess, DeleteRoom, AddAdmin, ChooseRole,
+        AddRole, CreateRoomFromChat, EditNotes, AddReview, ReviewReply, EditRoom, RoomAccess,
+        SearchMessages,
+    )
+}
+
+
+def state_to_dict(state) -> Dict:
+    """Состояние в словарь для JSON: {'type': имя класса, ...поля}"""
+    return {'type': type(state).__name__, **asdict(state)}
+
+
+def state_from_dict(data: Dict):
+    """Состояние из словаря state_to_dict (None, если тип состояния больше не существует)"""
+    fields = dict(data)
+    state_type = STATE_TYPES.get(fields.pop('type', None))
+    if state_type is None:
+        return None
+    return state_type(**fields)
+
+
+class InputRoute(NamedTuple):
+    """Обработчик состояния и условия, при которых он принимает сообщение"""
+    handler: Callable[[Message, object, str], Awaitable]
+    admin_only: bool
+    accepts: Optional[Callable[[str], bool]]
+
+
+class StateRouter:
+    """Выбор обработчика ввода по типу состояния пользователя за O(1)"""
+
+    def __init__(self):
+        self._routes: Dict[type, InputRoute] = {}
+
+    def handler(self, state_type: type, *, admin_only: bool = False, accepts: Callable[[str], bool] = None):
+        """Декоратор: зарегистрировать обработчик состояния.
+
+        accepts - проверка текста сообщения; если она не прошла, сообщение
+        обрабатывается дальше так, будто состояния нет.
+        """
+        def decorator(handler):
+            if state_type in self._routes:
+                raise ValueError(f"Обработчик состояния уже зарегистрирован: {state_type.__name__}")
+            self._routes[state_type] = InputRoute(handler, admin_only, accepts)
+            return handler
+        return decorator
+
+    def lookup(self, state) -> Optional[InputRoute]:
+        """Найти обработчик для состояния"""
+        return self._routes.get(type(state))
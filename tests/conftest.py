@@ -0,0 +1,78 @@
+import asyncio
+import inspect
+import os
+import sys
+from contextlib import asynccontextmanager
+
+import pytest
+
+# config.py завершает процесс без токена и администраторов
+os.environ.setdefault('BOT_TOKEN', '123456:test-token')
+os.environ.setdefault('ADMIN_IDS', '1')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import Database  # noqa: E402
+
+
+def pytest_configure(config):
+    config.addinivalue_line('markers', 'db(**attrs): атрибуты Database, заданные до init_db')
+
+
+@pytest.fixture(autouse=True)
+def runner():
+    """Цикл событий теста: в нем открывается Database и выполняются async-тесты"""
+    with asyncio.Runner() as runner:
+        yield runner
+
+
+@pytest.hookimpl(tryfirst=True)
+def pytest_pyfunc_call(pyfuncitem):
+    """Выполнить async def тест в цикле событий фикстуры runner"""
+    if not inspect.iscoroutinefunction(pyfuncitem.obj):
+        return None
+    arguments = {name: pyfuncitem.funcargs[name] for name in inspect.signature(pyfuncitem.obj).parameters}
+    pyfuncitem.funcargs['runner'].run(pyfuncitem.obj(**arguments))
+    return True
+
+
+@pytest.fixture
+def db(runner, tmp_path, request):
+    """Открытая Database на пустой базе во временном каталоге; закрывается после теста"""
+    database = Database()
+    database.db_path = str(tmp_path / 'bot_database.db')
+    database.archive_path = str(tmp_path / 'bot_archive.db')
+    marker = request.node.get_closest_marker('db')
+    for name, value in (marker.kwargs if marker else {}).items():
+        setattr(database, name, value)
+    runner.run(database.init_db())
+    yield database
+    runner.run(database.close())
+
+
+@pytest.fixture
+def pause_after_next_read():
+    """Функция pause(db), задерживающая следующее чтение из пула (см. _pause_after_next_read)"""
+    return _pause_after_next_read
+
+
+def _pause_after_next_read(db: Database):
+    """Задержать следующее чтение из пула после выполнения запроса.
+    
+    Возвращает (read_done, resume): read_done выставляется, когда запрос выполнен,
+    а чтение завершается (и заполняет кэш) только после resume.set().
+    Так тест вклинивает запись между чтением базы и заполнением кэша.
+    """
+    read_done = asyncio.Event()
+    resume = asyncio.Event()
+    original_read = db._read
+    
+    @asynccontextmanager
+    async def paused_read():
+        db._read = original_read
+        async with original_read() as conn:
+            yield conn
+        read_done.set()
+        await resume.wait()
+    
+    db._read = paused_read
+    return read_done, resume
@@ -0,0 +1,37 @@
+from contextlib import asynccontextmanager
+
+import pytest
+
+
+async def test_archive_rerun_after_failed_delete(db):
+    """Сбой между фиксацией порции в архиве и удалением из основной базы не дублирует сообщения"""
+    await db.add_user(1, 'admin', 'Admin', 'admin')
+    room_id = await db.create_room('Комната', created_by=1)
+    for i in range(5):
+        await db.save_message(room_id, 1, f'сообщение {i}', False)
+    
+    original_write = db._write
+    writes = 0
+    
+    @asynccontextmanager
+    async def failing_write():
+        nonlocal writes
+        writes += 1
+        if writes == 2:
+            raise RuntimeError('сбой перед удалением из основной базы')
+        async with original_write() as conn:
+            yield conn
+    
+    db._write = failing_write
+    with pytest.raises(RuntimeError):
+        await db.archive_room_messages(room_id, chunk_size=3)
+    db._write = original_write
+    # Первая порция уже в архиве, но еще не удалена из основной базы
+    assert (await db.get_room_archive_info(room_id))['message_count'] == 3
+    assert len((await db.get_room_history(room_id, limit=10))['messages']) == 5
+    
+    await db.archive_room_messages(room_id, chunk_size=3)
+    assert (await db.get_room_history(room_id, limit=10))['messages'] == []
+    assert (await db.get_room_archive_info(room_id))['message_count'] == 5
+    history = await db.get_archived_room_history(room_id, limit=10)
+    assert [m['message_text'] for m in history['messages']] == [f'сообщение {i}' for i in range(5)]
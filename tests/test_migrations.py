@@ -0,0 +1,34 @@
+from database import SCHEMA_VERSION, Database
+
+TIME_ORDERED_INDEXES = ('idx_messages_room_created', 'idx_chat_messages_chat_created')
+
+
+async def index_names(db: Database) -> set:
+    async with db._read() as conn:
+        async with conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'") as cursor:
+            return {row[0] for row in await cursor.fetchall()}
+
+
+async def test_fresh_schema_has_no_time_ordered_message_indexes(db):
+    """Новая база не создает индексы сообщений по времени: их не читает ни один запрос"""
+    assert not set(TIME_ORDERED_INDEXES) & await index_names(db)
+
+
+async def test_upgrade_drops_time_ordered_message_indexes(db):
+    """Миграция 10 удаляет индексы сообщений по времени из существующей базы"""
+    await db._writer.execute('CREATE INDEX idx_messages_room_created ON messages (room_id, created_at)')
+    await db._writer.execute('CREATE INDEX idx_chat_messages_chat_created ON chat_messages (chat_id, created_at)')
+    await db._writer.execute('PRAGMA user_version = 9')
+    await db._writer.commit()
+    await db.close()
+    
+    upgraded = Database()
+    upgraded.db_path, upgraded.archive_path = db.db_path, db.archive_path
+    await upgraded.init_db()
+    try:
+        assert not set(TIME_ORDERED_INDEXES) & await index_names(upgraded)
+        async with upgraded._read() as conn:
+            async with conn.execute('PRAGMA user_version') as cursor:
+                assert (await cursor.fetchone())[0] == SCHEMA_VERSION
+    finally:
+        await upgraded.close()
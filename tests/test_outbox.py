@@ -0,0 +1,15 @@
+import time
+
+
+async def test_compact_deletes_failed_after_retention(db):
+    """Уплотнение сразу удаляет доставленные сообщения, недоставляемые - только по истечении срока хранения"""
+    await db.enqueue_outbox([(chat_id, 'send_message', {'text': str(chat_id)}) for chat_id in (1, 2, 3)])
+    sent, failed, pending = [row['id'] for row in await db.get_due_outbox()]
+    await db.mark_outbox_sent([sent])
+    await db.mark_outbox_failed([(failed, 'Forbidden: bot was blocked by the user')])
+    
+    assert await db.compact_outbox(failed_before=time.time() - 86400) == 1
+    assert await db.compact_outbox(failed_before=time.time() - 86400) == 0
+    
+    assert await db.compact_outbox(failed_before=time.time() + 60) == 1
+    assert [row['id'] for row in await db.get_due_outbox()] == [pending]
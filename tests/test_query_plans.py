@@ -0,0 +1,38 @@
+import pytest
+
+# Горячие запросы и индекс, по которому должен идти поиск в первой таблице плана
+HOT_QUERIES = [
+    ('get_user_rooms', lambda db: db.get_user_rooms(5), 'idx_room_access_user'),
+    ('has_room_access', lambda db: db.has_room_access(1, 5), 'sqlite_autoindex_room_access_1'),
+    ('user_has_any_room', lambda db: db.user_has_any_room(5), 'idx_room_access_user'),
+    ('get_room_history', lambda db: db.get_room_history(1, before_id=100), 'idx_messages_room_id'),
+    ('get_chat_history', lambda db: db.get_chat_history(1, before_id=100), 'idx_chat_messages_chat_id'),
+    ('get_users_by_role', lambda db: db.get_users_by_role('admin'), 'idx_users_role_created'),
+    ('get_customer_closed_orders', lambda db: db.get_customer_closed_orders(5), 'idx_order_history_customer_closed'),
+    ('get_order_history_by_room', lambda db: db.get_order_history_by_room(5), 'idx_order_history_room'),
+    ('get_rooms_page', lambda db: db.get_rooms_page(('next', 100, 5)), 'idx_rooms_created'),
+    ('get_chats_page', lambda db: db.get_chats_page(('next', 100, 5)), 'idx_chats_last_message'),
+    ('get_customers_page', lambda db: db.get_customers_page(('next', 100, 5)), 'idx_customers_updated'),
+    ('get_users_page', lambda db: db.get_users_page('admin', ('next', 100, 5)), 'idx_users_role_created'),
+    ('get_reviews_page', lambda db: db.get_reviews_page(('next', 100, 5)), 'idx_reviews_created'),
+    ('get_order_history_page', lambda db: db.get_order_history_page(('next', 100, 5)), 'idx_order_history_closed'),
+]
+
+
+@pytest.mark.parametrize('name, call, index', HOT_QUERIES, ids=[query[0] for query in HOT_QUERIES])
+async def test_hot_query_uses_index(db, name, call, index):
+    """Запрос метода после всех миграций - поиск по индексу, без полного просмотра таблиц"""
+    # SQL берется из самого метода, чтобы проверка не расходилась с кодом
+    traced = []
+    for conn in db._readers:
+        await conn.set_trace_callback(traced.append)
+    await call(db)
+    selects = [sql for sql in traced if sql.lstrip().upper().startswith('SELECT')]
+    assert selects, f'{name} не выполнил ни одного SELECT'
+    for sql in selects:
+        async with db._writer.execute('EXPLAIN QUERY PLAN ' + sql) as cursor:
+            plan = [row[3] for row in await cursor.fetchall()]
+        assert plan[0].startswith('SEARCH ') and (
+            f'USING INDEX {index} ' in plan[0] or f'USING COVERING INDEX {index} ' in plan[0]
+        ), plan
+        assert not any(step.startswith('SCAN ') for step in plan), plan
@@ -0,0 +1,30 @@
+import asyncio
+import time
+
+from aiogram.methods import EditMessageText, SendMessage
+
+from ratelimit import RateLimiter
+
+
+def test_edit_after_burst_is_not_delayed():
+    """Правка сообщения после серии из трех отправок не ждет токена чата"""
+    async def scenario():
+        limiter = RateLimiter(global_rate=30, chat_rate=1, chat_burst=3, group_rate=20 / 60, max_retries=3)
+        sent = []
+        
+        async def make_request(bot, method):
+            sent.append(method.__api_method__)
+            return True
+        
+        for i in range(3):
+            await limiter(make_request, None, SendMessage(chat_id=5, text=f'сообщение {i}'))
+        # Корзина чата пуста: следующая отправка ждала бы около секунды
+        assert limiter._chats[5].tokens < 1
+        
+        started = time.monotonic()
+        await limiter(make_request, None, EditMessageText(chat_id=5, message_id=1, text='правка'))
+        assert time.monotonic() - started < 0.1
+        assert sent == ['sendMessage'] * 3 + ['editMessageText']
+        assert limiter.get_stats()['throttled_requests'] == 0
+    
+    asyncio.run(scenario())
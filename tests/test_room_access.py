@@ -0,0 +1,53 @@
+import asyncio
+
+
+async def test_revoke_during_cache_miss_is_not_cached(db, pause_after_next_read):
+    """Отзыв доступа, пока промах кэша читает базу, не перезаписывается старым True"""
+    await db.add_user(1, 'admin', 'Admin', 'admin')
+    await db.add_user(2, 'dev', 'Dev')
+    room_id = await db.create_room('Комната', created_by=1)
+    await db.add_room_access(room_id, 2)
+    
+    read_done, resume = pause_after_next_read(db)
+    check = asyncio.create_task(db.has_room_access(room_id, 2))
+    await read_done.wait()
+    await db.remove_room_access(room_id, 2)
+    resume.set()
+    
+    # Чтение началось до отзыва и вернуло старое значение...
+    assert await check is True
+    # ...но в кэш оно не попало
+    assert await db.has_room_access(room_id, 2) is False
+
+
+async def test_room_delete_during_cache_miss_is_not_cached(db, pause_after_next_read):
+    """Удаление комнаты, пока промах кэша читает запись, не оставляет ее в кэше"""
+    await db.add_user(1, 'admin', 'Admin', 'admin')
+    room_id = await db.create_room('Комната', created_by=1)
+    
+    read_done, resume = pause_after_next_read(db)
+    lookup = asyncio.create_task(db.get_room(room_id))
+    await read_done.wait()
+    await db.delete_room(room_id)
+    resume.set()
+    
+    assert (await lookup)['room_id'] == room_id
+    assert await db.get_room(room_id) is None
+
+
+async def test_role_change_during_recipients_miss_is_not_cached(db, pause_after_next_read):
+    """Смена роли, пока промах кэша читает получателей рассылки, не оставляет старый список"""
+    await db.add_user(1, 'admin', 'Admin', 'admin')
+    await db.add_user(2, 'dev', 'Dev')
+    room_id = await db.create_room('Комната', created_by=1)
+    await db.add_room_access(room_id, 2)
+    
+    read_done, resume = pause_after_next_read(db)
+    lookup = asyncio.create_task(db.get_room_broadcast_recipients(room_id))
+    await read_done.wait()
+    await db.update_user_role(2, 'admin')
+    resume.set()
+    await lookup
+    
+    recipients = {r['user_id']: r for r in await db.get_room_broadcast_recipients(room_id)}
+    assert recipients[2]['is_admin'] is True
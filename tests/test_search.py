@@ -0,0 +1,39 @@
+import database
+
+
+async def test_member_search_window_ignores_other_rooms(db, monkeypatch):
+    """Совпадения в чужих комнатах не вытесняют из окна ранжирования комнаты пользователя"""
+    monkeypatch.setattr(database, 'SEARCH_RANK_WINDOW', 3)
+    await db.add_user(1, 'admin', 'Admin', 'admin')
+    await db.add_user(2, 'dev', 'Dev')
+    own_room = await db.create_room('Своя', created_by=1)
+    other_room = await db.create_room('Чужая', created_by=1)
+    await db.add_room_access(own_room, 2)
+    for i in range(2):
+        await db.save_message(own_room, 1, f'дедлайн по макету {i}', False)
+    # Более новые совпадения вне комнат пользователя больше окна
+    for i in range(10):
+        await db.save_message(other_room, 1, f'дедлайн по бэкенду {i}', False)
+    
+    found = await db.search_messages('дедлайн', member_id=2)
+    assert {item['owner_id'] for item in found['items']} == {own_room}
+    assert len(found['items']) == 2
+    
+    everything = await db.search_messages('дедлайн', limit=20)
+    assert len(everything['items']) == 3
+
+
+async def test_search_reports_matches_outside_window(db, monkeypatch):
+    """Поиск сообщает, что более старые совпадения не вошли в окно ранжирования"""
+    monkeypatch.setattr(database, 'SEARCH_RANK_WINDOW', 3)
+    await db.add_user(1, 'admin', 'Admin', 'admin')
+    room_id = await db.create_room('Комната', created_by=1)
+    for i in range(3):
+        await db.save_message(room_id, 1, f'дедлайн {i}', False)
+    
+    assert not (await db.search_messages('дедлайн'))['truncated']
+    
+    await db.save_message(room_id, 1, 'дедлайн 3', False)
+    found = await db.search_messages('дедлайн', limit=20)
+    assert found['truncated']
+    assert len(found['items']) == 3
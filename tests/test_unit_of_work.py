@@ -0,0 +1,57 @@
+import asyncio
+
+import pytest
+
+
+@pytest.mark.db(write_behind=True, write_behind_queue_size=1, write_behind_max_delay=0, unit_max_hold=0)
+async def test_write_behind_full_queue_inside_unit(db):
+    """Сообщение в единице работы не ждет места в полной очереди отложенной записи"""
+    await db.add_user(1, 'admin', 'Admin', 'admin')
+    room_id = await db.create_room('Комната', created_by=1)
+    writer_held = asyncio.Event()
+    queue_full = asyncio.Event()
+    
+    async def send_outside_unit():
+        await writer_held.wait()
+        # Задача сброса берет первое сообщение и ждет соединения записи,
+        # второе сообщение заполняет очередь
+        for i in range(2):
+            await db.save_message(room_id, 1, f'из очереди {i}', False)
+        queue_full.set()
+    
+    # Задача создается до единицы работы и пишет вне ее
+    sender = asyncio.create_task(send_outside_unit())
+    async with db.unit_of_work():
+        await db.add_room_access(room_id, 1, 'developer')
+        writer_held.set()
+        await queue_full.wait()
+        await asyncio.wait_for(db.save_message(room_id, 1, 'в единице работы', False), 5)
+    await sender
+    
+    history = await db.get_room_history(room_id)
+    assert {m['message_text'] for m in history['messages']} == {'из очереди 0', 'из очереди 1', 'в единице работы'}
+
+
+@pytest.mark.db(unit_max_hold=0.05)
+async def test_unit_hold_timeout_releases_writer(db):
+    """Единица, ждущая не базу, фиксирует записи по таймеру и отпускает соединение записи"""
+    await db.add_user(1, 'admin', 'Admin', 'admin')
+    room_id = await db.create_room('Комната', created_by=1)
+    unit_wrote = asyncio.Event()
+    release_unit = asyncio.Event()
+    
+    async def handler():
+        async with db.unit_of_work():
+            await db.update_room_name(room_id, 'Из единицы работы')
+            unit_wrote.set()
+            # Ожидание, не связанное с базой (рассылка, пауза)
+            await release_unit.wait()
+    
+    unit_task = asyncio.create_task(handler())
+    await unit_wrote.wait()
+    # Запись вне единицы дожидается соединения после фиксации по таймеру
+    await asyncio.wait_for(db.add_user(2, 'dev', 'Dev'), 5)
+    assert (await db.get_room(room_id))['room_name'] == 'Из единицы работы'
+    assert db.get_write_stats()['units_hold_expired'] == 1
+    release_unit.set()
+    await unit_task
@@ -0,0 +1,55 @@
+from contextlib import asynccontextmanager
+
+import aiosqlite
+import pytest
+
+
+@pytest.mark.db(write_behind=True, write_behind_max_delay=5)
+async def test_bad_row_drops_only_itself(db, caplog):
+    """Строка с нарушением внешнего ключа отбрасывается, остальные сообщения пакета записываются"""
+    await db.add_user(1, 'admin', 'Admin', 'admin')
+    room_id = await db.create_room('Комната', created_by=1)
+    await db.save_message(room_id, 1, 'до', False)
+    # Комнаты 999 нет: вставка нарушает внешний ключ messages.room_id
+    await db.save_message(999, 1, 'в несуществующую комнату', False)
+    await db.save_message(room_id, 1, 'после', False)
+    await db.flush_pending_writes()
+    
+    history = await db.get_room_history(room_id)
+    assert [m['message_text'] for m in history['messages']] == ['до', 'после']
+    assert any('999' in record.getMessage() and record.levelname == 'ERROR' for record in caplog.records)
+
+
+@pytest.mark.db(write_behind=True)
+async def test_batch_is_retried_after_transient_error(db):
+    """Ошибка, не связанная со строками (database is locked), не теряет пакет: он записывается повторно"""
+    await db.add_user(1, 'admin', 'Admin', 'admin')
+    room_id = await db.create_room('Комната', created_by=1)
+    original_write = db._write
+    
+    @asynccontextmanager
+    async def locked_once():
+        db._write = original_write
+        raise aiosqlite.OperationalError('database is locked')
+        yield
+    
+    db._write = locked_once
+    await db.save_message(room_id, 1, 'сообщение', False)
+    await db.flush_pending_writes()
+    
+    history = await db.get_room_history(room_id)
+    assert [m['message_text'] for m in history['messages']] == ['сообщение']
+    assert db._write == original_write
+
+
+@pytest.mark.db(write_behind=True, write_behind_max_delay=5)
+async def test_chat_messages_keep_send_order(db):
+    """Ответ администратора из очереди и входящее сообщение пользователя получают message_id в порядке отправки"""
+    await db.add_user(1, 'admin', 'Admin', 'admin')
+    await db.add_user(2, 'customer', 'Customer')
+    chat_id = await db.get_or_create_chat(2)
+    await db.save_chat_message(chat_id, 1, 'ответ администратора', False)
+    await db.record_user_chat_message(2, 'customer', 'Customer', 'user', 'сообщение пользователя')
+    
+    history = await db.get_chat_history(chat_id)
+    assert [m['message_text'] for m in history['messages']] == ['ответ администратора', 'сообщение пользователя']
@@ -0,0 +1,45 @@
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.types import TelegramObject
+
+from database import Database
+
+
+class UnitOfWorkMiddleware(BaseMiddleware):
+    """Одна единица работы Database на каждое обновление Telegram.
+
+    Все записи обработчика идут в одной транзакции: фиксация в конце
+    обновления (или раньше - в точке фиксации или по истечении
+    UNIT_OF_WORK_MAX_HOLD_MS), откат при ошибке.
+    Единица передается обработчику в аргументе unit_of_work.
+    """
+
+    def __init__(self, db: Database):
+        self.db = db
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        async with self.db.unit_of_work() as unit:
+            data['unit_of_work'] = unit
+            return await handler(event, data)
+
+
+class CommitBeforeRequestMiddleware(BaseRequestMiddleware):
+    """Точка фиксации перед каждым запросом к Telegram.
+
+    Пользователь не получает ответа о записи, которая еще может откатиться,
+    а соединение записи не удерживается на время сетевого запроса.
+    """
+
+    def __init__(self, db: Database):
+        self.db = db
+
+    async def __call__(self, make_request, bot, method):
+        await self.db.commit_unit_of_work()
+        return await make_request(bot, method)